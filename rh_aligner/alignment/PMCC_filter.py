@@ -1,7 +1,6 @@
 import sys
 import cv2
 import numpy as np
-from scipy.ndimage.filters import maximum_filter
 #import pylab
 
 FAIL_PMCC_SCORE_TOO_LOW = 0
@@ -9,15 +8,32 @@ FAIL_PMCC_ON_EDGE = 1
 FAIL_PMCC_CURVATURE_TOO_HIGH = 2
 FAIL_PMCC_MAXRATIO_TOO_HIGH = 3
 FAIL_PMCC_NOT_LOCALIZED = 4
+FAIL_PMCC_EMPTY_TEMPLATE = 5
+FAIL_PMCC_REASONS = ['score_too_low', 'on_edge', 'curvature_too_high', 'maxratio_too_high', 'not_localized', 'empty_template']
+
+def is_empty_template(template, min_std=1.0, min_gradient_energy=0.0):
+    """Returns True if the template has too little texture to be matched (e.g., resin, holes or out of tissue areas),
+       either by its standard deviation or by its mean squared gradient"""
+    template = template.astype(np.float32)
+    if template.std() < min_std:
+        return True
+    if min_gradient_energy > 0:
+        gradient_energy = np.mean(np.diff(template, axis=0) ** 2) + np.mean(np.diff(template, axis=1) ** 2)
+        if gradient_energy < min_gradient_energy:
+            return True
+    return False
 
 def PMCC_match(image, template, min_correlation=0.2, maximal_curvature_ratio=10, maximal_ROD=0.9):
     # compute the correlation image
     correlation_image = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
     # pylab.imshow((correlation_image + 1) / 2.0)
 
-    # find local maxima
-    maxima_mask = (correlation_image == maximum_filter(correlation_image, size=3))
+    # find local maxima (dilation by a 3x3 kernel is a 3x3 maximum filter that only compares the border pixels to the image pixels)
+    maxima_mask = (correlation_image == cv2.dilate(correlation_image, np.ones((3, 3), dtype=np.uint8)))
     maxima_values = correlation_image[maxima_mask]
+    # Only the two highest maxima are needed
+    if maxima_values.size > 2:
+        maxima_values = np.partition(maxima_values, maxima_values.size - 2)[-2:]
     maxima_values.sort()
 
     if maxima_values[-1] < min_correlation:
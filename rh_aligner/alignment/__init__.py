@@ -5,9 +5,11 @@
 from .pre_match_3d_incremental import match_layers_sift_features
 from .block_match_3d_multiprocess import match_layers_pmcc_matching
 from .optimize_layers_elastic import optimize_layers_elastic
+from .global_registration import register_sections
 
 __all__ = [
             'match_layers_sift_features',
             'match_layers_pmcc_matching',
-            'optimize_layers_elastic'
+            'optimize_layers_elastic',
+            'register_sections'
           ]
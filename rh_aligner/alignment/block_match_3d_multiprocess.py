@@ -1,16 +1,21 @@
 # Setup
 from __future__ import print_function
 import os
+import math
 import numpy as np
 import json
 import time
 import sys
+import tempfile
 from scipy.spatial import distance
 from scipy import spatial
 import cv2
 import argparse
 from ..common import utils
-from ..common.bounding_box import BoundingBox
+from ..common.tile_collection import TileCollection
+from ..common.section_grid_index import load_section_grid_index
+from ..common.match_store import MatchStore, save_match_store, is_match_store_fname
+from .section_pyramid import load_section_pyramid, render_strips
 from rh_renderer import models
 import PMCC_filter
 import multiprocessing as mp
@@ -30,19 +35,9 @@ logger.addHandler(logger_handler)
 
 
 
-def get_mfov_centers_from_json(indexed_ts):
-    mfov_centers = {}
-    for mfov in indexed_ts.keys():
-        tile_bboxes = []
-        mfov_tiles = indexed_ts[mfov].values()
-        tile_bboxes = zip(*[tile["bbox"] for tile in mfov_tiles])
-        min_x = min(tile_bboxes[0])
-        max_x = max(tile_bboxes[1])
-        min_y = min(tile_bboxes[2])
-        max_y = max(tile_bboxes[3])
-        # center = [(min_x + min_y) / 2.0, (min_y + max_y) / 2.0], but w/o overflow
-        mfov_centers[mfov] = np.array([(min_x / 2.0 + max_x / 2.0, min_y / 2.0 + max_y / 2.0)])
-    return mfov_centers
+def get_mfov_centers_from_json(ts):
+    """Returns a dictionary that maps each mfov to the center of its bounding box"""
+    return TileCollection(ts).mfov_centers()
 
 def get_best_transformations(pre_mfov_matches, tiles_fname1, tiles_fname2, mfov_centers1, mfov_centers2, sorted_mfovs1, sorted_mfovs2):
     """Returns a dictionary that maps an mfov number to a matrix that best describes the transformation to the other section.
@@ -66,7 +61,7 @@ def get_best_transformations(pre_mfov_matches, tiles_fname1, tiles_fname2, mfov_
         reversed_transformations = [np.linalg.inv(m["transformation"]["matrix"]) for m in pre_mfov_matches["matches"]]
 
         # Build a kdtree from the mfovs centers in section 2
-        kdtree = spatial.KDTree(np.array(mfov_centers1.values()).flatten().reshape(len(mfov_centers1), 2))
+        kdtree = spatial.KDTree(np.array([mfov_centers1[m] for m in sorted_mfovs1]).reshape(len(sorted_mfovs1), 2))
 
         # For each mfov transformed center in section 2, find the closest center, and declare it as a transformation
         closest_centers_idx = kdtree.query(transformed_section_centers2)[1]
@@ -126,12 +121,7 @@ def find_best_mfov_transformation(mfov, best_transformations, mfov_centers):
 
 
 def get_tile_centers_from_json(ts):
-    tiles_centers = []
-    for tile in ts:
-        center_x = (tile["bbox"][0] + tile["bbox"][1]) / 2.0
-        center_y = (tile["bbox"][2] + tile["bbox"][3]) / 2.0
-        tiles_centers.append(np.array([center_x, center_y]))
-    return tiles_centers
+    return TileCollection(ts).centers()
 
 
 def get_closest_index_to_point(point, centerstree):
@@ -149,13 +139,160 @@ def is_point_in_img(tile_ts, point):
     return False
 
 
-def execute_pmcc_matching(img1_center_point, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer, min_corr, max_curvature, max_rod, debug_save_matches=False, debug_dir=None):
-    # Assumes that img1_renderer already has the transformation to img2 applied, and is scaled down,
-    # and that img2_renderer is already scaled down,
-    # and img1_center_point is w/o the transformation to img2 and w/o the scaling
-
+class RenderedRegion(object):
+    """A region of a section that is rendered once (by a renderer that has a crop method) into a contiguous image,
+       so that sub-images of the region are cut as views of that image, instead of being rendered again"""
+
+    def __init__(self, image, start_point):
+        self.image = image
+        self.start_point = start_point
+
+    @classmethod
+    def render(cls, renderer, from_x, from_y, to_x, to_y):
+        """Renders the pixels [floor(from), floor(to)] (inclusive) of the given renderer"""
+        from_x, from_y = int(math.floor(from_x)), int(math.floor(from_y))
+        to_x, to_y = int(math.floor(to_x)), int(math.floor(to_y))
+        rendered, rendered_start_point = renderer.crop(from_x, from_y, to_x, to_y)
+        image = np.zeros((to_y - from_y + 1, to_x - from_x + 1), dtype=np.uint8 if rendered is None else rendered.dtype)
+        if rendered is not None:
+            # The renderer may return a smaller image (e.g., near the section's boundaries), so place it in the region
+            off_x, off_y = int(rendered_start_point[0]) - from_x, int(rendered_start_point[1]) - from_y
+            dst = image[max(0, off_y):off_y + rendered.shape[0], max(0, off_x):off_x + rendered.shape[1]]
+            dst[...] = rendered[max(0, -off_y):max(0, -off_y) + dst.shape[0], max(0, -off_x):max(0, -off_x) + dst.shape[1]]
+        return cls(image, (from_x, from_y))
+
+    def crop(self, from_x, from_y, to_x, to_y):
+        """Returns a view of the pixels [floor(from), floor(to)] (inclusive) of the region, and the view's start point.
+           If the requested area is not inside the region (e.g., a search window near the boundary of a whole rendered
+           section), the area outside the region is zero-padded (in a copy)"""
+        from_x, from_y = int(math.floor(from_x)) - self.start_point[0], int(math.floor(from_y)) - self.start_point[1]
+        to_x, to_y = int(math.floor(to_x)) - self.start_point[0], int(math.floor(to_y)) - self.start_point[1]
+        start_point = (from_x + self.start_point[0], from_y + self.start_point[1])
+        if from_x >= 0 and from_y >= 0 and to_x < self.image.shape[1] and to_y < self.image.shape[0]:
+            return self.image[from_y:to_y + 1, from_x:to_x + 1], start_point
+        cropped = np.zeros((to_y - from_y + 1, to_x - from_x + 1), dtype=self.image.dtype)
+        src = self.image[max(0, from_y):max(0, to_y + 1), max(0, from_x):max(0, to_x + 1)]
+        cropped[max(0, -from_y):max(0, -from_y) + src.shape[0], max(0, -from_x):max(0, -from_x) + src.shape[1]] = src
+        return cropped, start_point
+
+
+class SharedRenderedRegion(object):
+    """A RenderedRegion whose image is copied to a shared memory array, so processes that are forked after its creation
+       can use it without copying (or pickling) the image"""
+
+    def __init__(self, region):
+        self.shape = region.image.shape
+        self.dtype = region.image.dtype
+        self.start_point = region.start_point
+        image_bytes = np.ascontiguousarray(region.image).view(np.uint8).ravel()
+        self.image = mp.RawArray('B', max(image_bytes.size, 1))
+        np.frombuffer(self.image, dtype=np.uint8)[:image_bytes.size] = image_bytes
+
+    def region(self):
+        """Returns a RenderedRegion whose image is a view of the shared memory array"""
+        image = np.frombuffer(self.image, dtype=self.dtype, count=int(np.prod(self.shape))).reshape(self.shape)
+        return RenderedRegion(image, self.start_point)
+
+
+def share_region(region):
+    """Returns the given region in the form that is passed to forked processes: an in-memory RenderedRegion is copied to
+       a SharedRenderedRegion, and a memory mapped RenderedRegion, a TransformedRegion (whose warped crops are cut from
+       its region when they are needed) or None are inherited by the processes as is (see unshare_region)"""
+    if isinstance(region, RenderedRegion) and not isinstance(region.image, np.memmap):
+        return SharedRenderedRegion(region)
+    return region
+
+
+def unshare_region(shared_region):
+    """Returns the region of a region that was passed to a process by share_region"""
+    if isinstance(shared_region, SharedRenderedRegion):
+        return shared_region.region()
+    return shared_region
+
+
+class TransformedRegion(object):
+    """A view of a RenderedRegion of a section (rendered at some scaling) through a transformation to the coordinates of
+       another section (at the same scaling). Only the cropped sub-images are warped, so the same rendered section can be
+       used to match its points to another section, and as the search area of the other section's points"""
+
+    def __init__(self, region, transform, scaling):
+        self.region = region
+        # The (scaled) transformation from the other section's scaled coordinates to this section's scaled coordinates
+        inv_transform = np.linalg.inv(np.vstack((np.asarray(transform, dtype=np.float64)[:2], [0., 0., 1.])))
+        self.inv_matrix = inv_transform[:2, :2]
+        self.inv_translation = inv_transform[:2, 2] * scaling
+
+    def crop(self, from_x, from_y, to_x, to_y):
+        """Returns the pixels [floor(from), floor(to)] (inclusive, in the other section's scaled coordinates), and the
+           start point (see RenderedRegion.crop)"""
+        from_x, from_y = int(math.floor(from_x)), int(math.floor(from_y))
+        to_x, to_y = int(math.floor(to_x)), int(math.floor(to_y))
+        # Map each cropped pixel to the rendered region pixels
+        warp_matrix = np.empty((2, 3), dtype=np.float64)
+        warp_matrix[:, :2] = self.inv_matrix
+        warp_matrix[:, 2] = np.dot(self.inv_matrix, [from_x, from_y]) + self.inv_translation - np.array(self.region.start_point)
+        cropped = cv2.warpAffine(self.region.image, warp_matrix, (to_x - from_x + 1, to_y - from_y + 1),
+                                 flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return cropped, (from_x, from_y)
+
+
+def render_section(renderer, bbox, scaling, margin=0, strip_height=2048):
+    """Renders the (whole) given section bounding box with the given renderer (that scales the section by scaling), and
+       a margin (of zeros, in scaled pixels) around it, so the search windows of the section's boundary points are views
+       of the rendered section, and returns the RenderedRegion.
+       The section is rendered in strips into a (deleted) temporary file that is memory mapped, so it is never held in
+       memory as a whole, and processes that are forked after its rendering share it as is"""
+    start_point = (int(math.floor(bbox[0] * scaling - margin)), int(math.floor(bbox[2] * scaling - margin)))
+    end_point = (int(math.floor(bbox[1] * scaling + margin)), int(math.floor(bbox[3] * scaling + margin)))
+    with tempfile.TemporaryFile(prefix='rendered_section_') as image_file:
+        image = np.memmap(image_file, dtype=np.uint8, mode='w+', shape=(end_point[1] - start_point[1] + 1, end_point[0] - start_point[0] + 1))
+    render_strips(renderer, start_point, image, strip_height)
+    return RenderedRegion(image, start_point)
+
+
+def load_pyramid_sections(cache_dir, tiles_fnames, scalings):
+    """Returns the (memory mapped) RenderedRegion of each of the given sections at each of the given scalings (ordered by
+       the scalings, and then by the sections) from the sections pyramids in the cache directory, or None if one of the
+       sections was not rendered (at one of the scalings) to the cache directory"""
+    pyramids = [load_section_pyramid(cache_dir, tiles_fname) for tiles_fname in tiles_fnames]
+    sections = []
+    for scaling in scalings:
+        for tiles_fname, pyramid in zip(tiles_fnames, pyramids):
+            level_idx = None if pyramid is None else pyramid.level_index(scaling)
+            if level_idx is None:
+                logger.warn("Section {} was not rendered at scale {} to the pyramids directory {}, rendering the matched regions instead".format(tiles_fname, scaling, cache_dir))
+                return None
+            sections.append(RenderedRegion(pyramid.level(level_idx), pyramid.start_points[level_idx]))
+    return sections
+
+
+def render_matching_regions(img1_center_points, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer):
+    """Renders (once) the regions of both sections that all the templates (of img1) and search windows (of img2) around the
+       given img1 points are cut from. Returns the two RenderedRegion objects (or None, None if there are no points)"""
+    if len(img1_center_points) == 0:
+        return None, None
+    img1_center_points_on_img2 = (np.dot(img1_center_points, img1_to_img2_transform[:2, :2].T) + img1_to_img2_transform[:2, 2]) * scaling
+    min_xy = np.min(img1_center_points_on_img2, axis=0)
+    max_xy = np.max(img1_center_points_on_img2, axis=0)
+    # Add a pixel to the margins, so the rounding of the crops stays inside the regions
+    template_margin = template_size * scaling / 2 + 1
+    search_window_margin = search_window_size * scaling / 2 + 1
+    img1_region = RenderedRegion.render(img1_scaled_renderer, min_xy[0] - template_margin, min_xy[1] - template_margin,
+                                        max_xy[0] + template_margin, max_xy[1] + template_margin)
+    img2_region = RenderedRegion.render(img2_scaled_renderer, min_xy[0] - search_window_margin, min_xy[1] - search_window_margin,
+                                        max_xy[0] + search_window_margin, max_xy[1] + search_window_margin)
+    return img1_region, img2_region
+
+
+def _pmcc_matching_crops(img1_center_point, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer, search_offset=None):
+    """Returns the estimated (scaled) location of the given img1 point on img2, the template around it (of img1, after the
+       transformation to img2), the search window around it (of img2, moved by the search offset, in non-scaled
+       coordinates, if given), and the search window's start point"""
     # Compute the estimated point on img2 with scaling
     img1_center_point_on_img2 = (np.dot(img1_to_img2_transform[:2,:2], img1_center_point) + img1_to_img2_transform[:2,2]) * scaling
+    search_center_point = img1_center_point_on_img2
+    if search_offset is not None:
+        search_center_point = img1_center_point_on_img2 + np.asarray(search_offset) * scaling
 
     # Fetch the template around img1_point (after transformation)
     template_scaled_side = template_size * scaling / 2
@@ -165,28 +302,45 @@ def execute_pmcc_matching(img1_center_point, img1_to_img2_transform, scaling, te
     
     # Fetch a large sub-image around img2_point (using search_window_scaled_size)
     search_window_scaled_side = search_window_size * scaling / 2
-    from_x2, from_y2 = img1_center_point_on_img2 - search_window_scaled_side
-    to_x2, to_y2 = img1_center_point_on_img2 + search_window_scaled_side
+    from_x2, from_y2 = search_center_point - search_window_scaled_side
+    to_x2, to_y2 = search_center_point + search_window_scaled_side
     img2_search_window, img2_search_window_start_point = img2_scaled_renderer.crop(from_x2, from_y2, to_x2, to_y2)
+    return img1_center_point_on_img2, img1_template, img2_search_window, np.array([from_x2, from_y2])
+
+
+def _pmcc_matched_point(img1_center_point, img1_center_point_on_img2, reason, search_window_from, template_size, scaling, match_val, img1_template, img2_search_window, debug_save_matches, debug_dir):
+    """Returns the matched point on img2 (in non-scaled coordinates) of a successful PMCC match"""
+    template_scaled_side = template_size * scaling / 2
+    # Compute the location of the matched point on img2 in non-scaled coordinates
+    #matched_location_scaled = np.array([reason[1], reason[0]]) + template_scaled_side
+    #img2_center_point = (matched_location_scaled + img1_center_point_on_img2) / scaling 
+    matched_location_scaled = np.array([reason[1], reason[0]]) + search_window_from + template_scaled_side
+    img2_center_point = matched_location_scaled / scaling 
+    logger.debug("{}: match found: {} and {} (orig assumption: {})".format(os.getpid(), img1_center_point, img2_center_point, img1_center_point_on_img2 / scaling))
+    if debug_save_matches:
+        #debug_out_fname1 = os.path.join(debug_dir, "debug_match_sec1{}-{}_sec2{}-{}_image1.png".format(hexgr_point[0], hexgr_point[1], reasonx, reasony))
+        #debug_out_fname2 = os.path.join(debug_dir, "debug_match_sec1{}-{}_sec2{}-{}_image2.png".format(hexgr_point[0], hexgr_point[1], reasonx, reasony))
+        debug_out_fname1 = os.path.join(debug_dir, "debug_match_sec1{}-{}_sec2{}-{}_image1.png".format(int(img1_center_point[0]), int(img1_center_point[1]), int(img2_center_point[0]), int(img2_center_point[1])))
+        debug_out_fname2 = os.path.join(debug_dir, "debug_match_sec1{}-{}_sec2{}-{}_image2.png".format(int(img1_center_point[0]), int(img1_center_point[1]), int(img2_center_point[0]), int(img2_center_point[1])))
+        cv2.imwrite(debug_out_fname1, img1_template)
+        img2_cut_out = img2_search_window[int(reason[0]):int(reason[0] + 2 * template_scaled_side), int(reason[1]):int(reason[1] + 2 * template_scaled_side)]
+        cv2.imwrite(debug_out_fname2, img2_cut_out)
+    return img2_center_point
+
+
+def execute_pmcc_matching(img1_center_point, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer, min_corr, max_curvature, max_rod, debug_save_matches=False, debug_dir=None):
+    # Assumes that img1_renderer already has the transformation to img2 applied, and is scaled down,
+    # and that img2_renderer is already scaled down,
+    # and img1_center_point is w/o the transformation to img2 and w/o the scaling
+    # (the "renderers" can also be RenderedRegion objects that contain all the needed pixels)
+    img1_center_point_on_img2, img1_template, img2_search_window, search_window_from = _pmcc_matching_crops(
+        img1_center_point, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer)
 
     # execute the PMCC match
     # Do template matching
     result, reason, match_val = PMCC_filter.PMCC_match(img2_search_window, img1_template, min_correlation=min_corr, maximal_curvature_ratio=max_curvature, maximal_ROD=max_rod)
     if result is not None:
-        # Compute the location of the matched point on img2 in non-scaled coordinates
-        #matched_location_scaled = np.array([reason[1], reason[0]]) + template_scaled_side
-        #img2_center_point = (matched_location_scaled + img1_center_point_on_img2) / scaling 
-        matched_location_scaled = np.array([reason[1], reason[0]]) + np.array([from_x2, from_y2]) + template_scaled_side
-        img2_center_point = matched_location_scaled / scaling 
-        logger.debug("{}: match found: {} and {} (orig assumption: {})".format(os.getpid(), img1_center_point, img2_center_point, img1_center_point_on_img2 / scaling))
-        if debug_save_matches:
-            #debug_out_fname1 = os.path.join(debug_dir, "debug_match_sec1{}-{}_sec2{}-{}_image1.png".format(hexgr_point[0], hexgr_point[1], reasonx, reasony))
-            #debug_out_fname2 = os.path.join(debug_dir, "debug_match_sec1{}-{}_sec2{}-{}_image2.png".format(hexgr_point[0], hexgr_point[1], reasonx, reasony))
-            debug_out_fname1 = os.path.join(debug_dir, "debug_match_sec1{}-{}_sec2{}-{}_image1.png".format(int(img1_center_point[0]), int(img1_center_point[1]), int(img2_center_point[0]), int(img2_center_point[1])))
-            debug_out_fname2 = os.path.join(debug_dir, "debug_match_sec1{}-{}_sec2{}-{}_image2.png".format(int(img1_center_point[0]), int(img1_center_point[1]), int(img2_center_point[0]), int(img2_center_point[1])))
-            cv2.imwrite(debug_out_fname1, img1_template)
-            img2_cut_out = img2_search_window[reason[0]:reason[0] + 2 * template_scaled_side, reason[1]:reason[1] + 2 * template_scaled_side]
-            cv2.imwrite(debug_out_fname2, img2_cut_out)
+        img2_center_point = _pmcc_matched_point(img1_center_point, img1_center_point_on_img2, reason, search_window_from, template_size, scaling, match_val, img1_template, img2_search_window, debug_save_matches, debug_dir)
         return img1_center_point, img2_center_point, match_val
 
     # When there are no matches save template and search window
@@ -200,97 +354,313 @@ def execute_pmcc_matching(img1_center_point, img1_to_img2_transform, scaling, te
     return None
 
 
-def fetch_and_run(q_jobs, add_result_func, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer, min_corr, max_curvature, max_rod, debug_save_matches=False, deubg_dir=None):
-    while True:
-        job = q_jobs.get(block=True)
-        if job is None:
-            break
-        #logger.debug("Working on point: {}".format(job))
-        r = execute_pmcc_matching(job, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer, min_corr, max_curvature, max_rod, debug_save_matches, deubg_dir)
-        if r is not None:
-            add_result_func(r)
-    logger.info("Process {} is finished".format(os.getpid()))
+def coarse_search_offsets(img1_center_points, img1_to_img2_transform, coarse_scaling, template_size, search_window_size, img1_coarse_renderer, img2_coarse_renderer):
+    """Matches the template of each of the given img1 points over its (full) search window at a coarse scale (without the
+       PMCC tests), and returns an Nx2 array of the offsets (in non-scaled coordinates) of the best matches from the
+       estimated locations of the points on img2"""
+    offsets = np.zeros((len(img1_center_points), 2), dtype=np.float64)
+    template_scaled_side = template_size * coarse_scaling / 2
+    for i, img1_center_point in enumerate(img1_center_points):
+        img1_center_point_on_img2, img1_template, img2_search_window, search_window_from = _pmcc_matching_crops(
+            img1_center_point, img1_to_img2_transform, coarse_scaling, template_size, search_window_size, img1_coarse_renderer, img2_coarse_renderer)
+        correlation_image = cv2.matchTemplate(img2_search_window, img1_template, cv2.TM_CCOEFF_NORMED)
+        mi, mj = np.unravel_index(np.argmax(correlation_image), correlation_image.shape)
+        offsets[i] = (search_window_from + np.array([mj, mi]) + template_scaled_side - img1_center_point_on_img2) / coarse_scaling
+    return offsets
+
+
+def execute_pmcc_matching_batch(img1_center_points, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer, min_corr, max_curvature, max_rod, debug_save_matches=False, debug_dir=None, search_offsets=None):
+    """Executes the PMCC matching of each of the given img1 points (see execute_pmcc_matching), and returns the matches
+       as an Nx5 array, where each row is (img1 x, img1 y, img2 x, img2 y, match value), and the number of failed points
+       per failure reason (an array indexed by the PMCC_filter.FAIL_PMCC_* reasons).
+       If search_offsets is given, each point's search window is moved by its offset (in non-scaled coordinates)"""
+    matches = np.empty((len(img1_center_points), 5), dtype=np.float64)
+    matches_num = 0
+    failures_counts = np.zeros((len(PMCC_filter.FAIL_PMCC_REASONS), ), dtype=np.int64)
+    for i, img1_center_point in enumerate(img1_center_points):
+        img1_center_point_on_img2, img1_template, img2_search_window, search_window_from = _pmcc_matching_crops(
+            img1_center_point, img1_to_img2_transform, scaling, template_size, search_window_size, img1_scaled_renderer, img2_scaled_renderer,
+            None if search_offsets is None else search_offsets[i])
+        result, reason, match_val = PMCC_filter.PMCC_match(img2_search_window, img1_template, min_correlation=min_corr, maximal_curvature_ratio=max_curvature, maximal_ROD=max_rod)
+        if result is None:
+            failures_counts[reason] += 1
+            continue
+        img2_center_point = _pmcc_matched_point(img1_center_point, img1_center_point_on_img2, reason, search_window_from, template_size, scaling, match_val, img1_template, img2_search_window, debug_save_matches, debug_dir)
+        matches[matches_num, :2] = img1_center_point
+        matches[matches_num, 2:4] = img2_center_point
+        matches[matches_num, 4] = match_val
+        matches_num += 1
+    return matches[:matches_num], failures_counts
 
-def match_layers_pmcc_matching(tiles_fname1, tiles_fname2, pre_matches_fname, out_fname, targeted_mfov, conf_fname=None, processes_num=1):
-    starttime = time.time()
-    logger.info("Block-Matching+PMCC layers: {} with {} targeted mfov: {}".format(tiles_fname1, tiles_fname2, targeted_mfov))
 
-    # Load parameters file
+def empty_templates_mask(img1_center_points, img1_to_img2_transform, scaling, template_size, img1_scaled_renderer, min_std, min_gradient_energy):
+    """Returns a mask of the given img1 points whose (scaled) templates are empty (see PMCC_filter.is_empty_template)"""
+    template_scaled_side = template_size * scaling / 2
+    img1_center_points_on_img2 = (np.dot(np.asarray(img1_center_points).reshape((-1, 2)), img1_to_img2_transform[:2, :2].T) + img1_to_img2_transform[:2, 2]) * scaling
+    empty_mask = np.zeros((len(img1_center_points_on_img2), ), dtype=np.bool_)
+    for i, (center_x, center_y) in enumerate(img1_center_points_on_img2):
+        img1_template, _ = img1_scaled_renderer.crop(center_x - template_scaled_side, center_y - template_scaled_side,
+                                                     center_x + template_scaled_side, center_y + template_scaled_side)
+        empty_mask[i] = PMCC_filter.is_empty_template(img1_template, min_std, min_gradient_energy)
+    return empty_mask
+
+
+def match_points(img1_center_points, img1_region, img2_region, matching_args, pyramid_args=None, pyramid_regions=None):
+    """Executes the PMCC matching of the given img1 points (see execute_pmcc_matching_batch). If pyramid_args (the coarse
+       scaling, the coarse template size, and the refinement search window size) are given, the points are first matched
+       over their search windows in the given coarse rendered regions, and then the PMCC matching is executed only in
+       (smaller) refinement search windows around the coarse matches.
+       Points whose templates are empty fail (with PMCC_filter.FAIL_PMCC_EMPTY_TEMPLATE) before any correlation.
+       Returns the matches, the failures counts, and a mask of the given points whose templates are empty"""
+    img1_to_img2_transform, scaling, template_size, search_window_size, min_corr, max_curvature, max_rod, debug_save_matches, debug_dir, template_thresholds = matching_args
+    empty_mask = np.zeros((len(img1_center_points), ), dtype=np.bool_)
+    if template_thresholds is not None and len(img1_center_points) > 0:
+        empty_mask = empty_templates_mask(img1_center_points, img1_to_img2_transform, scaling, template_size, img1_region, *template_thresholds)
+        img1_center_points = np.asarray(img1_center_points)[~empty_mask]
+    search_offsets = None
+    if pyramid_args is not None:
+        coarse_scaling, coarse_template_size, search_window_size = pyramid_args
+        search_offsets = coarse_search_offsets(img1_center_points, img1_to_img2_transform, coarse_scaling, coarse_template_size, matching_args[3],
+                                               pyramid_regions[0], pyramid_regions[1])
+    matches, failures_counts = execute_pmcc_matching_batch(img1_center_points, img1_to_img2_transform, scaling, template_size, search_window_size,
+                                                           img1_region, img2_region, min_corr, max_curvature, max_rod, debug_save_matches, debug_dir,
+                                                           search_offsets=search_offsets)
+    failures_counts[PMCC_filter.FAIL_PMCC_EMPTY_TEMPLATE] += np.sum(empty_mask)
+    return matches, failures_counts, empty_mask
+
+
+_pmcc_worker_state = {}
+
+def _init_pmcc_worker(shared_regions, matching_args, pyramid_args):
+    cv_wrap_module.setNumThreads(1)
+    regions = [unshare_region(shared_region) for shared_region in shared_regions]
+    _pmcc_worker_state['regions'] = regions[:2]
+    _pmcc_worker_state['pyramid_regions'] = regions[2:] if pyramid_args is not None else None
+    _pmcc_worker_state['matching_args'] = matching_args
+    _pmcc_worker_state['pyramid_args'] = pyramid_args
+
+def _pmcc_worker(img1_center_points):
+    return match_points(img1_center_points, _pmcc_worker_state['regions'][0], _pmcc_worker_state['regions'][1], _pmcc_worker_state['matching_args'],
+                        _pmcc_worker_state['pyramid_args'], _pmcc_worker_state['pyramid_regions'])
+
+
+def create_pmcc_pool(img1_region, img2_region, matching_args, processes_num, pyramid_args=None, pyramid_regions=None):
+    """Returns a pool of processes for matching points with the given rendered regions (see run_pmcc_matching). The regions'
+       images are shared once with the processes (see share_region), so the pool can be used for several sets of points"""
+    regions = [img1_region, img2_region] + (list(pyramid_regions) if pyramid_args is not None else [])
+    return mp.Pool(processes=processes_num, initializer=_init_pmcc_worker,
+                   initargs=([share_region(region) for region in regions], matching_args, pyramid_args))
+
+
+def run_pmcc_matching(img1_center_points, img1_region, img2_region, matching_args, processes_num=1, batches_per_process=4, pyramid_args=None, pyramid_regions=None, pool=None):
+    """Executes the PMCC matching of the given img1 points (using the given rendered regions), and returns the matches,
+       the failures counts and the empty templates mask (see match_points). If processes_num > 1, the points are matched in batches by a pool of processes that share the
+       rendered regions' images (the memory mapped and the transformed regions are inherited by the processes, see share_region).
+       If a pool is given (see create_pmcc_pool), it is used instead of creating a new one"""
+    if processes_num <= 1 or len(img1_center_points) == 0:
+        return match_points(img1_center_points, img1_region, img2_region, matching_args, pyramid_args, pyramid_regions)
+    # Use a few batches per process, so processes that get points that fail quickly don't wait for the others
+    batches = np.array_split(np.asarray(img1_center_points), min(len(img1_center_points), processes_num * batches_per_process))
+    if pool is not None:
+        batches_results = pool.map(_pmcc_worker, batches, chunksize=1)
+    else:
+        pool = create_pmcc_pool(img1_region, img2_region, matching_args, processes_num, pyramid_args, pyramid_regions)
+        try:
+            batches_results = pool.map(_pmcc_worker, batches, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return np.vstack([r[0] for r in batches_results]), np.sum([r[1] for r in batches_results], axis=0), np.concatenate([r[2] for r in batches_results])
+
+
+def adaptive_points_subset(points, spacing):
+    """Returns the (sorted) indices of a subset of the given points, with a single point in each spacing x spacing cell"""
+    cells_points = {}
+    for i, cell in enumerate(np.floor(np.asarray(points, dtype=np.float64) / spacing).astype(np.int64)):
+        cells_points.setdefault(tuple(cell), i)
+    return np.array(sorted(cells_points.values()), dtype=np.int64)
+
+
+def local_models(matches, neighbors_num):
+    """Fits an affine model to the nearest neighboring matches of each match (a row of an Nx5 matches array), and returns
+       the distance of each match from its model, the linear (2x2) part of each model, and the indices of (and distances to)
+       the neighbors of each match (the residuals and the linear parts are nan if there are too few matches for fitting)"""
+    residuals = np.full((len(matches), ), np.nan)
+    linear_parts = np.full((len(matches), 2, 2), np.nan)
+    if len(matches) < 4:
+        return residuals, linear_parts, None, None
+    pts1 = matches[:, :2]
+    pts2 = matches[:, 2:4]
+    neighbors_num = min(neighbors_num, len(matches) - 1)
+    neighbors_dists, neighbors_idxs = spatial.cKDTree(pts1).query(pts1, k=neighbors_num + 1)
+    # The first neighbor is the match itself
+    neighbors_dists = neighbors_dists[:, 1:]
+    neighbors_idxs = neighbors_idxs[:, 1:]
+    for i, idxs in enumerate(neighbors_idxs):
+        # Fit the model relative to the match's location (for better conditioning)
+        src = np.column_stack((pts1[idxs] - pts1[i], np.ones((len(idxs), ))))
+        model, _, rank, _ = np.linalg.lstsq(src, pts2[idxs], rcond=-1)
+        if rank == 3:
+            residuals[i] = np.linalg.norm(model[2] - pts2[i])
+            linear_parts[i] = model[:2]
+    return residuals, linear_parts, neighbors_idxs, neighbors_dists
+
+
+def local_model_residuals(matches, neighbors_num):
+    """Returns the distance of each match (a row of an Nx5 matches array) from the affine model that is fitted to its
+       nearest neighboring matches (or nan if there are too few matches for fitting)"""
+    return local_models(matches, neighbors_num)[0]
+
+
+def local_model_curvatures(matches, neighbors_num, fitted_models=None):
+    """Returns the local curvature of the deformation at each match (a row of an Nx5 matches array): the maximal change
+       (per pixel) between the linear part of the affine model around the match and the models around its nearest
+       neighboring matches, or nan if there are too few matches for fitting (fitted_models is the output of local_models,
+       if it was already computed)"""
+    if fitted_models is None:
+        fitted_models = local_models(matches, neighbors_num)
+    _, linear_parts, neighbors_idxs, neighbors_dists = fitted_models
+    curvatures = np.full((len(matches), ), np.nan)
+    if neighbors_idxs is None:
+        return curvatures
+    changes = np.sqrt(np.sum((linear_parts[neighbors_idxs] - linear_parts[:, np.newaxis]) ** 2, axis=(2, 3))) / np.maximum(neighbors_dists, 1e-9)
+    changes[np.isnan(changes)] = -np.inf
+    curvatures = np.max(changes, axis=1)
+    curvatures[np.isinf(curvatures)] = np.nan
+    return curvatures
+
+
+def run_adaptive_pmcc_matching(img1_center_points, img1_region, img2_region, matching_args, adaptive_args, processes_num=1, pyramid_args=None, pyramid_regions=None):
+    """Executes the PMCC matching (see run_pmcc_matching) of a coarse subset of the given img1 points (adaptive_args are
+       the coarse spacing, the maximal residual, the number of neighbors of the local models, and optionally the maximal
+       local curvature), and then of the rest of the points that are within the coarse spacing of failed matches, of
+       matches whose residual from a local affine model (fitted to their neighboring matches) is too high, or of matches
+       where the local affine models change too fast (see local_model_curvatures), until there are no such (new) points
+       (points that failed because their templates are empty are not matched, so there is nothing to densify around them).
+       The rendered regions are shared once with a single pool of processes that is used for all the rounds.
+       Returns the matches and the failures counts of all the evaluated points, and the mask of the evaluated points
+       whose templates are empty"""
+    coarse_spacing, max_residual, neighbors_num = adaptive_args[:3]
+    max_local_curvature = adaptive_args[3] if len(adaptive_args) > 3 else None
+    points = np.asarray(img1_center_points)
+    if len(points) == 0:
+        return run_pmcc_matching(points, img1_region, img2_region, matching_args, processes_num, pyramid_args=pyramid_args, pyramid_regions=pyramid_regions)
+    points_kdtree = spatial.cKDTree(points)
+    evaluated = np.zeros((len(points), ), dtype=np.bool_)
+    empty_mask = np.zeros((len(points), ), dtype=np.bool_)
+    new_idxs = adaptive_points_subset(points, coarse_spacing)
+    all_matches = []
+    failures_counts = np.zeros((len(PMCC_filter.FAIL_PMCC_REASONS), ), dtype=np.int64)
+    pool = None
+    if processes_num > 1:
+        pool = create_pmcc_pool(img1_region, img2_region, matching_args, processes_num, pyramid_args, pyramid_regions)
+    try:
+        while len(new_idxs) > 0:
+            evaluated[new_idxs] = True
+            new_matches, new_failures_counts, empty_mask[new_idxs] = run_pmcc_matching(points[new_idxs], img1_region, img2_region, matching_args, processes_num,
+                                                                                       pyramid_args=pyramid_args, pyramid_regions=pyramid_regions, pool=pool)
+            all_matches.append(new_matches)
+            failures_counts += new_failures_counts
+            matches = np.vstack(all_matches)
+
+            # Find the failed points, and the matches that don't agree with their neighbors (or where the deformation bends)
+            matched_points = set(map(tuple, matches[:, :2].tolist()))
+            failed_points = [p for p in points[evaluated & ~empty_mask].tolist() if tuple(float(v) for v in p) not in matched_points]
+            fitted_models = local_models(matches, neighbors_num)
+            flagged_mask = fitted_models[0] > max_residual
+            if max_local_curvature is not None:
+                flagged_mask |= local_model_curvatures(matches, neighbors_num, fitted_models) > max_local_curvature
+            flagged_points = failed_points + matches[flagged_mask, :2].tolist()
+
+            # Add the (not yet evaluated) points around the flagged points
+            new_idxs = set()
+            if len(flagged_points) > 0:
+                for idxs in points_kdtree.query_ball_point(flagged_points, coarse_spacing):
+                    new_idxs.update(idxs)
+            new_idxs = np.array(sorted(i for i in new_idxs if not evaluated[i]), dtype=np.int64)
+            logger.info("Adaptive matching - evaluated {} points out of {}, adding {} points".format(np.sum(evaluated), len(points), len(new_idxs)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return np.vstack(all_matches), failures_counts, empty_mask
+
+
+def _read_matching_params(conf_fname):
+    """Reads the block matching parameters (with their defaults) from the configuration file"""
     params = utils.conf_from_file(conf_fname, 'MatchLayersBlockMatching')
     if params is None:
         params = {}
-    cv_wrap_module.setNumThreads(1)
 
     # Parameters for the matching
-    hex_spacing = params.get("hex_spacing", 1500)
-    scaling = params.get("scaling", 0.2)
-    template_size = params.get("template_size", 200)
-    search_window_size = params.get("search_window_size", 8 * template_size)
+    matching_params = {}
+    matching_params['hex_spacing'] = params.get("hex_spacing", 1500)
+    matching_params['scaling'] = scaling = params.get("scaling", 0.2)
+    matching_params['template_size'] = template_size = params.get("template_size", 200)
+    matching_params['search_window_size'] = search_window_size = params.get("search_window_size", 8 * template_size)
     logger.info("Actual template size: {} and window search size: {} (after scaling)".format(template_size * scaling, search_window_size * scaling))
 
-    # Parameters for PMCC filtering
-    min_corr = params.get("min_correlation", 0.2)
-    max_curvature = params.get("maximal_curvature_ratio", 10)
-    max_rod = params.get("maximal_ROD", 0.9)
+    # Parameters for the coarse-to-fine (pyramid) matching, where the templates are first matched over the search windows
+    # at pyramid_scaling, and then the PMCC matching is done in a pyramid_refine_window_size window around each coarse match
+    pyramid_scaling = params.get("pyramid_scaling", None)
+    matching_params['pyramid_args'] = None
+    if pyramid_scaling is not None:
+        pyramid_template_size = params.get("pyramid_template_size", 2 * template_size)
+        pyramid_refine_window_size = params.get("pyramid_refine_window_size", 2 * template_size)
+        matching_params['pyramid_args'] = (pyramid_scaling, pyramid_template_size, pyramid_refine_window_size)
+        logger.info("Pyramid mode - coarse template size: {} and window search size: {} (after scaling), refinement window search size: {} (after scaling)".format(
+            pyramid_template_size * pyramid_scaling, search_window_size * pyramid_scaling, pyramid_refine_window_size * scaling))
+
+    # Parameters for the adaptive matching, where only a subset of the hexagonal grid points (a point per
+    # adaptive_coarse_spacing) is matched, and then the points around failed matches or matches that deviate (by more than
+    # adaptive_max_residual) from an affine model of their neighboring matches, or where the affine models of neighboring
+    # matches change by more than adaptive_max_local_curvature per pixel (if set), are matched as well
+    adaptive_coarse_spacing = params.get("adaptive_coarse_spacing", None)
+    matching_params['adaptive_args'] = None
+    if adaptive_coarse_spacing is not None:
+        matching_params['adaptive_args'] = (adaptive_coarse_spacing, params.get("adaptive_max_residual", 5.0), params.get("adaptive_neighbors_num", 6),
+                                            params.get("adaptive_max_local_curvature", None))
+
+    # The directory of the rendered sections pyramids (see section_pyramid), where the templates and search windows are
+    # cut from (instead of rendering them from the tiles), if the sections were rendered at the matching scales
+    matching_params['pyramid_cache_dir'] = params.get("pyramid_cache_dir", None)
+
+    # Parameters for skipping the points whose templates are (almost) empty, before matching them (off by default)
+    template_min_std = params.get("template_min_std", 0.0)
+    template_min_gradient_energy = params.get("template_min_gradient_energy", 0.0)
+    matching_params['template_thresholds'] = None
+    if template_min_std > 0 or template_min_gradient_energy > 0:
+        matching_params['template_thresholds'] = (template_min_std, template_min_gradient_energy)
 
-    debug_save_matches = False
-    debug_dir = None
-    if "debug_save_matches" in params.keys():
-        logger.info("Debug mode - on")
-        debug_save_matches = True
-        if debug_save_matches:
-            # Create a debug directory
-            import datetime
-            debug_dir = os.path.join(os.path.dirname(out_fname), 'debug_matches_{}'.format(datetime.datetime.now().isoformat()))
-            os.mkdir(debug_dir)
-
-    # Read the tilespecs
-    tiles_fname1 = os.path.abspath(tiles_fname1)
-    tiles_fname2 = os.path.abspath(tiles_fname2)
-    ts1 = utils.load_tilespecs(tiles_fname1)
-    ts2 = utils.load_tilespecs(tiles_fname2)
-    indexed_ts1 = utils.index_tilespec(ts1)
-    indexed_ts2 = utils.index_tilespec(ts2)
-
-    sorted_mfovs1 = sorted(indexed_ts1.keys())
-    sorted_mfovs2 = sorted(indexed_ts2.keys())
-
-    # Get the tiles centers for each section
-    tile_centers1 = get_tile_centers_from_json(ts1)
-    tile_centers1tree = spatial.KDTree(tile_centers1)
-    tile_centers2 = get_tile_centers_from_json(ts2)
-    tile_centers2tree = spatial.KDTree(tile_centers2)
-    mfov_centers1 = get_mfov_centers_from_json(indexed_ts1)
-    mfov_centers2 = get_mfov_centers_from_json(indexed_ts2)
-
-    # Load the preliminary matches
-    with open(pre_matches_fname, 'r') as data_matches:
-        mfov_pre_matches = json.load(data_matches)
-    if len(mfov_pre_matches["matches"]) == 0:
-        logger.warn("No matches were found in pre-matching, aborting Block-Matching proces between layers: {} and {}".format(tiles_fname1, tiles_fname2))
-        return
-    best_transformations = get_best_transformations(mfov_pre_matches, tiles_fname1, tiles_fname2, mfov_centers1, mfov_centers2, sorted_mfovs1, sorted_mfovs2)
-
-    # Create output dictionary
-    out_jsonfile = {}
-    out_jsonfile['tilespec1'] = tiles_fname1
-    out_jsonfile['tilespec2'] = tiles_fname2
+    # Parameters for PMCC filtering
+    matching_params['min_corr'] = params.get("min_correlation", 0.2)
+    matching_params['max_curvature'] = params.get("maximal_curvature_ratio", 10)
+    matching_params['max_rod'] = params.get("maximal_ROD", 0.9)
+
+    matching_params['debug_save_matches'] = "debug_save_matches" in params.keys()
+    return matching_params
+
+
+def match_mfov_pmcc_matching(targeted_mfov, sections_data, matching_params, processes_num=1, debug_dir=None, section_regions=None):
+    """Executes the block matching of the hexagonal grid points of the given mfov (of section 1) on section 2.
+       If section_regions (the rendered sections 1 and 2 at the scaling, and at the pyramid scaling) are given, the
+       templates and search windows are cut from them (and the mfov's regions are not rendered).
+       Returns the hexagonal grid points in the mfov's bounding box, the matches and the failures counts (see match_points),
+       and the number of grid points that are inside the mfov's tiles"""
+    ts1, ts2, tiles1, grid_index1, best_transformations, mfov_centers1 = sections_data
+    scaling = matching_params['scaling']
+    template_size = matching_params['template_size']
+    search_window_size = matching_params['search_window_size']
+    pyramid_args = matching_params['pyramid_args']
 
     # Create the (lazy) renderers for the two sections
     img1_renderer = TilespecAffineRenderer(ts1)
     img2_renderer = TilespecAffineRenderer(ts2)
 
-    # Generate an hexagonal grid according to the first section's bounding box
-    logger.info("Generating Hexagonal Grid")
-    bb = BoundingBox.read_bbox(tiles_fname1)
-    logger.info("bounding_box: {}".format(bb))
-    hexgr = utils.generate_hexagonal_grid(bb, hex_spacing)
-    #print(hexgr)
     # a single mfov is targeted, so restrict the hexagonal grid to that mfov locations
-    mfov_tiles = indexed_ts1[targeted_mfov]
-    bb_mfov = BoundingBox.read_bbox_from_ts(mfov_tiles.values())
-    logger.info("Trimming bounding box grid points to {} (mfov {})".format(bb_mfov.toArray(), targeted_mfov))
-    hexgr = [p for p in hexgr if bb_mfov.contains(np.array([p]))]
+    bb_mfov = tiles1.bbox(tiles1.mfov_indices(targeted_mfov))
+    logger.info("Trimming bounding box grid points to {} (mfov {})".format(bb_mfov, targeted_mfov))
+    hexgr = grid_index1.points_in_bbox(bb_mfov)
     logger.info("Found {} possible points in bbox".format(len(hexgr)))
 
     # Use the mfov exepected transform (from section 1 to section 2) to transform img1
@@ -305,81 +675,261 @@ def match_layers_pmcc_matching(tiles_fname1, tiles_fname2, pre_matches_fname, ou
     img1_renderer.add_transformation(scale_transformation)
     img2_renderer.add_transformation(scale_transformation)
 
+    # Only check the hexagonal grid points that are part of the targeted mfov (inside one of its tiles)
+    mfov_points = grid_index1.mfov_points(targeted_mfov)
+    on_section_points_num = len(mfov_points)
+
+    # Render the regions of both sections that the templates and search windows are cut from once, instead of
+    # rendering each template and search window separately
+    pyramid_regions = None
+    if section_regions is not None:
+        # The section 1 templates are warped to section 2 from the rendered section 1
+        img1_region = TransformedRegion(section_regions[0], img1_to_img2_transform, scaling)
+        img2_region = section_regions[1]
+        if pyramid_args is not None:
+            pyramid_regions = (TransformedRegion(section_regions[2], img1_to_img2_transform, pyramid_args[0]), section_regions[3])
+    elif pyramid_args is None:
+        logger.info("Rendering the matched regions")
+        img1_region, img2_region = render_matching_regions(mfov_points, img1_to_img2_transform, scaling, template_size, search_window_size, img1_renderer, img2_renderer)
+    else:
+        logger.info("Rendering the matched regions")
+        # The coarse regions are rendered by (separate) renderers at the coarse scale
+        pyramid_scaling = pyramid_args[0]
+        pyramid_scale_transformation = np.array([
+                                    [ pyramid_scaling, 0., 0. ],
+                                    [ 0., pyramid_scaling, 0. ]
+                                ])
+        img1_coarse_renderer = TilespecAffineRenderer(ts1)
+        img1_coarse_renderer.add_transformation(img1_to_img2_transform)
+        img1_coarse_renderer.add_transformation(pyramid_scale_transformation)
+        img2_coarse_renderer = TilespecAffineRenderer(ts2)
+        img2_coarse_renderer.add_transformation(pyramid_scale_transformation)
+        pyramid_regions = render_matching_regions(mfov_points, img1_to_img2_transform, pyramid_scaling, pyramid_args[1], search_window_size, img1_coarse_renderer, img2_coarse_renderer)
+        # The refinement search windows are around the coarse matches (inside the full search windows)
+        img1_region, img2_region = render_matching_regions(mfov_points, img1_to_img2_transform, scaling, template_size, search_window_size + pyramid_args[2], img1_renderer, img2_renderer)
+
     # Execute PMCC Matching
     logger.info("Performing PMCC Matching with {} processes".format(processes_num))
-    # Allocate processes_num-1 other processes and initialize with the "static" data, and a queue for jobs and a queue for results
-    q_jobs = mp.Queue(maxsize=len(hexgr))
-    # Creating the results queue using a manager, or otherwise we enter a deadlock because buffers aren't flushed
-    mp_manager = mp.Manager()
-    q_res = mp_manager.Queue(maxsize=len(hexgr))
-
-    all_processes = [mp.Process(target=fetch_and_run, args=(q_jobs, lambda x: q_res.put(x), img1_to_img2_transform, scaling, template_size, search_window_size, img1_renderer, img2_renderer, min_corr, max_curvature, max_rod, debug_save_matches, debug_dir)) for i in range(processes_num - 1)]
-    for p in all_processes:
-        p.start()
-
-    # Iterate over the hexagonal grid points, and only check those that are part of the targeted mfov
-    on_section_points_num = 0
-    for i in range(len(hexgr)):
-        # Find the tile image where the point from the hexagonal is in the first section
-        img1_ind = get_closest_index_to_point(hexgr[i], tile_centers1tree)
-        if img1_ind is None:
-            continue
-        if ts1[img1_ind]["mfov"] != targeted_mfov:
-            continue
-        if not is_point_in_img(ts1[img1_ind], hexgr[i]):
-            continue
-
-        img1_point = np.array(hexgr[i])
-        on_section_points_num += 1
-        
-        # Perform matching of that point
-        q_jobs.put(img1_point)
- 
-    # Add empty jobs to end the execution of each process
-    for i in range(processes_num):
-        q_jobs.put(None)
-
-    # Used to store the results of the main process (and then all the results)
-    point_matches = []
-
-    # Use the main process to run jobs like any other process
-    fetch_and_run(q_jobs, lambda x: point_matches.append(x), img1_to_img2_transform, scaling, template_size, search_window_size, img1_renderer, img2_renderer, min_corr, max_curvature, max_rod, debug_save_matches, debug_dir)
-
-    # Wait for the termination of all other processes
-    logger.info("Waiting for other processes to finish")
-    for p in all_processes:
-        p.join()
-
-    logger.info("Collecting results")
-    while not q_res.empty():
-        r = q_res.get(block=True)
-        point_matches.append(r)
+    matching_args = (img1_to_img2_transform, scaling, template_size, search_window_size, matching_params['min_corr'], matching_params['max_curvature'],
+                     matching_params['max_rod'], matching_params['debug_save_matches'], debug_dir, matching_params['template_thresholds'])
+    if matching_params['adaptive_args'] is None:
+        point_matches, failures_counts, _ = run_pmcc_matching(mfov_points, img1_region, img2_region, matching_args, processes_num, pyramid_args=pyramid_args, pyramid_regions=pyramid_regions)
+    else:
+        point_matches, failures_counts, _ = run_adaptive_pmcc_matching(mfov_points, img1_region, img2_region, matching_args, matching_params['adaptive_args'], processes_num,
+                                                                       pyramid_args=pyramid_args, pyramid_regions=pyramid_regions)
 
     logger.info("Found {} matches out of possible {} points (on section points: {})".format(len(point_matches), len(hexgr), on_section_points_num))
+    logger.info("Failures: {}".format(", ".join("{}: {}".format(name, count) for name, count in zip(PMCC_filter.FAIL_PMCC_REASONS, failures_counts))))
+    return hexgr, point_matches, failures_counts, on_section_points_num
 
 
-    # Save the output
+def save_pmcc_matches(out_fname, tiles_fname1, tiles_fname2, targeted_mfov, hexgr, point_matches, failures_counts, runtime):
+    """Saves the matches (and the failures counts) of an mfov (of section 1) to a json file"""
     logger.info("Saving output to: {}".format(out_fname))
-    out_jsonfile['runtime'] = time.time() - starttime
-    out_jsonfile['mesh'] = hexgr
-    if targeted_mfov != -1:
-        out_jsonfile['mfov1'] = targeted_mfov
+    out_jsonfile = {}
+    out_jsonfile['tilespec1'] = tiles_fname1
+    out_jsonfile['tilespec2'] = tiles_fname2
+    out_jsonfile['runtime'] = runtime
+    out_jsonfile['mesh'] = hexgr.tolist()
+    out_jsonfile['mfov1'] = targeted_mfov
+    out_jsonfile['failures'] = {name: int(count) for name, count in zip(PMCC_filter.FAIL_PMCC_REASONS, failures_counts)}
 
     final_point_matches = []
     for pm in point_matches:
-        p1, p2, match_val = pm
         record = {}
-        record['point1'] = p1.tolist()
-        record['point2'] = p2.tolist()
+        record['point1'] = pm[:2].tolist()
+        record['point2'] = pm[2:4].tolist()
         #record['isvirtualpoint'] = nmesh
-        record['match_val'] = float(match_val)
+        record['match_val'] = float(pm[4])
         final_point_matches.append(record)
 
     out_jsonfile['pointmatches'] = final_point_matches
-    with open(out_fname, 'w') as out:
-        json.dump(out_jsonfile, out, indent=4)
+    with utils.atomic_output_file(out_fname) as tmp_fname:
+        with open(tmp_fname, 'w') as out:
+            json.dump(out_jsonfile, out, indent=4)
+
+
+_mfov_worker_state = {}
+
+def _init_mfov_worker(directions, matching_params, debug_dir, shared_sections=None):
+    cv_wrap_module.setNumThreads(1)
+    # directions is a list of (sections_data, tiles file names, the sections order in shared_sections)
+    _mfov_worker_state['directions'] = directions
+    _mfov_worker_state['matching_params'] = matching_params
+    _mfov_worker_state['debug_dir'] = debug_dir
+    _mfov_worker_state['sections'] = None
+    if shared_sections is not None:
+        _mfov_worker_state['sections'] = [unshare_region(shared_section) for shared_section in shared_sections]
+
+def _mfov_worker(mfov_task):
+    direction_idx, targeted_mfov, out_fname = mfov_task
+    sections_data, tiles_fnames, sections_order = _mfov_worker_state['directions'][direction_idx]
+    section_regions = None
+    if _mfov_worker_state['sections'] is not None:
+        # The sections are ordered as (section 1, section 2, coarse section 1, coarse section 2) of the first direction
+        sections = _mfov_worker_state['sections']
+        section_regions = [sections[sections_order[0]], sections[sections_order[1]], sections[2 + sections_order[0]], sections[2 + sections_order[1]]]
+    starttime = time.time()
+    hexgr, point_matches, failures_counts, _ = match_mfov_pmcc_matching(targeted_mfov, sections_data, _mfov_worker_state['matching_params'],
+                                                                        debug_dir=_mfov_worker_state['debug_dir'], section_regions=section_regions)
+    runtime = time.time() - starttime
+    # The matches of an mfov without an output file are saved (with the rest of its direction's mfovs) to a match store
+    if out_fname is not None:
+        save_pmcc_matches(out_fname, tiles_fnames[0], tiles_fnames[1], targeted_mfov, hexgr, point_matches, failures_counts, runtime)
+    return direction_idx, targeted_mfov, point_matches, failures_counts, runtime
+
+
+def match_layers_pmcc_matching(tiles_fname1, tiles_fname2, pre_matches_fname, out_fname, targeted_mfov, conf_fname=None, processes_num=1, reverse_out_fname=None):
+    """Block-matches the hexagonal grid points of the given mfov of section 1 on section 2, and saves the matches to out_fname.
+       If targeted_mfov is -1, all the mfovs of section 1 are matched (the sections are only loaded once), each by a single
+       process of a pool (that takes the next mfov when it is done with an mfov), and the matches of each mfov are saved
+       to out_fname.format(mfov=<mfov>) (mfovs whose output file already exists are skipped).
+       If reverse_out_fname is also given (with targeted_mfov -1), the mfovs of section 2 are matched on section 1 as well,
+       and saved to reverse_out_fname.format(mfov=<mfov>). Each section is then rendered (whole) only once, and both
+       directions cut their templates and search windows from the rendered sections.
+       If the sections were rendered to the pyramids directory (pyramid_cache_dir), the templates and search windows are
+       cut from the sections pyramids (in all the modes).
+       If an output file name is of a match store (an npz file, see match_store), the matches of all the mfovs (of that
+       direction) are saved to that single file (when all the mfovs are done) instead of to a json file per mfov"""
+    starttime = time.time()
+    logger.info("Block-Matching+PMCC layers: {} with {} targeted mfov: {}".format(tiles_fname1, tiles_fname2, targeted_mfov))
+    for cur_out_fname in [out_fname, reverse_out_fname]:
+        if targeted_mfov == -1 and cur_out_fname is not None and not is_match_store_fname(cur_out_fname) and '{mfov}' not in cur_out_fname:
+            raise ValueError("The output file name of all the mfovs matching should include {{mfov}}: {}".format(cur_out_fname))
 
-    logger.info("Done")
+    # Load parameters file
+    matching_params = _read_matching_params(conf_fname)
+    cv_wrap_module.setNumThreads(1)
+
+    debug_dir = None
+    if matching_params['debug_save_matches']:
+        logger.info("Debug mode - on")
+        # Create a debug directory
+        import datetime
+        debug_dir = os.path.join(os.path.dirname(out_fname), 'debug_matches_{}'.format(datetime.datetime.now().isoformat()))
+        os.mkdir(debug_dir)
+
+    # Read the tilespecs
+    tiles_fname1 = os.path.abspath(tiles_fname1)
+    tiles_fname2 = os.path.abspath(tiles_fname2)
+    ts1 = utils.load_tilespecs(tiles_fname1)
+    ts2 = utils.load_tilespecs(tiles_fname2)
+    tiles1 = TileCollection(ts1)
+    tiles2 = TileCollection(ts2)
+
+    sorted_mfovs1 = tiles1.sorted_mfovs()
+    sorted_mfovs2 = tiles2.sorted_mfovs()
+
+    # Get the mfov centers for each section
+    mfov_centers1 = tiles1.mfov_centers()
+    mfov_centers2 = tiles2.mfov_centers()
+
+    # Load the preliminary matches
+    with open(pre_matches_fname, 'r') as data_matches:
+        mfov_pre_matches = json.load(data_matches)
+    if len(mfov_pre_matches["matches"]) == 0:
+        logger.warn("No matches were found in pre-matching, aborting Block-Matching proces between layers: {} and {}".format(tiles_fname1, tiles_fname2))
+        return
+    best_transformations = get_best_transformations(mfov_pre_matches, tiles_fname1, tiles_fname2, mfov_centers1, mfov_centers2, sorted_mfovs1, sorted_mfovs2)
+
+    # Load the hexagonal grid of the first section's bounding box (with the mapping of each grid point to its tile and mfov)
+    logger.info("Loading Hexagonal Grid index")
+    grid_index1 = load_section_grid_index(tiles_fname1, matching_params['hex_spacing'], tilespecs=ts1)
+    sections_data = (ts1, ts2, tiles1, grid_index1, best_transformations, mfov_centers1)
+
+    # The whole sections (section 1, section 2, coarse section 1, coarse section 2) that the templates and search windows
+    # are cut from, if both sections were rendered to the pyramids directory
+    sections_scalings = [matching_params['scaling']]
+    if matching_params['pyramid_args'] is not None:
+        sections_scalings.append(matching_params['pyramid_args'][0])
+    sections = None
+    if matching_params['pyramid_cache_dir'] is not None:
+        sections = load_pyramid_sections(matching_params['pyramid_cache_dir'], [tiles_fname1, tiles_fname2], sections_scalings)
+        if sections is not None and len(sections) == 2:
+            sections.extend([None, None])
+
+    if targeted_mfov != -1:
+        hexgr, point_matches, failures_counts, _ = match_mfov_pmcc_matching(targeted_mfov, sections_data, matching_params, processes_num, debug_dir, section_regions=sections)
+        if is_match_store_fname(out_fname):
+            save_match_store(out_fname, MatchStore.from_mfovs_matches(tiles_fname1, tiles_fname2, matching_params['hex_spacing'],
+                                                                      [(targeted_mfov, point_matches, failures_counts, time.time() - starttime)]))
+        else:
+            save_pmcc_matches(out_fname, tiles_fname1, tiles_fname2, targeted_mfov, hexgr, point_matches, failures_counts, time.time() - starttime)
+        logger.info("Done")
+        return
+
+    # Section-pair mode
+    directions = [(sections_data, (tiles_fname1, tiles_fname2), (0, 1))]
+    directions_out_fnames = [out_fname]
+    if reverse_out_fname is not None:
+        # Match section 2 to section 1 as well, using the same (once) rendered sections
+        reverse_best_transformations = get_best_transformations(mfov_pre_matches, tiles_fname2, tiles_fname1, mfov_centers2, mfov_centers1, sorted_mfovs2, sorted_mfovs1)
+        grid_index2 = load_section_grid_index(tiles_fname2, matching_params['hex_spacing'], tilespecs=ts2)
+        reverse_sections_data = (ts2, ts1, tiles2, grid_index2, reverse_best_transformations, mfov_centers2)
+        directions.append((reverse_sections_data, (tiles_fname2, tiles_fname1), (1, 0)))
+        directions_out_fnames.append(reverse_out_fname)
+    mfovs_tasks = []
+    for direction_idx, (direction_sorted_mfovs, direction_out_fname) in enumerate(zip([sorted_mfovs1, sorted_mfovs2], directions_out_fnames)):
+        if is_match_store_fname(direction_out_fname):
+            if not os.path.exists(direction_out_fname):
+                mfovs_tasks.extend([(direction_idx, mfov, None) for mfov in direction_sorted_mfovs])
+        else:
+            mfovs_tasks.extend([(direction_idx, mfov, direction_out_fname.format(mfov=mfov)) for mfov in direction_sorted_mfovs
+                                if not os.path.exists(direction_out_fname.format(mfov=mfov))])
+
+    if sections is None and reverse_out_fname is not None and len(mfovs_tasks) > 0:
+        logger.info("Rendering the sections")
+        # The search windows of the section's boundary points (around the coarse matches, in the pyramid mode) are
+        # inside the rendered sections' margins
+        sections_margins = [matching_params['search_window_size'] * matching_params['scaling'] / 2 + 1]
+        if matching_params['pyramid_args'] is not None:
+            sections_margins = [(matching_params['search_window_size'] + matching_params['pyramid_args'][2]) * matching_params['scaling'] / 2 + 1,
+                                matching_params['search_window_size'] * matching_params['pyramid_args'][0] / 2 + 1]
+        sections = []
+        for cur_scaling, cur_margin in zip(sections_scalings, sections_margins):
+            for ts, tiles in [(ts1, tiles1), (ts2, tiles2)]:
+                renderer = TilespecAffineRenderer(ts)
+                renderer.add_transformation(np.array([[cur_scaling, 0., 0.], [0., cur_scaling, 0.]]))
+                sections.append(render_section(renderer, tiles.bbox(), cur_scaling, cur_margin))
+        if len(sections) == 2:
+            sections.extend([None, None])
+
+    logger.info("Section-pair mode - matching {} mfovs with {} processes".format(len(mfovs_tasks), processes_num))
+    # The (mfov, matches, failures counts, runtime) of each direction whose matches are saved to a match store
+    directions_mfovs_matches = [[] for direction in directions]
+    def mfov_done(mfov_result):
+        direction_idx, mfov, point_matches, failures_counts, runtime = mfov_result
+        logger.info("Mfov {} is done ({} matches)".format(mfov, len(point_matches)))
+        if is_match_store_fname(directions_out_fnames[direction_idx]):
+            directions_mfovs_matches[direction_idx].append((mfov, point_matches, failures_counts, runtime))
+
+    if processes_num <= 1:
+        _init_mfov_worker(directions, matching_params, debug_dir)
+        _mfov_worker_state['sections'] = sections
+        for mfov_task in mfovs_tasks:
+            mfov_done(_mfov_worker(mfov_task))
+    else:
+        # Each worker takes the next mfov as soon as it is done with its current mfov, so while some workers render their
+        # mfovs' regions, the others are matching
+        # (the memory mapped rendered sections and pyramid sections are inherited by the processes as is)
+        shared_sections = None
+        if sections is not None:
+            shared_sections = [share_region(section) for section in sections]
+        pool = mp.Pool(processes=processes_num, initializer=_init_mfov_worker, initargs=(directions, matching_params, debug_dir, shared_sections))
+        try:
+            for mfov_result in pool.imap_unordered(_mfov_worker, mfovs_tasks, chunksize=1):
+                mfov_done(mfov_result)
+        finally:
+            pool.close()
+            pool.join()
+
+    for direction, direction_out_fname, direction_mfovs_matches in zip(directions, directions_out_fnames, directions_mfovs_matches):
+        if len(direction_mfovs_matches) > 0:
+            logger.info("Saving the matches of {} mfovs to: {}".format(len(direction_mfovs_matches), direction_out_fname))
+            save_match_store(direction_out_fname, MatchStore.from_mfovs_matches(direction[1][0], direction[1][1], matching_params['hex_spacing'],
+                                                                                direction_mfovs_matches))
+
+    logger.info("Done (section-pair runtime: {} seconds)".format(time.time() - starttime))
 
 
 def main():
@@ -392,9 +942,9 @@ def main():
     parser.add_argument('pre_matches_file', metavar='pre_matches_file', type=str,
                         help='a json file that contains the preliminary matches')
     parser.add_argument('mfov', type=int,
-                        help='the mfov number of compare')
+                        help='the mfov number of compare (-1 for all the mfovs, where the output file name should include "{mfov}", unless it is an npz match store)')
     parser.add_argument('-o', '--output_file', type=str,
-                        help='an output correspondent_spec file, that will include the matches between the sections (default: ./matches.json)',
+                        help='an output correspondent_spec file, that will include the matches between the sections, or an npz match store of all the matched mfovs (default: ./matches.json)',
                         default='./matches.json')
     parser.add_argument('-c', '--conf_file_name', type=str,
                         help='the configuration file with the parameters for each step of the alignment process in json format (uses default parameters, if not supplied)',
@@ -402,12 +952,16 @@ def main():
     parser.add_argument('-t', '--threads_num', type=int,
                         help='the number of threads (processes) to use (default: 1)',
                         default=1)
+    parser.add_argument('-r', '--reverse_output_file', type=str,
+                        help='when all the mfovs are matched (mfov -1), also match the second section mfovs to the first section, and save them to this file name (should include "{mfov}", unless it is an npz match store)',
+                        default=None)
 
     args = parser.parse_args()
     match_layers_pmcc_matching(args.tiles_file1, args.tiles_file2,
                                args.pre_matches_file, args.output_file,
                                args.mfov,
-                               conf_fname=args.conf_file_name, processes_num=args.threads_num)
+                               conf_fname=args.conf_file_name, processes_num=args.threads_num,
+                               reverse_out_fname=args.reverse_output_file)
 
 if __name__ == '__main__':
     main()
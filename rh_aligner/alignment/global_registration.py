@@ -0,0 +1,182 @@
+# Global (whole section) registration of two sections, using low resolution renderings of the sections.
+# The rotation between the sections is estimated by a phase correlation of the log-polar representations of the
+# renderings' Fourier magnitude spectra, and then the translation is estimated by a phase correlation of the
+# renderings (after undoing the rotation).
+# The renderings are cached in a sidecar npz file next to each section's tilespec file (validated by the tilespec
+# file's size and mtime), as each section is usually registered with several other sections.
+
+from __future__ import print_function
+import math
+import numpy as np
+import cv2
+from rh_renderer import models
+from ..common import utils
+from ..common.tile_collection import TileCollection
+
+
+def _read_tile_thumbnail(img_fname, tile_scale):
+    """Reads a tile image (in grayscale), and downsamples it by the given scale"""
+    # When the image is much larger than needed, let the decoder do part of the downsampling (OpenCV >= 3.2)
+    if tile_scale <= 0.125 and hasattr(cv2, 'IMREAD_REDUCED_GRAYSCALE_8'):
+        img = cv2.imread(img_fname, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        tile_scale *= 8
+    else:
+        img = cv2.imread(img_fname, 0)
+    if img is None:
+        return None
+    out_shape = (max(1, int(round(img.shape[1] * tile_scale))), max(1, int(round(img.shape[0] * tile_scale))))
+    return cv2.resize(img, out_shape, interpolation=cv2.INTER_AREA)
+
+
+def render_section_thumbnail(tilespecs, scale):
+    """Renders the given section at the given (low) scale, by placing a downsampled image of each tile according to the
+       tile's (affine) transformation. Returns the rendered image (float32) and the section coordinates of its
+       top-left corner"""
+    tiles = TileCollection(tilespecs)
+    bbox = tiles.bbox()
+    offset = np.array([bbox[0], bbox[2]], dtype=np.float64)
+    out_shape = (int(math.ceil((bbox[3] - bbox[2]) * scale)) + 1, int(math.ceil((bbox[1] - bbox[0]) * scale)) + 1)
+    thumbnail = np.zeros(out_shape, dtype=np.float32)
+
+    for i, ts in enumerate(tilespecs):
+        tile_img = _read_tile_thumbnail(tiles.urls[i].replace('file://', ''), scale)
+        if tile_img is None:
+            print("Warning: could not read image {}, skipping the tile".format(tiles.urls[i]))
+            continue
+        tile_matrix = models.Transforms.from_tilespec(ts["transforms"][0]).get_matrix()[:2]
+        # The tile image's pixels are mapped to the section coordinates (using the tile's transformation),
+        # and then to the pixels of the tile's window in the thumbnail
+        tile_bbox = tiles.bboxes[i]
+        from_x = max(0, int(math.floor((tile_bbox[0] - offset[0]) * scale)))
+        from_y = max(0, int(math.floor((tile_bbox[2] - offset[1]) * scale)))
+        to_x = min(out_shape[1], int(math.ceil((tile_bbox[1] - offset[0]) * scale)) + 1)
+        to_y = min(out_shape[0], int(math.ceil((tile_bbox[3] - offset[1]) * scale)) + 1)
+        tile_scale_x = float(tile_img.shape[1]) / ts["width"] if ts.get("width", 0) > 0 else scale
+        tile_scale_y = float(tile_img.shape[0]) / ts["height"] if ts.get("height", 0) > 0 else scale
+        warp_matrix = scale * tile_matrix.dot(np.diag([1.0 / tile_scale_x, 1.0 / tile_scale_y, 1.0]))
+        warp_matrix[:, 2] -= scale * offset + np.array([from_x, from_y])
+        warped = cv2.warpAffine(tile_img.astype(np.float32), warp_matrix, (to_x - from_x, to_y - from_y), flags=cv2.INTER_LINEAR)
+        # Overlapping tiles show (more or less) the same content, so just keep the brighter value
+        np.maximum(thumbnail[from_y:to_y, from_x:to_x], warped, out=thumbnail[from_y:to_y, from_x:to_x])
+
+    return thumbnail, offset
+
+
+def _thumbnail_cache_fname(tiles_fname, scale):
+    return '{}.thumbnail_{}.npz'.format(tiles_fname, scale)
+
+
+def _read_thumbnail_cache(cache_fname):
+    with np.load(cache_fname) as data:
+        return data["key"].tolist(), (data["thumbnail"], data["offset"])
+
+
+def _write_thumbnail_cache(cache_fname, cache_key, thumbnail, offset):
+    with open(cache_fname, 'wb') as cache_file:
+        np.savez(cache_file, key=np.array(cache_key, dtype=np.float64), thumbnail=thumbnail, offset=offset)
+
+
+def load_section_thumbnail(tiles_fname, scale, tilespecs=None, use_cache=True):
+    """Returns the thumbnail (and its offset) of the given section tilespec file (see render_section_thumbnail).
+       If use_cache is True, the thumbnail is read from (or saved to) a sidecar file next to the tilespec file"""
+    tiles_fname = tiles_fname.replace('file://', '')
+    if use_cache:
+        cache_fname = _thumbnail_cache_fname(tiles_fname, scale)
+        cache_key = tuple(float(v) for v in utils.file_cache_key(tiles_fname))
+        cached_thumbnail = utils.load_cache_file(cache_fname, cache_key, _read_thumbnail_cache)
+        if cached_thumbnail is not None:
+            return cached_thumbnail
+
+    if tilespecs is None:
+        tilespecs = utils.load_tilespecs(tiles_fname)
+    thumbnail, offset = render_section_thumbnail(tilespecs, scale)
+
+    if use_cache:
+        utils.save_cache_file(cache_fname, cache_key, lambda tmp_fname: _write_thumbnail_cache(tmp_fname, cache_key, thumbnail, offset))
+
+    return thumbnail, offset
+
+
+def _pad_to_shape(img, shape):
+    out_img = np.zeros(shape, dtype=np.float32)
+    out_img[:img.shape[0], :img.shape[1]] = img
+    return out_img
+
+
+def _highpass_filter(shape):
+    """The high-pass filter of Reddy and Chatterji (1996), that reduces the low frequencies of a (shifted) spectrum"""
+    x = np.cos(np.pi * np.linspace(-0.5, 0.5, shape[1]))
+    y = np.cos(np.pi * np.linspace(-0.5, 0.5, shape[0]))
+    xy = np.outer(y, x)
+    return (1.0 - xy) * (2.0 - xy)
+
+
+def _log_polar_spectrum(img, angles_num, radii_num):
+    """Returns the log-polar representation (rows are angles in [0, pi), columns are log radii) of the image's
+       (high-pass filtered) Fourier magnitude spectrum"""
+    spectrum = np.fft.fftshift(np.abs(np.fft.fft2(img)))
+    spectrum *= _highpass_filter(spectrum.shape)
+    center_y, center_x = spectrum.shape[0] // 2, spectrum.shape[1] // 2
+    max_radius = min(center_x, center_y)
+    radii = np.power(max_radius, np.arange(radii_num, dtype=np.float64) / radii_num)
+    # The magnitude spectrum of a real image is symmetric, so only half of the angles are needed
+    angles = np.arange(angles_num, dtype=np.float64) * np.pi / angles_num
+    map_x = (center_x + np.outer(np.cos(angles), radii)).astype(np.float32)
+    map_y = (center_y + np.outer(np.sin(angles), radii)).astype(np.float32)
+    return cv2.remap(spectrum.astype(np.float32), map_x, map_y, cv2.INTER_LINEAR)
+
+
+def _rotate_image(img, angle):
+    """Rotates the image around its center by the given angle (radians, the matrix is [[cos, -sin], [sin, cos]])"""
+    center = (img.shape[1] / 2.0, img.shape[0] / 2.0)
+    rot_matrix = cv2.getRotationMatrix2D(center, -np.degrees(angle), 1.0)
+    return cv2.warpAffine(img, rot_matrix, (img.shape[1], img.shape[0]), flags=cv2.INTER_LINEAR), rot_matrix
+
+
+def estimate_rigid_transform(img1, img2, angles_num=720):
+    """Estimates the rigid transformation that maps the pixels of img1 to the pixels of img2.
+       Returns a 2x3 matrix, and the phase correlation response of the translation (higher is better)"""
+    # Use a square shape, so a rotation of the image is also a rotation of its spectrum (in pixel units)
+    size = max(img1.shape + img2.shape)
+    shape = (size, size)
+    img1 = _pad_to_shape(img1, shape)
+    img2 = _pad_to_shape(img2, shape)
+    window = cv2.createHanningWindow((shape[1], shape[0]), cv2.CV_32F)
+
+    # Estimate the rotation (up to a rotation by pi, as the spectra are symmetric)
+    radii_num = max(shape) // 2
+    log_polar1 = _log_polar_spectrum(img1 * window, angles_num, radii_num)
+    log_polar2 = _log_polar_spectrum(img2 * window, angles_num, radii_num)
+    (_, angle_shift), _ = cv2.phaseCorrelate(log_polar1, log_polar2)
+    angle = angle_shift * np.pi / angles_num
+
+    # Estimate the translation for both possible rotations, and take the one with the higher response
+    best_matrix = None
+    best_response = -1.0
+    for cur_angle in [angle, angle + np.pi]:
+        rotated_img1, rot_matrix = _rotate_image(img1, cur_angle)
+        (shift_x, shift_y), response = cv2.phaseCorrelate(rotated_img1, img2, window=window)
+        if response > best_response:
+            best_response = response
+            best_matrix = rot_matrix.copy()
+            best_matrix[:, 2] += [shift_x, shift_y]
+    return best_matrix, best_response
+
+
+def register_sections(tiles_fname1, tiles_fname2, scale, tilespecs1=None, tilespecs2=None):
+    """Estimates the rigid transformation from the coordinates of section 1 to the coordinates of section 2, using a
+       low resolution rendering of both sections. Returns the transformation model and its phase correlation response"""
+    thumbnail1, offset1 = load_section_thumbnail(tiles_fname1, scale, tilespecs1)
+    thumbnail2, offset2 = load_section_thumbnail(tiles_fname2, scale, tilespecs2)
+    thumbnails_matrix, response = estimate_rigid_transform(thumbnail1, thumbnail2)
+
+    # Convert the thumbnails transformation to the sections coordinates:
+    # p2 = offset2 + (R * (scale * (p1 - offset1)) + t) / scale
+    rot = thumbnails_matrix[:, :2]
+    translation = offset2 - rot.dot(offset1) + thumbnails_matrix[:, 2] / scale
+    theta = math.atan2(rot[1, 0], rot[0, 0])
+    model = models.Transforms.from_tilespec({
+        "className": "mpicbg.trakem2.transform.RigidModel2D",
+        "dataString": "{} {} {}".format(theta, translation[0], translation[1])
+    })
+    return model, response
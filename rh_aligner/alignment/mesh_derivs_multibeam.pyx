@@ -295,12 +295,17 @@ cpdef FLOAT_TYPE external_grad(FLOAT_TYPE[:, ::1] mesh1,
                                FLOAT_TYPE[:, ::1] barys2,
                                FLOAT_TYPE between_weight,
                                FLOAT_TYPE between_winsor) except -1:
+    cdef:
+        FLOAT_TYPE cost = 0
 
-    return crosslink_mesh_derivs(mesh1, mesh2,
-                                 d_cost_d_mesh1, d_cost_d_mesh2,
-                                 indices1, indices2,
-                                 barys1, barys2,
-                                 between_weight, between_winsor)
+    # (the GIL is released, so the links can be computed by multiple threads)
+    with nogil:
+        cost = crosslink_mesh_derivs(mesh1, mesh2,
+                                     d_cost_d_mesh1, d_cost_d_mesh2,
+                                     indices1, indices2,
+                                     barys1, barys2,
+                                     between_weight, between_winsor)
+    return cost
 
 
 def compare(x, y, eps, restlen, sigma):
@@ -2,13 +2,14 @@ import sys
 import os
 import glob
 import argparse
-from ..common.bounding_box import BoundingBox
+from ..common.bounding_box import BoundingBoxArray
+from ..common import utils
+from ..common import bbox_index
 import json
 
 def add_transformation(in_file, out_file, transform, deltas):
     # load the current json file
-    with open(in_file, 'r') as f:
-        data = json.load(f)
+    data = utils.load_tilespecs(in_file)
 
     if deltas[0] != 0.0 and deltas[1] != 0.0:
         for tile in data:
@@ -25,6 +26,9 @@ def add_transformation(in_file, out_file, transform, deltas):
 
     with open(out_file, 'w') as f:
         json.dump(data, f, indent=4)
+
+    # return the new bounding box of the section (for the bbox index)
+    return BoundingBoxArray.fromTilespec(data).union()
  
 
 def normalize_coordinates(tile_fnames_or_dir, output_dir):
@@ -52,12 +56,10 @@ def normalize_coordinates(tile_fnames_or_dir, output_dir):
     # Retrieve the bounding box of these files
     entire_image_bbox = None
     
-    # merge the bounding boxes to a single bbox
+    # merge the bounding boxes to a single bbox (using the bbox index of the files' directories)
     if len(all_files) > 0:
-        entire_image_bbox = BoundingBox.read_bbox_grep(all_files[0])
-        for f in all_files:
-            entire_image_bbox.extend(BoundingBox.read_bbox_grep(f))
-    
+        entire_image_bbox = bbox_index.read_stack_bbox(all_files)
+
     print "Entire 3D image bounding box: {}".format(entire_image_bbox)
 
     # Set the translation transformation
@@ -71,9 +73,14 @@ def normalize_coordinates(tile_fnames_or_dir, output_dir):
         }
 
     # Add the transformation to each tile in each tilespec
+    out_files = []
+    out_bboxes = []
     for in_file in all_files:
         out_file = os.path.join(output_dir, os.path.basename(in_file))
-        add_transformation(in_file, out_file, transform, [deltaX, deltaY])
+        out_bboxes.append(add_transformation(in_file, out_file, transform, [deltaX, deltaY]))
+        out_files.append(out_file)
+
+    bbox_index.update_bbox_index(out_files, out_bboxes)
 
 
 
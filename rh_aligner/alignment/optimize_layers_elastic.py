@@ -3,10 +3,11 @@ import os
 import glob
 import argparse
 from subprocess import call
-from ..common.bounding_box import BoundingBox
+from ..common.bounding_box import BoundingBox, BoundingBoxArray
 import json
 import itertools
 from ..common import utils
+from ..common import bbox_index
 from optimize_mesh import optimize_meshes
 import math
 import numpy as np
@@ -107,9 +108,7 @@ def save_optimized_mesh(ts_fname, url_optimized_mesh, out_dir):
     ts_base = os.path.basename(ts_fname)
     out_fname = os.path.join(out_dir, ts_base)
     # read tilespec
-    data = None
-    with open(ts_fname, 'r') as data_file:
-        data = json.load(data_file)
+    data = utils.load_tilespecs(ts_fname)
 
     if len(data) > 0:
         tiles_to_remove = []
@@ -132,9 +131,12 @@ def save_optimized_mesh(ts_fname, url_optimized_mesh, out_dir):
 
         # save the output tile spec
         save_json_file(out_fname, data)
+        # return the section's new bounding box (for the bbox index)
+        return out_fname, BoundingBoxArray.fromTilespec(data).union()
     else:
         print('Nothing to write for tilespec {}'.format(ts_fname))
         sys.stdout.flush()
+    return None, None
 
 
 def save_optimized_meshes(all_tile_urls, optimized_meshes, out_dir, processes_num=1):
@@ -148,11 +150,18 @@ def save_optimized_meshes(all_tile_urls, optimized_meshes, out_dir, processes_nu
         res = pool.apply_async(save_optimized_mesh, (ts_fname, optimized_meshes[ts_fname], out_dir))
         all_results.append(res)
 
+    out_fnames = []
+    out_bboxes = []
     for res in all_results:
-        res.get()
+        out_fname, out_bbox = res.get()
+        if out_fname is not None:
+            out_fnames.append(out_fname)
+            out_bboxes.append(out_bbox)
 
     pool.close()
     pool.join()
+
+    bbox_index.update_bbox_index(out_fnames, out_bboxes)
         
 def read_ts_layers(tile_files):
     tsfile_to_layerid = {}
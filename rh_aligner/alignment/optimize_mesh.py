@@ -11,8 +11,10 @@ from sklearn.utils.extmath import randomized_svd
 import pylab
 from matplotlib import collections as mc
 import gc
-from ..common.bounding_box import BoundingBox
+from multiprocessing.pool import ThreadPool
+from ..common.section_grid_index import load_section_grid_index
 from ..common import utils
+from ..common.match_store import load_match_store, is_match_store_fname
 import datetime
 
 import pyximport
@@ -249,6 +251,28 @@ def get_transform_matrix(pts1, pts2, type):
         print("Unsupported transformation model type")
         return None
 
+def compact_link(idx1, w1, idx2, w2):
+    """Returns the (unique) mesh points of each side of a link, and the link's mesh indices in those points, so the
+       link's gradient can be computed into buffers of only the link's mesh points"""
+    pts_idx1, local_idx1 = np.unique(idx1, return_inverse=True)
+    pts_idx2, local_idx2 = np.unique(idx2, return_inverse=True)
+    return (pts_idx1, local_idx1.reshape(idx1.shape).astype(np.uint32), np.ascontiguousarray(w1, dtype=FLOAT_TYPE),
+            pts_idx2, local_idx2.reshape(idx2.shape).astype(np.uint32), np.ascontiguousarray(w2, dtype=FLOAT_TYPE))
+
+def link_external_grad(pts1, pts2, link, weight, winsor):
+    """Returns the cost of the given compact link (see compact_link), and the gradients of its mesh points"""
+    pts_idx1, local_idx1, w1, pts_idx2, local_idx2, w2 = link
+    link_pts1 = np.ascontiguousarray(pts1[pts_idx1])
+    link_pts2 = np.ascontiguousarray(pts2[pts_idx2])
+    gradient1 = np.zeros_like(link_pts1)
+    gradient2 = np.zeros_like(link_pts2)
+    cost = mesh_derivs_multibeam.external_grad(link_pts1, link_pts2,
+                                      gradient1, gradient2,
+                                      local_idx1, w1,
+                                      local_idx2, w2,
+                                      weight, winsor)
+    return cost, gradient1, gradient2
+
 def optimize_meshes_links(meshes, links, layers, conf_dict={}):
     # set default values
     cross_slice_weight = conf_dict.get("cross_slice_weight", 1.0)
@@ -262,7 +286,7 @@ def optimize_meshes_links(meshes, links, layers, conf_dict={}):
     # min_iterations = conf_dict.get("min_iterations", 200)
     max_iterations = conf_dict.get("max_iterations", 5000)
     # mean_offset_threshold = conf_dict.get("mean_offset_threshold", 5)
-    # num_threads = conf_dict.get("optimization_threads", 8)
+    num_threads = conf_dict.get("optimization_threads", 8)
     min_stepsize = conf_dict.get("min_stepsize", 1e-20)
     assumed_model = conf_dict.get("assumed_model", 3) # 0 - Translation (not supported), 1 - Rigid, 2 - Similarity (not supported), 3 - Affine
 
@@ -332,62 +356,82 @@ def optimize_meshes_links(meshes, links, layers, conf_dict={}):
     gradients_with_momentum = {ts: 0.0 for ts in meshes}
     old_pts = None
 
+    # The gradient kernels release the GIL, so the sections and the links are computed by a pool of threads.
+    # Each section's internal gradient is computed into its own gradient, and each link's gradient into buffers of
+    # only the link's mesh points, which are then added to the sections gradients in a fixed (sorted links) order, so
+    # the result does not depend on the number of threads or on their scheduling
+    sorted_links = sorted(links.keys())
+    compact_links = {(ts1, ts2): compact_link(idx1, w1, idx2, w2) for (ts1, ts2), ((idx1, w1), (idx2, w2)) in links.iteritems()}
+    print("Computing the gradients with {} threads".format(num_threads))
+    pool = None
+    pool_map = map
+    if num_threads > 1:
+        pool = ThreadPool(processes=num_threads)
+        pool_map = pool.map
+
+    try:
+        for iter in range(max_iterations):
+            cost = 0.0
+
+            gradients = {ts: np.zeros_like(mesh.pts) for ts, mesh in meshes.iteritems()}
+
+            # Compute the cost of the internal and external links
+            internal_costs = pool_map(lambda ts: mesh_derivs_multibeam.internal_grad(meshes[ts].pts, gradients[ts],
+                                                  *((structural_meshes[ts]) +
+                                                    (intra_slice_weight, intra_slice_winsor))),
+                                      sorted_slices)
+            external_results = pool_map(lambda link: link_external_grad(meshes[link[0]].pts, meshes[link[1]].pts, compact_links[link],
+                                                  cross_slice_weight / float(abs(layers[link[0]] - layers[link[1]])), cross_slice_winsor),
+                                        sorted_links)
+            for internal_cost in internal_costs:
+                cost += internal_cost
+            for (ts1, ts2), (link_cost, link_gradient1, link_gradient2) in zip(sorted_links, external_results):
+                cost += link_cost
+                gradients[ts1][compact_links[ts1, ts2][0]] += link_gradient1
+                gradients[ts2][compact_links[ts1, ts2][3]] += link_gradient2
+
+            if cost < prev_cost and not np.isinf(cost):
+                prev_cost = cost
+                stepsize *= 1.1
+                if stepsize > 1.0:
+                    stepsize = 1.0
+                # update with new gradients
+                for ts in gradients_with_momentum:
+                    gradients_with_momentum[ts] = gradients[ts] + momentum * gradients_with_momentum[ts]
+                old_pts = {ts: m.pts.copy() for ts, m in meshes.iteritems()}
+                for ts in meshes:
+                    meshes[ts].pts -= stepsize * gradients_with_momentum[ts]
+                # if iter % 500 == 0:
+                #     print("{} Good step: cost {}  stepsize {}".format(iter, cost, stepsize))
+            else:  # we took a bad step: undo it, scale down stepsize, and start over
+                for ts in meshes:
+                    meshes[ts].pts = old_pts[ts]
+                stepsize *= 0.5
+                gradients_with_momentum = {ts: 0 for ts in meshes}
+                # if iter % 500 == 0:
+                #     print("{} Bad step: stepsize {}".format(iter, stepsize))
+            if iter % 100 == 0:
+                print("iter {}: C: {}, MO: {}, S: {}".format(iter, cost, mean_offsets(meshes, links, sorted_slices[-1], plot=False), stepsize))
+
+            # Save animation for debugging
+            if len(debugged_layers) > 0:
+                # TODO - make this faster by just iterating over the debugged layers
+                for active_ts in sorted_slices:
+                    if layers[active_ts] in debugged_layers:
+                        cPickle.dump([active_ts, meshes[active_ts].pts], open(os.path.join(DEBUG_DIR, "post_iter{}_{}.pickle".format(str(iter).zfill(5), os.path.basename(active_ts).replace(' ', '_'))), "w"))
+                        #plot_points(meshes[active_ts].pts, os.path.join(DEBUG_DIR, "post_iter{}_{}.png".format(str(iter).zfill(5), os.path.basename(active_ts).replace(' ', '_'))))
 
-    for iter in range(max_iterations):
-        cost = 0.0
-
-        gradients = {ts: np.zeros_like(mesh.pts) for ts, mesh in meshes.iteritems()}
 
-        # Compute the cost of the internal and external links
-        for ts in meshes:
-            cost += mesh_derivs_multibeam.internal_grad(meshes[ts].pts, gradients[ts],
-                                              *((structural_meshes[ts]) +
-                                                (intra_slice_weight, intra_slice_winsor)))
-        for (ts1, ts2), ((idx1, w1), (idx2, w2)) in links.iteritems():
-            cost += mesh_derivs_multibeam.external_grad(meshes[ts1].pts, meshes[ts2].pts,
-                                              gradients[ts1], gradients[ts2],
-                                              idx1, w1,
-                                              idx2, w2,
-                                              cross_slice_weight / float(abs(layers[ts1] - layers[ts2])), cross_slice_winsor)
-
-        if cost < prev_cost and not np.isinf(cost):
-            prev_cost = cost
-            stepsize *= 1.1
-            if stepsize > 1.0:
-                stepsize = 1.0
-            # update with new gradients
-            for ts in gradients_with_momentum:
-                gradients_with_momentum[ts] = gradients[ts] + momentum * gradients_with_momentum[ts]
-            old_pts = {ts: m.pts.copy() for ts, m in meshes.iteritems()}
             for ts in meshes:
-                meshes[ts].pts -= stepsize * gradients_with_momentum[ts]
-            # if iter % 500 == 0:
-            #     print("{} Good step: cost {}  stepsize {}".format(iter, cost, stepsize))
-        else:  # we took a bad step: undo it, scale down stepsize, and start over
-            for ts in meshes:
-                meshes[ts].pts = old_pts[ts]
-            stepsize *= 0.5
-            gradients_with_momentum = {ts: 0 for ts in meshes}
-            # if iter % 500 == 0:
-            #     print("{} Bad step: stepsize {}".format(iter, stepsize))
-        if iter % 100 == 0:
-            print("iter {}: C: {}, MO: {}, S: {}".format(iter, cost, mean_offsets(meshes, links, sorted_slices[-1], plot=False), stepsize))
-
-        # Save animation for debugging
-        if len(debugged_layers) > 0:
-            # TODO - make this faster by just iterating over the debugged layers
-            for active_ts in sorted_slices:
-                if layers[active_ts] in debugged_layers:
-                    cPickle.dump([active_ts, meshes[active_ts].pts], open(os.path.join(DEBUG_DIR, "post_iter{}_{}.pickle".format(str(iter).zfill(5), os.path.basename(active_ts).replace(' ', '_'))), "w"))
-                    #plot_points(meshes[active_ts].pts, os.path.join(DEBUG_DIR, "post_iter{}_{}.png".format(str(iter).zfill(5), os.path.basename(active_ts).replace(' ', '_'))))
-
-
-        for ts in meshes:
-            assert not np.any(~ np.isfinite(meshes[ts].pts))
-
-        # If stepsize is too small (won't make any difference), stop the iterations
-        if stepsize < min_stepsize:
-            break
+                assert not np.any(~ np.isfinite(meshes[ts].pts))
+
+            # If stepsize is too small (won't make any difference), stop the iterations
+            if stepsize < min_stepsize:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     print("last MO: {}\n".format(mean_offsets(meshes, links, sorted_slices[-1], plot=False)))
 
     if SHOW_FINAL_MO:
@@ -418,6 +462,18 @@ def optimize_meshes_links(meshes, links, layers, conf_dict={}):
 
     return out_positions
 
+def load_matches_file(match_file):
+    """Returns the tilespecs (tilespec1, tilespec2) and the matched points (pts1, pts2) of a block matching output file,
+       which is either the json file of a single mfov, or the match store of all the mfovs of a layers pair"""
+    if is_match_store_fname(match_file):
+        store = load_match_store(match_file)
+        return store.tilespec1, store.tilespec2, store.point1, store.point2
+    with open(match_file, 'r') as f:
+        data = json.load(f)
+    pts1 = np.array([p["point1"] for p in data["pointmatches"]])
+    pts2 = np.array([p["point2"] for p in data["pointmatches"]])
+    return data["tilespec1"], data["tilespec2"], pts1, pts2
+
 def optimize_meshes(match_files_list, hex_spacing, conf_dict={}):
     meshes = {}
 
@@ -427,11 +483,9 @@ def optimize_meshes(match_files_list, hex_spacing, conf_dict={}):
     # extract meshes
     for match_file in match_files_list:
         # Assumes that the mesh can be separated into multiple files with the same tilespec1 or tilespec2
-        data = None
         print match_file
-        with open(match_file, 'r') as f:
-            data = json.load(f)
-        if not data["tilespec1"] in meshes:
+        tilespec1, tilespec2, pts1, pts2 = load_matches_file(match_file)
+        if not tilespec1 in meshes:
             # if "mfov1" in data:
             #     if not data["tilespec1"] in meshes_per_mfov:
             #         meshes_per_mfov[data["tilespec1"]] = {}
@@ -439,21 +493,17 @@ def optimize_meshes(match_files_list, hex_spacing, conf_dict={}):
             #         meshes_per_mfov[data["tilespec1"]][data["mfov1"]] = data["mesh"]
             # else:
             #     meshes[data["tilespec1"]] = Mesh(data["mesh"])
-            ts_fname = data["tilespec1"].replace("file://","")
-            print("Generating Hexagonal Grid")
-            bb = BoundingBox.read_bbox(ts_fname)
-            print("bounding_box: ", bb)
-            meshes[data["tilespec1"]] = Mesh(utils.generate_hexagonal_grid(bb, hex_spacing))
+            ts_fname = tilespec1.replace("file://","")
+            print("Loading Hexagonal Grid")
+            meshes[tilespec1] = Mesh(load_section_grid_index(ts_fname, hex_spacing).points)
             ts_layer = utils.read_layer_from_file(ts_fname)
-            layers[data["tilespec1"]] = ts_layer
-        if not data["tilespec1"] in pair_ts_to_pts:
-            pair_ts_to_pts[data["tilespec1"]] = {}
-        if not data["tilespec2"] in pair_ts_to_pts[data["tilespec1"]]:
-            pair_ts_to_pts[data["tilespec1"]][data["tilespec2"]] = []
-        pts1 = np.array([p["point1"] for p in data["pointmatches"]])
-        pts2 = np.array([p["point2"] for p in data["pointmatches"]])
+            layers[tilespec1] = ts_layer
+        if not tilespec1 in pair_ts_to_pts:
+            pair_ts_to_pts[tilespec1] = {}
+        if not tilespec2 in pair_ts_to_pts[tilespec1]:
+            pair_ts_to_pts[tilespec1][tilespec2] = []
         if len(pts1) > 0:
-            pair_ts_to_pts[data["tilespec1"]][data["tilespec2"]].append((pts1, pts2))
+            pair_ts_to_pts[tilespec1][tilespec2].append((pts1, pts2))
 
 #    # Make sure the meshes are initialized per tilespec
 #    for tilespec_url in meshes_per_mfov:
@@ -9,13 +9,19 @@ import json
 import random
 import sys
 from scipy.spatial import distance
+from scipy.spatial import cKDTree
 import cv2
 import time
 import glob
+import re
+import zlib
 import argparse
+import multiprocessing as mp
 from ..common import utils
+from . import global_registration
 from scipy.spatial import Delaunay
-from ..common.bounding_box import BoundingBox
+from ..common.bounding_box import BoundingBox, BoundingBoxArray
+from ..common.tile_collection import TileCollection
 
 TILES_PER_MFOV = 61
 
@@ -79,6 +85,21 @@ def getcenter(mfov_ts):
 
 
 
+def map_mfov_feature_files(mfov_feature_files, mfov_string):
+    """Returns a dictionary that maps a tile number to its features file (the first, in sorted order, whose name,
+       after the 'sifts_' part, contains _[mfov]_[tile]_)"""
+    tile_re = re.compile('_{}_([0-9]{{3}})_'.format(mfov_string))
+    tiles_feature_files = {}
+    for fname in mfov_feature_files:
+        name_parts = fname.split('sifts_')
+        if len(name_parts) < 2:
+            continue
+        m = tile_re.search(name_parts[1])
+        if m is not None:
+            tiles_feature_files.setdefault(int(m.group(1)), fname)
+    return tiles_feature_files
+
+
 def analyzemfov(mfov_ts, features_dir):
     """Returns all the relevant features of the tiles in a single mfov"""
     allpoints = np.array([]).reshape((0, 2))
@@ -90,11 +111,11 @@ def analyzemfov(mfov_ts, features_dir):
     mfov_feature_files = sorted(glob.glob(os.path.join(os.path.join(features_dir, mfov_string), '*')))
     if len(mfov_feature_files) < TILES_PER_MFOV:
         print("Warning: number of feature files in directory: {} is smaller than {}".format(os.path.join(os.path.join(features_dir, mfov_string)), TILES_PER_MFOV), file=sys.stderr)
+    tiles_feature_files = map_mfov_feature_files(mfov_feature_files, mfov_string)
 
     # load each features file, and concatenate all to single lists
     for tile_num in mfov_ts.keys():
-    #for feature_file in mfov_feature_files:
-        feature_file = [fname for fname in mfov_feature_files if "_{}_{}_".format(mfov_string, "%03d" % tile_num) in fname.split('sifts_')[1]][0]
+        feature_file = tiles_feature_files[tile_num]
         # Get the correct tile tilespec from the section tilespec (convert to int to remove leading zeros)
         #tile_num = int(feature_file.split('sifts_')[1].split('_')[2])
         (tempoints, tempresps, tempdescs) = load_features(feature_file, mfov_ts[tile_num])
@@ -131,6 +152,67 @@ def generatematches_crosscheck_cv2(allpoints1, allpoints2, alldescs1, alldescs2,
 
 
 
+class IncrementalCrossCheckMatcher(object):
+    """Cross-check (mutual nearest neighbor) matching of the features of a fixed set of section 1 mfovs against the
+       features of a growing set of section 2 mfovs. For each section 1 feature the nearest section 2 feature (and its
+       distance) is kept, and for each section 2 feature its nearest section 1 feature is kept, so when new section 2
+       mfovs are added, only the new features are queried (using the mfovs nearest neighbors indices of the
+       SectionFeaturesIndex objects), and the cross-check is re-resolved using the kept nearest neighbors.
+       When exact nearest neighbors are used, the matches are the same as the ones of generatematches_crosscheck_cv2
+       on all the added features."""
+
+    def __init__(self, features_index1, mfovs1, features_index2):
+        self.features_index1 = features_index1
+        self.features_index2 = features_index2
+        self.mfovs1 = list(mfovs1)
+        mfovs1_features = [features_index1.get_mfov_features(mfov) for mfov in self.mfovs1]
+        # The index of the first feature of each section 1 mfov (in the concatenated features)
+        self.mfovs1_offsets = np.cumsum([0] + [len(f[0]) for f in mfovs1_features])[:-1].tolist()
+        self.points1 = np.vstack([f[0].reshape((-1, 2)) for f in mfovs1_features] + [np.zeros((0, 2))])
+        self.descs1 = None
+        if len(self.points1) > 0:
+            self.descs1 = np.ascontiguousarray(np.vstack([f[2] for f in mfovs1_features if len(f[0]) > 0]), dtype=np.float32)
+        self.forward_idxs = np.full((len(self.points1), ), -1, dtype=np.int64)
+        self.forward_dists = np.full((len(self.points1), ), np.inf, dtype=np.float32)
+        self.points2 = np.zeros((0, 2))
+        self.backward_idxs = np.zeros((0, ), dtype=np.int64)
+
+    def add_mfovs(self, mfovs2):
+        """Adds the features of the given section 2 mfovs (appended after the previously added ones)"""
+        for mfov2 in mfovs2:
+            points2, _, descs2 = self.features_index2.get_mfov_features(mfov2)
+            if len(points2) == 0:
+                continue
+            offset = len(self.points2)
+            new_backward_idxs = np.full((len(points2), ), -1, dtype=np.int64)
+            if len(self.points1) > 0:
+                # Update the nearest section 2 feature of each section 1 feature (on ties, the earlier feature is kept)
+                new_idxs, new_dists = self.features_index2.nearest(mfov2, self.descs1)
+                improved_mask = new_dists < self.forward_dists
+                self.forward_idxs[improved_mask] = new_idxs[improved_mask] + offset
+                self.forward_dists[improved_mask] = new_dists[improved_mask]
+                # The nearest section 1 feature of each new section 2 feature
+                new_backward_dists = np.full((len(points2), ), np.inf, dtype=np.float32)
+                for mfov1, offset1 in zip(self.mfovs1, self.mfovs1_offsets):
+                    idxs, dists = self.features_index1.nearest(mfov1, descs2)
+                    improved_mask = dists < new_backward_dists
+                    new_backward_idxs[improved_mask] = idxs[improved_mask] + offset1
+                    new_backward_dists[improved_mask] = dists[improved_mask]
+            self.points2 = np.vstack((self.points2, points2.reshape((-1, 2))))
+            self.backward_idxs = np.concatenate((self.backward_idxs, new_backward_idxs))
+
+    def __len__(self):
+        """The number of section 2 features that were added"""
+        return len(self.points2)
+
+    def get_match_points(self):
+        """Returns a 2xNx2 array of the cross-checked matches' points (the section 1 points, and the section 2 points)"""
+        idxs1 = np.nonzero(self.forward_idxs >= 0)[0]
+        idxs2 = self.forward_idxs[idxs1]
+        mutual_mask = self.backward_idxs[idxs2] == idxs1
+        return np.array([self.points1[idxs1[mutual_mask]], self.points2[idxs2[mutual_mask]]])
+
+
 def compare_features(section1_pts_resps_descs, section2_pts_resps_descs, actual_params):
     [allpoints1, allresps1, alldescs1] = section1_pts_resps_descs
     [allpoints2, allresps2, alldescs2] = section2_pts_resps_descs
@@ -138,9 +220,18 @@ def compare_features(section1_pts_resps_descs, section2_pts_resps_descs, actual_
     # print("lengths: len(allpoints2): {}, alldescs2.shape: {}".format(len(allpoints2), alldescs2.shape))
     #match_points = generatematches_cv2(allpoints1, allpoints2, alldescs1, alldescs2, actual_params)
     match_points = generatematches_crosscheck_cv2(allpoints1, allpoints2, alldescs1, alldescs2, actual_params)
+    return filter_match_points(match_points, len(allpoints1), len(allpoints2), actual_params)
+
 
+def compare_features_incremental(matcher, actual_params, initial_model=None):
+    """Same as compare_features, but uses the (incrementally updated) matches of the given IncrementalCrossCheckMatcher,
+       and warm-starts the RANSAC search from the given initial model"""
+    return filter_match_points(matcher.get_match_points(), len(matcher.points1), len(matcher), actual_params, initial_model)
+
+
+def filter_match_points(match_points, num_points1, num_points2, actual_params, initial_model=None):
     if match_points.shape[0] == 0 or match_points.shape[1] == 0:
-        return (None, 0, 0, 0, len(allpoints1), len(allpoints2))
+        return (None, 0, 0, 0, num_points1, num_points2)
     
     model_index = actual_params["model_index"]
     iterations = actual_params["iterations"]
@@ -150,27 +241,150 @@ def compare_features(section1_pts_resps_descs, section2_pts_resps_descs, actual_
     max_trust = actual_params["max_trust"]
     det_delta = actual_params["det_delta"]
     max_stretch = actual_params["max_stretch"]
-    model, filtered_matches = ransac.filter_matches(match_points, model_index, iterations, max_epsilon, min_inlier_ratio, min_num_inlier, max_trust, det_delta, max_stretch)
+    model, filtered_matches = ransac.filter_matches(match_points, model_index, iterations, max_epsilon, min_inlier_ratio, min_num_inlier, max_trust, det_delta, max_stretch, initial_model)
     if filtered_matches is None:
         filtered_matches = np.zeros((0, 0))
-    return (model, filtered_matches.shape[1], float(filtered_matches.shape[1]) / match_points.shape[1], match_points.shape[1], len(allpoints1), len(allpoints2))
-
-
-def load_mfovs_features(indexed_ts, features_dir, mfovs_idx):
-    all_points, all_resps, all_descs = np.array([]).reshape((0, 2)), [], []
-    for idx in mfovs_idx:
-        mfov_points, mfov_resps, mfov_descs = analyzemfov(indexed_ts[idx], features_dir)
-        all_points = np.append(all_points, mfov_points, axis=0)
-        all_resps.append(mfov_resps)
-        all_descs.append(mfov_descs)
-    return all_points, all_resps, all_descs
- 
-
-
-def iterative_search(actual_params, layer1, layer2, indexed_ts1, indexed_ts2, features_dir1, features_dir2, mfovs_nums1, centers_mfovs_nums2, section2_mfov_bboxes, sorted_mfovs2, assumed_model=None, is_initial_search=False, point1=None):
+    return (model, filtered_matches.shape[1], float(filtered_matches.shape[1]) / match_points.shape[1], match_points.shape[1], num_points1, num_points2)
+
+
+# The FLANN randomized kd-trees index algorithm
+FLANN_INDEX_KDTREE = 1
+
+
+def _exact_nearest(query_descs, train_descs):
+    """Returns the index of the nearest train descriptor of each query descriptor, and its (L2) distance"""
+    matches = cv2.BFMatcher(cv2.NORM_L2).match(query_descs, train_descs)
+    nearest_idxs = np.full((len(query_descs), ), -1, dtype=np.int64)
+    nearest_dists = np.full((len(query_descs), ), np.inf, dtype=np.float32)
+    for m in matches:
+        nearest_idxs[m.queryIdx] = m.trainIdx
+        nearest_dists[m.queryIdx] = m.distance
+    return nearest_idxs, nearest_dists
+
+
+class MfovDescriptorsIndex(object):
+    """An approximate nearest neighbors index (FLANN randomized kd-forest) of an mfov's descriptors.
+       The index is saved in the mfov's features directory (the file name includes the number of descriptors and
+       their checksum, so a saved index is only used for the same descriptors), and is reused by later queries
+       of all the layer pairs that include the section."""
+
+    def __init__(self, descs, index_dir, trees=4, checks=64):
+        self.descs = np.ascontiguousarray(descs, dtype=np.float32)
+        self.checks = checks
+        index_fname = os.path.join(index_dir, '.descs_kdtree{}_{}_{:08x}.flann'.format(
+            trees, len(self.descs), zlib.crc32(self.descs.tostring()) & 0xffffffff))
+        # (the index file name is its key, so the saved index file has no key of its own)
+        self.index = utils.load_cache_file(index_fname, None, self._read_index)
+        if self.index is not None:
+            return
+        self.index = cv2.flann_Index(self.descs, dict(algorithm=FLANN_INDEX_KDTREE, trees=trees))
+        utils.save_cache_file(index_fname, None, self.index.save)
+
+    def _read_index(self, index_fname):
+        index = cv2.flann_Index()
+        if not index.load(self.descs, index_fname):
+            raise IOError("Could not load the descriptors index {}".format(index_fname))
+        return None, index
+
+    def nearest(self, query_descs):
+        """Returns the index of the (approximate) nearest descriptor of each query descriptor, and its (L2) distance"""
+        idxs, sq_dists = self.index.knnSearch(np.ascontiguousarray(query_descs, dtype=np.float32), 1, params=dict(checks=self.checks))
+        return idxs.ravel().astype(np.int64), np.sqrt(sq_dists.ravel())
+
+
+class SectionFeaturesIndex(object):
+    """Holds the relevant (transformed, coarse octaves) features of a section's mfovs in memory.
+       Each mfov's features are loaded (using analyzemfov) on its first query only, and kept in contiguous arrays.
+       If ann_params (a dictionary with the 'trees' and 'checks' of the FLANN index) are given, nearest neighbor
+       queries use a (persistent) approximate index per mfov, and otherwise an exact (brute-force) search."""
+
+    def __init__(self, indexed_ts, features_dir, ann_params=None):
+        self.indexed_ts = indexed_ts
+        self.features_dir = features_dir
+        self.ann_params = ann_params
+        # A map between an mfov number and its (points, responses, descriptors)
+        self.mfovs_features = {}
+        # A map between an mfov number and its MfovDescriptorsIndex
+        self.mfovs_descs_indices = {}
+
+    def get_mfov_features(self, mfov):
+        if mfov not in self.mfovs_features:
+            mfov_points, mfov_resps, mfov_descs = analyzemfov(self.indexed_ts[mfov], self.features_dir)
+            self.mfovs_features[mfov] = (np.ascontiguousarray(mfov_points),
+                                         np.ascontiguousarray(mfov_resps),
+                                         np.ascontiguousarray(mfov_descs))
+        return self.mfovs_features[mfov]
+
+    def get_mfovs_features(self, mfovs):
+        """Returns the concatenated (points, responses, descriptors) of the given mfovs (in the given order)"""
+        mfovs_features = [self.get_mfov_features(mfov) for mfov in mfovs]
+        return (np.concatenate([f[0] for f in mfovs_features]).reshape((-1, 2)),
+                np.concatenate([f[1] for f in mfovs_features]),
+                np.vstack([f[2] for f in mfovs_features]))
+
+    def nearest(self, mfov, query_descs):
+        """Returns the index (in the mfov's features) of the nearest feature of the given mfov to each of the query
+           descriptors, and its distance (the index is -1, and the distance is inf, if the mfov has no features)"""
+        mfov_descs = self.get_mfov_features(mfov)[2]
+        if len(mfov_descs) == 0 or len(query_descs) == 0:
+            return np.full((len(query_descs), ), -1, dtype=np.int64), np.full((len(query_descs), ), np.inf, dtype=np.float32)
+        if self.ann_params is None:
+            return _exact_nearest(np.ascontiguousarray(query_descs, dtype=np.float32), np.ascontiguousarray(mfov_descs, dtype=np.float32))
+        if mfov not in self.mfovs_descs_indices:
+            mfov_dir = os.path.join(self.features_dir, "%06d" % int(mfov))
+            self.mfovs_descs_indices[mfov] = MfovDescriptorsIndex(mfov_descs, mfov_dir, **self.ann_params)
+        return self.mfovs_descs_indices[mfov].nearest(query_descs)
+
+
+def _to_shared_array(arr, typecode, dtype):
+    """Copies the given array to a new (flat) shared memory array"""
+    arr = np.asarray(arr, dtype=dtype).ravel()
+    shared_arr = mp.RawArray(typecode, max(arr.size, 1))
+    np.frombuffer(shared_arr, dtype=dtype)[:arr.size] = arr
+    return shared_arr
+
+
+class SharedSectionFeatures(object):
+    """The features of a section's mfovs, concatenated into shared memory arrays, so processes that are forked after
+       its creation can use them without loading (or copying) the features"""
+
+    def __init__(self, features_index, mfovs):
+        mfovs_features = [features_index.get_mfov_features(mfov) for mfov in mfovs]
+        offsets = np.cumsum([0] + [len(f[0]) for f in mfovs_features]).tolist()
+        self.mfovs_ranges = {mfov: (offsets[i], offsets[i + 1]) for i, mfov in enumerate(mfovs)}
+        self.features_num = offsets[-1]
+        self.descs_dim = max([f[2].shape[1] for f in mfovs_features if f[2].ndim == 2] + [0])
+        self.indexed_ts = features_index.indexed_ts
+        self.features_dir = features_index.features_dir
+        self.ann_params = features_index.ann_params
+        self.points = _to_shared_array(np.vstack([f[0].reshape((-1, 2)) for f in mfovs_features] + [np.zeros((0, 2))]), 'd', np.float64)
+        self.resps = _to_shared_array(np.concatenate([f[1] for f in mfovs_features] + [np.zeros((0, ))]), 'f', np.float32)
+        self.descs = _to_shared_array(np.vstack([f[2].reshape((-1, self.descs_dim)) for f in mfovs_features] + [np.zeros((0, self.descs_dim))]), 'f', np.float32)
+
+    def features_index(self):
+        """Returns a SectionFeaturesIndex whose mfovs features are views of the shared memory arrays"""
+        points = np.frombuffer(self.points, dtype=np.float64)[:self.features_num * 2].reshape((-1, 2))
+        resps = np.frombuffer(self.resps, dtype=np.float32)[:self.features_num]
+        descs = np.frombuffer(self.descs, dtype=np.float32)[:self.features_num * self.descs_dim].reshape((-1, self.descs_dim))
+        features_index = SectionFeaturesIndex(self.indexed_ts, self.features_dir, self.ann_params)
+        for mfov, (start_idx, end_idx) in self.mfovs_ranges.items():
+            features_index.mfovs_features[mfov] = (points[start_idx:end_idx], resps[start_idx:end_idx], descs[start_idx:end_idx])
+        return features_index
+
+
+def meets_match_thresholds(actual_params, num_filtered, filter_rate, features_num1, mfovs_num1):
+    """Returns True if the number of filtered matches and the filter rate are high enough to accept a model"""
+    return num_filtered > (actual_params["num_filtered_percent"] * features_num1 / mfovs_num1) and filter_rate > actual_params["filter_rate_cutoff"]
+
+
+def iterative_search(actual_params, layer1, layer2, features_index1, features_index2, mfovs_nums1, centers_mfovs_nums2, section2_mfov_bboxes, sorted_mfovs2, assumed_model=None, is_initial_search=False, point1=None, max_iterations=None, require_match=False):
+    """Matches the features of the given section 1 mfovs to the features of the given section 2 mfovs, and expands
+       the section 2 area until a model that meets the thresholds is found (or no more mfovs can be added).
+       If max_iterations is given, the area is expanded at most max_iterations - 1 times, and if require_match is True,
+       a model is only returned if it meets the thresholds"""
     # Load the features from the mfovs in section 1
-    all_points1, all_resps1, all_descs1 = load_mfovs_features(indexed_ts1, features_dir1, mfovs_nums1)
-    section1_pts_resps_descs = [all_points1, np.concatenate(all_resps1), np.vstack(all_descs1)]
+    section1_pts_resps_descs = list(features_index1.get_mfovs_features(mfovs_nums1))
+    all_points1 = section1_pts_resps_descs[0]
     print("Section {} - mfovs: {}, {} features loaded.".format(layer1, mfovs_nums1, len(all_points1)))
 
     # Make sure we have enough features from section 1
@@ -182,22 +396,20 @@ def iterative_search(actual_params, layer1, layer2, indexed_ts1, indexed_ts2, fe
     # Take the mfovs in the middle of the 2nd section as the initial matched area
     # (on each iteration, increase the matched area, by taking all the mfovs that overlap
     # with the bounding box of the previous matched area)
-    current_area = BoundingBox.fromList(section2_mfov_bboxes[centers_mfovs_nums2[0]].toArray())
-    print("Adding area 0: {}".format(section2_mfov_bboxes[centers_mfovs_nums2[0]].toArray()))
-    for i in range(1, len(centers_mfovs_nums2)):
-        center_mfov_num2 = centers_mfovs_nums2[i]
-        current_area.extend(BoundingBox.fromList(section2_mfov_bboxes[center_mfov_num2].toArray()))
-        print("Adding area {}: {}".format(i, section2_mfov_bboxes[center_mfov_num2].toArray()))
+    # (section2_mfov_bboxes is a BoundingBoxArray, where row i is the bounding box of mfov sorted_mfovs2[i])
+    mfovs_bbox_idx2 = {m: i for i, m in enumerate(sorted_mfovs2)}
+    centers_bboxes2 = section2_mfov_bboxes[[mfovs_bbox_idx2[m] for m in centers_mfovs_nums2]]
+    for i, center_mfov_bbox2 in enumerate(centers_bboxes2.toArray()):
+        print("Adding area {}: {}".format(i, center_mfov_bbox2))
+    current_area = centers_bboxes2.union()
     current_mfovs = set(centers_mfovs_nums2)
-    current_features_pts, current_features_resps, current_features_descs = np.array([]).reshape((0, 2)), [], []
-    for center_mfov_num2 in centers_mfovs_nums2:
-        print("loading features for mfov: {}".format(center_mfov_num2))
-        mfov_points, mfov_resps, mfov_descs = analyzemfov(indexed_ts2[center_mfov_num2], features_dir2)
-        current_features_pts = np.append(current_features_pts, mfov_points, axis=0)
-        current_features_resps.append(mfov_resps)
-        current_features_descs.append(mfov_descs)
+    # The order in which the mfovs features were added to the current features
+    current_mfovs_order = list(centers_mfovs_nums2)
+    print("loading features for mfovs: {}".format(current_mfovs_order))
+    # The matches are updated incrementally when the area expands (only the new mfovs' features are matched)
+    matcher = IncrementalCrossCheckMatcher(features_index1, mfovs_nums1, features_index2)
+    matcher.add_mfovs(current_mfovs_order)
     print("Features loaded")
-    current_features = (current_features_pts, np.concatenate(current_features_resps), np.vstack(current_features_descs))
 
     match_found = False
     match_iteration = 0
@@ -219,9 +431,12 @@ def iterative_search(actual_params, layer1, layer2, indexed_ts1, indexed_ts2, fe
     }
     while not match_found:
         match_iteration += 1
-        print("Iteration {}: using {} mfovs from section {} ({} features)".format(match_iteration, len(current_mfovs), layer2, len(current_features_pts)))
+        print("Iteration {}: using {} mfovs from section {} ({} features)".format(match_iteration, len(current_mfovs), layer2, len(matcher)))
         # Try to match the 3-mfovs features of section1 to the current features of section2
-        (model, num_filtered, filter_rate, num_rod, num_m1, num_m2) = compare_features(section1_pts_resps_descs, current_features, actual_params)
+        # (the RANSAC search starts from the best model that was found in the previous iterations)
+        # (or from the assumed model, on the first iteration)
+        initial_model = saved_model['model'] if saved_model['model'] is not None else assumed_model
+        (model, num_filtered, filter_rate, num_rod, num_m1, num_m2) = compare_features_incremental(matcher, actual_params, initial_model)
 
         if model is None:
             if saved_model['model'] is not None:
@@ -250,17 +465,17 @@ def iterative_search(actual_params, layer1, layer2, indexed_ts1, indexed_ts2, fe
                 # just use the best that was found, and no need to search more
                 break
 
-        if num_filtered > (actual_params["num_filtered_percent"] * len(all_points1) / len(mfovs_nums1)) and filter_rate > actual_params["filter_rate_cutoff"]:
+        if meets_match_thresholds(actual_params, num_filtered, filter_rate, len(all_points1), len(mfovs_nums1)):
             best_transform = model
             match_found = True
+        elif max_iterations is not None and match_iteration >= max_iterations:
+            print("Reached the maximal number of iterations ({}), stopping search".format(max_iterations))
+            break
         else:
             # Find the mfovs that are overlapping with the current area
             print("len(mfovs_nums1)", len(mfovs_nums1))
             print("threshold wasn't met: num_filtered: {} > {} and filter_rate: {} > {}".format(num_filtered, (actual_params["num_filtered_percent"] * len(all_points1) / len(mfovs_nums1)), filter_rate, actual_params["filter_rate_cutoff"]))
-            overlapping_mfovs = set()
-            for m in sorted_mfovs2:
-                if current_area.overlap(section2_mfov_bboxes[m]):
-                    overlapping_mfovs.add(m)
+            overlapping_mfovs = set(sorted_mfovs2[i] for i in section2_mfov_bboxes.query_overlapping(current_area))
 
             new_mfovs = overlapping_mfovs - current_mfovs
             if len(new_mfovs) == 0:
@@ -270,22 +485,20 @@ def iterative_search(actual_params, layer1, layer2, indexed_ts1, indexed_ts2, fe
 
             # Add the new mfovs features
             print("Adding {} mfovs ({}) to the second layer".format(len(new_mfovs), new_mfovs))
-            for m in new_mfovs:
-                mfov_points, mfov_resps, mfov_descs = analyzemfov(indexed_ts2[m], features_dir2)
-                current_features_pts = np.append(current_features_pts, mfov_points, axis=0)
-                current_features_resps.append(mfov_resps)
-                current_features_descs.append(mfov_descs)
+            new_mfovs_order = list(new_mfovs)
+            for m in new_mfovs_order:
+                current_mfovs_order.append(m)
 
                 # Expand the current area
-                current_area.extend(section2_mfov_bboxes[m])
-            print("Combining features")
-            current_features = (current_features_pts, np.concatenate(current_features_resps), np.vstack(current_features_descs))
+                current_area.extend(section2_mfov_bboxes[mfovs_bbox_idx2[m]])
+            print("Matching the new features")
+            matcher.add_mfovs(new_mfovs_order)
             current_mfovs = overlapping_mfovs
 
         if not is_initial_search and match_iteration == actual_params["max_attempts"]:
             print("Reached maximal number of attempts in iterative search, stopping search")
 
-    if best_transform is None and saved_model['model'] is not None:
+    if best_transform is None and saved_model['model'] is not None and not require_match:
         best_transform = saved_model['model']
         num_filtered = saved_model['num_filtered']
         filter_rate = saved_model['filter_rate']
@@ -298,28 +511,204 @@ def iterative_search(actual_params, layer1, layer2, indexed_ts1, indexed_ts2, fe
 
 
 
-def analyze_slices(tiles_fname1, tiles_fname2, features_dir1, features_dir2, actual_params):
-    # Read the tilespecs
-    ts1 = utils.load_tilespecs(tiles_fname1)
-    ts2 = utils.load_tilespecs(tiles_fname2)
-    indexed_ts1 = utils.index_tilespec(ts1)
-    indexed_ts2 = utils.index_tilespec(ts2)
-
-    num_mfovs1 = len(indexed_ts1)
-    num_mfovs2 = len(indexed_ts2)
-
-    sorted_mfovs1 = sorted(indexed_ts1.keys())
-    sorted_mfovs2 = sorted(indexed_ts2.keys())
-
-    layer1 = indexed_ts1.values()[0].values()[0]["layer"]
-    layer2 = indexed_ts2.values()[0].values()[0]["layer"]
-    to_ret = []
-    best_transform = None
-
-    # Get all the centers of each section
-    #print("Fetching sections centers")
-    centers1 = np.array([getcenter(indexed_ts1[m]) for m in sorted_mfovs1])
-    centers2 = np.array([getcenter(indexed_ts2[i]) for i in sorted_mfovs2])
+def search_mfov(i, features_index1, features_index2, actual_params, layer1, layer2, mfovs_models, centers1, centers2, section2_mfov_bboxes, sorted_mfovs1, sorted_mfovs2, max_iterations=None, require_match=False):
+    """Searches for the transformation between the i'th mfov (in sorted order) of section 1 and section 2, starting from
+       the estimated location of the mfov in section 2 (according to the mfov's assumed model in mfovs_models).
+       Returns the match entry of the mfov, or None if no transformation was found"""
+    best_transform = mfovs_models[sorted_mfovs1[i]]
+    best_transform_matrix = best_transform.get_matrix()
+    num_mfovs2 = len(sorted_mfovs2)
+    # Find the location of all mfovs in section 2 that "overlap" the current mfov from section 1
+    # (according to the estimated transform)
+    #section1_mfov_bbox = BoundingBox.read_bbox_from_ts(indexed_ts1[i + 1].values())
+    #print("section1_mfov_bbox: {}".format(section1_mfov_bbox))
+    #bbox_points = np.array([[section1_mfov_bbox.from_x, section1_mfov_bbox.from_y, 1.0],
+    #                        [section1_mfov_bbox.from_x, section1_mfov_bbox.to_y, 1.0],
+    #                        [section1_mfov_bbox.to_x, section1_mfov_bbox.from_y, 1.0],
+    #                        [section1_mfov_bbox.to_x, section1_mfov_bbox.to_y, 1.0]])
+    #bbox_points_projected = [np.dot(best_transform_matrix, p)[0:2] for p in bbox_points]
+    #projected_min_x, projected_min_y = np.min(bbox_points_projected, axis=0)
+    #projected_max_x, projected_max_y = np.max(bbox_points_projected, axis=0)
+    #projected_mfov_bbox = BoundingBox(projected_min_x, projected_max_x, projected_min_y, projected_max_y)
+    #print("projected_mfov_bbox: {}".format(projected_mfov_bbox))
+    #relevant_mfovs_nums2 = []
+    #for j, section2_mfov_bbox in enumerate(section2_mfov_bboxes):
+    #    if projected_mfov_bbox.overlap(section2_mfov_bbox):
+    #        relevant_mfovs_nums2.append(j + 1)
+
+    # Find the "location" of mfov i's center on section2
+    center1 = centers1[i]
+    center1_transformed = np.dot(best_transform_matrix, np.append(center1, [1]))[0:2]
+    distances = np.array([np.linalg.norm(center1_transformed - centers2[j]) for j in range(num_mfovs2)])
+    print("distances:", [str(x) + ":" + str(d) for x, d in enumerate(distances)])
+    relevant_mfovs_nums2 = [sorted_mfovs2[np.argsort(distances)[0]]]
+    print("Initial assumption Section {} mfov {} will match Section {} mfovs {}".format(layer1, sorted_mfovs1[i], layer2, relevant_mfovs_nums2))
+    # Do an iterative search of the mfov from section 1 to the "corresponding" mfov of section2
+    mfov_search_start_time = time.time()
+    mfov_transform, num_filtered, filter_rate, num_rod, num_m1, num_m2, match_iterations = iterative_search(actual_params, layer1, layer2, features_index1, features_index2,
+                         [sorted_mfovs1[i]], relevant_mfovs_nums2, section2_mfov_bboxes, sorted_mfovs2, assumed_model=best_transform, is_initial_search=False, point1=center1,
+                         max_iterations=max_iterations, require_match=require_match)
+    mfov_search_end_time = time.time()
+    if mfov_transform is None:
+        # Could not find a transformation for the given mfov
+        print("Could not find a transformation between Section {} mfov {}, to Section {} (after {} seconds), skipping the mfov".format(layer1, sorted_mfovs1[i], layer2, mfov_search_end_time - mfov_search_start_time))
+        return None
+    else:
+        print("Found a transformation between section {} mfov {} to section {} (filtered matches#: {}, rate: {}), with model: {}".format(layer1, sorted_mfovs1[i], layer2, num_filtered, filter_rate, mfov_transform.get_matrix()))
+        #best_transform_matrix = mfov_transform.get_matrix()
+        dictentry = {}
+        dictentry['mfov1'] = sorted_mfovs1[i]
+        dictentry['section2_center'] = center1_transformed.tolist()
+        #dictentry['mfov2'] = checkindices[j] + 1
+        dictentry['features_in_mfov1'] = num_m1
+        #dictentry['features_in_mfov2'] = num_m2
+        dictentry['transformation'] = {
+            "className": mfov_transform.class_name,
+            "matrix": mfov_transform.get_matrix().tolist()
+        }
+        dictentry['matches_rod'] = num_rod
+        dictentry['matches_model'] = num_filtered
+        dictentry['filter_rate'] = filter_rate
+        dictentry['mfov_search_time'] = mfov_search_end_time - mfov_search_start_time
+        dictentry['mfov_iterations_num'] = match_iterations
+        return dictentry
+
+
+# The state of a per-mfov search worker process (set by _init_search_mfov_worker)
+_search_mfov_worker_state = {}
+
+def _init_search_mfov_worker(shared_features1, shared_features2, search_args):
+    # Each worker uses a single thread, and a different random state (for the RANSAC sampling)
+    cv2.setNumThreads(1)
+    np.random.seed()
+    _search_mfov_worker_state['features_index1'] = shared_features1.features_index()
+    _search_mfov_worker_state['features_index2'] = shared_features2.features_index()
+    _search_mfov_worker_state['search_args'] = search_args
+
+def _search_mfov_worker(i):
+    return search_mfov(i, _search_mfov_worker_state['features_index1'], _search_mfov_worker_state['features_index2'],
+                       *_search_mfov_worker_state['search_args'])
+
+
+def run_mfovs_searches(mfovs_idxs, features_index1, features_index2, search_args, processes_num=1, shared_features=None):
+    """Runs search_mfov on each of the given section 1 mfovs indices, and returns a dictionary between an mfov index and
+       its search result. If processes_num > 1, the searches run in a pool of processes that use the given shared features
+       (a pair of SharedSectionFeatures)"""
+    if processes_num <= 1:
+        return {i: search_mfov(i, features_index1, features_index2, *search_args) for i in mfovs_idxs}
+    print("Searching the mfovs transformations with {} processes".format(processes_num))
+    pool = mp.Pool(processes=processes_num, initializer=_init_search_mfov_worker,
+                   initargs=(shared_features[0], shared_features[1], search_args))
+    try:
+        # map returns the results in the mfovs order (regardless of the order the searches end)
+        mfovs_results = pool.map(_search_mfov_worker, mfovs_idxs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(mfovs_idxs, mfovs_results))
+
+
+def find_mfovs_neighbors(centers, max_distance_factor):
+    """Returns a list of the neighbors (indices) of each mfov, that is the mfovs whose centers are closer than
+       max_distance_factor times the median distance between an mfov center and the center closest to it"""
+    if len(centers) < 2:
+        return [[] for _ in centers]
+    centers_tree = cKDTree(centers)
+    closest_dists, _ = centers_tree.query(centers, k=2)
+    max_dist = max_distance_factor * np.median(closest_dists[:, 1])
+    return [sorted(j for j in centers_tree.query_ball_point(center, max_dist) if j != i) for i, center in enumerate(centers)]
+
+
+def propagated_mfovs_searches(mfovs_idxs, solved_results, default_model, features_index1, features_index2, actual_params, layer1, layer2,
+                              centers1, centers2, section2_mfov_bboxes, sorted_mfovs1, sorted_mfovs2, processes_num=1, shared_features=None):
+    """Searches for the transformations of the given section 1 mfovs in a breadth-first order (starting from the already solved
+       mfovs in solved_results, or from the mfov closest to the section center). The search of each mfov starts from the
+       location predicted by the model of its closest solved neighbor, is limited to a few iterations around that location,
+       and only accepts a model that meets the thresholds. The mfovs of each breadth-first level are searched together.
+       The propagation stops when no pending mfov is a neighbor of a newly solved mfov (the remaining mfovs are left to
+       the regular search), and the mfov closest to the section center is only used as a (single) starting point if
+       there are no solved mfovs at all.
+       Returns a dictionary between an mfov index and its search result (None for mfovs that were not solved)"""
+    neighbors = find_mfovs_neighbors(centers1, actual_params["propagation_neighbor_distance"])
+    section_center1 = np.mean(centers1, axis=0)
+    solved_models = {i: model_from_matrix(r["transformation"]["matrix"]) for i, r in solved_results.items() if r is not None}
+    pending_idxs = set(mfovs_idxs)
+    results = {}
+    frontier = sorted(set(j for i in solved_models for j in neighbors[i]) & pending_idxs)
+    seeded = False
+    while len(pending_idxs) > 0:
+        if len(frontier) == 0:
+            if seeded or len(solved_models) > 0:
+                break
+            seeded = True
+            # Start from the pending mfov closest to the section center (there are no solved mfovs yet)
+            frontier = [min(pending_idxs, key=lambda i: np.linalg.norm(centers1[i] - section_center1))]
+        mfovs_models = {}
+        for i in frontier:
+            solved_neighbors = [j for j in neighbors[i] if j in solved_models]
+            if len(solved_neighbors) == 0:
+                mfovs_models[sorted_mfovs1[i]] = default_model
+            else:
+                closest_neighbor = min(solved_neighbors, key=lambda j: np.linalg.norm(centers1[j] - centers1[i]))
+                mfovs_models[sorted_mfovs1[i]] = solved_models[closest_neighbor]
+        print("Searching {} mfovs using their neighbors models".format(len(frontier)))
+        search_args = (actual_params, layer1, layer2, mfovs_models, centers1, centers2, section2_mfov_bboxes, sorted_mfovs1, sorted_mfovs2,
+                       actual_params["propagation_max_iterations"], True)
+        # (a single mfov is searched without a pool of processes)
+        level_results = run_mfovs_searches(frontier, features_index1, features_index2, search_args, processes_num if len(frontier) > 1 else 1, shared_features)
+        results.update(level_results)
+        pending_idxs -= set(frontier)
+        for i, r in level_results.items():
+            if r is not None:
+                solved_models[i] = model_from_matrix(r["transformation"]["matrix"])
+        frontier = sorted(set(j for i in frontier if level_results[i] is not None for j in neighbors[i]) & pending_idxs)
+    results.update({i: None for i in pending_idxs})
+    return results
+
+
+def model_from_matrix(matrix):
+    """Returns an affine model of the given 3x3 matrix"""
+    return models.Transforms.from_tilespec({
+        "className": "mpicbg.trakem2.transform.AffineModel2D",
+        "dataString": "{} {} {} {} {} {}".format(matrix[0][0], matrix[1][0], matrix[0][1], matrix[1][1], matrix[0][2], matrix[1][2])
+    })
+
+
+def compose_pre_matches(pre_match_fname1, pre_match_fname2):
+    """Given the pre-matches of sections (A, B) and of sections (B, C), returns a dictionary between each matched mfov of
+       section A and an estimate (a 3x3 matrix) of its transformation to section C, that is the composition of the mfov's
+       transformation to section B and the transformation of the section B mfov that is closest to the mfov's location
+       in section B. Returns an empty dictionary if one of the pre-matches files is missing (e.g., no match was found)"""
+    if not os.path.exists(pre_match_fname1) or not os.path.exists(pre_match_fname2):
+        print("Pre-matches file {} or {} is missing, cannot compose their transformations".format(pre_match_fname1, pre_match_fname2))
+        return {}
+    with open(pre_match_fname1, 'r') as f:
+        pre_matches1 = json.load(f)
+    with open(pre_match_fname2, 'r') as f:
+        pre_matches2 = json.load(f)
+    if os.path.abspath(pre_matches1["tilespec2"]) != os.path.abspath(pre_matches2["tilespec1"]):
+        print("Pre-matches files {} and {} don't share a section, cannot compose their transformations".format(pre_match_fname1, pre_match_fname2))
+        return {}
+    if len(pre_matches2["matches"]) == 0:
+        return {}
+
+    # The centers of the section B mfovs that have a transformation to section C
+    mfov_centers_b = TileCollection.from_file(pre_matches2["tilespec1"]).mfov_centers()
+    centers_b = np.array([mfov_centers_b[m["mfov1"]] for m in pre_matches2["matches"]])
+    transforms_b = [np.array(m["transformation"]["matrix"]) for m in pre_matches2["matches"]]
+
+    estimates = {}
+    for m in pre_matches1["matches"]:
+        closest_idx = np.argmin(np.linalg.norm(centers_b - np.array(m["section2_center"]), axis=1))
+        estimates[m["mfov1"]] = np.dot(transforms_b[closest_idx], np.array(m["transformation"]["matrix"]))
+    return estimates
+
+
+def initial_section_search(actual_params, layer1, layer2, tiles_fname1, tiles_fname2, ts1, ts2, features_index1, features_index2,
+                           centers1, centers2, sorted_mfovs1, sorted_mfovs2, section2_mfov_bboxes):
+    """Finds a preliminary transformation between the sections, by an iterative search of the mfovs closest to the center of
+       section 1 in section 2. Returns the transformation (or None), the number of iterations and the search time"""
+    num_mfovs1 = len(sorted_mfovs1)
 
     # Take the mfov closest to the middle of each section
     section_center1 = np.mean(centers1, axis=0)
@@ -327,95 +716,144 @@ def analyze_slices(tiles_fname1, tiles_fname2, features_dir1, features_dir2, act
     CLOSEST_MFOVS1_NUM = 3
     # Find the closest mfovs to the center of section 1
     if num_mfovs1 <= CLOSEST_MFOVS1_NUM:
-        closest_mfovs_nums1 = indexed_ts1.keys()
+        closest_mfovs_nums1 = list(sorted_mfovs1)
     else:
         closest_mfovs_nums1 = np.argpartition([((c[0] - section_center1[0])**2 + (c[1] - section_center1[1])**2) for c in centers1], CLOSEST_MFOVS1_NUM)[:CLOSEST_MFOVS1_NUM]
         closest_mfovs_nums1 = [sorted_mfovs1[n] for n in closest_mfovs_nums1]
     # Find the closest mfov to the center of section 2
     centers_mfovs_nums2 = [np.argmin([((c[0] - section_center2[0])**2 + (c[1] - section_center2[1])**2) for c in centers2])]
     centers_mfovs_nums2 = [sorted_mfovs2[n] for n in centers_mfovs_nums2]
-    
-    # Compute per-mfov bounding box for the 2nd section
-    section2_mfov_bboxes = {m: BoundingBox.read_bbox_from_ts(indexed_ts2[m].values()) for m in sorted_mfovs2}
+
+    # Estimate the transformation between the sections using their low resolution renderings
+    global_transform = None
+    if actual_params["global_registration"]:
+        global_registration_start_time = time.time()
+        global_transform, response = global_registration.register_sections(tiles_fname1, tiles_fname2, actual_params["global_registration_scale"], ts1, ts2)
+        print("Global registration between sections {} and {} found model: {} (response: {}) in {} seconds".format(layer1, layer2, global_transform.get_matrix(), response, time.time() - global_registration_start_time))
+        if response < actual_params["global_registration_min_response"]:
+            print("Global registration response is too low, ignoring its model")
+            global_transform = None
+        else:
+            # Start the search in section 2 from the estimated location of the section 1 mfovs
+            closest_centers1 = np.mean([centers1[sorted_mfovs1.index(m)] for m in closest_mfovs_nums1], axis=0)
+            closest_centers1_transformed = np.dot(global_transform.get_matrix(), np.append(closest_centers1, [1]))[0:2]
+            centers_mfovs_nums2 = [sorted_mfovs2[np.argmin(np.linalg.norm(centers2 - closest_centers1_transformed, axis=1))]]
 
     print("Comparing Sec{} (mfovs: {}) and Sec{} (starting from mfovs: {})".format(layer1, closest_mfovs_nums1, layer2, centers_mfovs_nums2))
     initial_search_start_time = time.time()
     # Do an iterative search of the mfovs closest to the center of section 1 to the mfovs of section2 (starting from the center)
-    best_transform, num_filtered, filter_rate, _, _, _, initial_search_iters_num = iterative_search(actual_params, layer1, layer2, indexed_ts1, indexed_ts2,
-                         features_dir1, features_dir2, closest_mfovs_nums1, centers_mfovs_nums2, section2_mfov_bboxes, sorted_mfovs2, is_initial_search=True)
+    best_transform, num_filtered, filter_rate, _, _, _, initial_search_iters_num = iterative_search(actual_params, layer1, layer2, features_index1, features_index2,
+                         closest_mfovs_nums1, centers_mfovs_nums2, section2_mfov_bboxes, sorted_mfovs2, is_initial_search=True)
     initial_search_end_time = time.time()
 
+    if best_transform is None and global_transform is not None:
+        print("Could not find a preliminary transform between sections: {} and {} using the features, using the global registration model".format(layer1, layer2))
+        best_transform = global_transform
+        num_filtered = 0
+        filter_rate = 0
 
-    
     if best_transform is None:
         print("Could not find a preliminary transform between sections: {} and {}, after {} seconds.".format(layer1, layer2, initial_search_end_time - initial_search_start_time))
-        return to_ret, initial_search_iters_num, initial_search_end_time - initial_search_start_time
+    else:
+        print("Found a preliminary transform between sections: {} and {} (filtered matches#: {}, rate: {}), with model: {} in {} seconds, and {} iterations".format(layer1, layer2, num_filtered, filter_rate, best_transform.get_matrix(), initial_search_end_time - initial_search_start_time, initial_search_iters_num))
+    return best_transform, initial_search_iters_num, initial_search_end_time - initial_search_start_time
 
-    best_transform_matrix = best_transform.get_matrix()
-    print("Found a preliminary transform between sections: {} and {} (filtered matches#: {}, rate: {}), with model: {} in {} seconds, and {} iterations".format(layer1, layer2, num_filtered, filter_rate, best_transform_matrix, initial_search_end_time - initial_search_start_time, initial_search_iters_num))
-
-
-    # Iterate throught the mfovs of section1, and try to find
-    # for each mfov the transformation to section 2
-    # (do an iterative search as was done in the previous phase)
-    for i in range(0, num_mfovs1):
-        # Find the location of all mfovs in section 2 that "overlap" the current mfov from section 1
-        # (according to the estimated transform)
-        #section1_mfov_bbox = BoundingBox.read_bbox_from_ts(indexed_ts1[i + 1].values())
-        #print("section1_mfov_bbox: {}".format(section1_mfov_bbox))
-        #bbox_points = np.array([[section1_mfov_bbox.from_x, section1_mfov_bbox.from_y, 1.0],
-        #                        [section1_mfov_bbox.from_x, section1_mfov_bbox.to_y, 1.0],
-        #                        [section1_mfov_bbox.to_x, section1_mfov_bbox.from_y, 1.0],
-        #                        [section1_mfov_bbox.to_x, section1_mfov_bbox.to_y, 1.0]])
-        #bbox_points_projected = [np.dot(best_transform_matrix, p)[0:2] for p in bbox_points]
-        #projected_min_x, projected_min_y = np.min(bbox_points_projected, axis=0)
-        #projected_max_x, projected_max_y = np.max(bbox_points_projected, axis=0)
-        #projected_mfov_bbox = BoundingBox(projected_min_x, projected_max_x, projected_min_y, projected_max_y)
-        #print("projected_mfov_bbox: {}".format(projected_mfov_bbox))
-        #relevant_mfovs_nums2 = []
-        #for j, section2_mfov_bbox in enumerate(section2_mfov_bboxes):
-        #    if projected_mfov_bbox.overlap(section2_mfov_bbox):
-        #        relevant_mfovs_nums2.append(j + 1)
-
-        # Find the "location" of mfov i's center on section2
-        center1 = centers1[i]
-        center1_transformed = np.dot(best_transform_matrix, np.append(center1, [1]))[0:2]
-        distances = np.array([np.linalg.norm(center1_transformed - centers2[j]) for j in range(num_mfovs2)])
-        print("distances:", [str(x) + ":" + str(d) for x, d in enumerate(distances)])
-        relevant_mfovs_nums2 = [sorted_mfovs2[np.argsort(distances)[0]]]
-        print("Initial assumption Section {} mfov {} will match Section {} mfovs {}".format(layer1, sorted_mfovs1[i], layer2, relevant_mfovs_nums2))
-        # Do an iterative search of the mfov from section 1 to the "corresponding" mfov of section2
-        mfov_search_start_time = time.time()
-        mfov_transform, num_filtered, filter_rate, num_rod, num_m1, num_m2, match_iterations = iterative_search(actual_params, layer1, layer2, indexed_ts1, indexed_ts2,
-                             features_dir1, features_dir2, [sorted_mfovs1[i]], relevant_mfovs_nums2, section2_mfov_bboxes, sorted_mfovs2, assumed_model=best_transform, is_initial_search=False, point1=center1)
-        mfov_search_end_time = time.time()
-        if mfov_transform is None:
-            # Could not find a transformation for the given mfov
-            print("Could not find a transformation between Section {} mfov {}, to Section {} (after {} seconds), skipping the mfov".format(layer1, sorted_mfovs1[i], layer2, mfov_search_end_time - mfov_search_start_time))
-        else:
-            print("Found a transformation between section {} mfov {} to section {} (filtered matches#: {}, rate: {}), with model: {}".format(layer1, sorted_mfovs1[i], layer2, num_filtered, filter_rate, mfov_transform.get_matrix()))
-            #best_transform_matrix = mfov_transform.get_matrix()
-            dictentry = {}
-            dictentry['mfov1'] = sorted_mfovs1[i]
-            dictentry['section2_center'] = center1_transformed.tolist()
-            #dictentry['mfov2'] = checkindices[j] + 1
-            dictentry['features_in_mfov1'] = num_m1
-            #dictentry['features_in_mfov2'] = num_m2
-            dictentry['transformation'] = {
-                "className": mfov_transform.class_name,
-                "matrix": mfov_transform.get_matrix().tolist()
-            }
-            dictentry['matches_rod'] = num_rod
-            dictentry['matches_model'] = num_filtered
-            dictentry['filter_rate'] = filter_rate
-            dictentry['mfov_search_time'] = mfov_search_end_time - mfov_search_start_time
-            dictentry['mfov_iterations_num'] = match_iterations
-            to_ret.append(dictentry)
-
-
-    return to_ret, initial_search_iters_num, initial_search_end_time - initial_search_start_time
-
-def match_layers_sift_features(tiles_fname1, features_dir1, tiles_fname2, features_dir2, out_fname, conf_fname=None):
+
+def analyze_slices(tiles_fname1, tiles_fname2, features_dir1, features_dir2, actual_params, processes_num=1, initial_transforms=None):
+    """Finds the transformation of each section 1 mfov to section 2. If initial_transforms (a dictionary between a section 1
+       mfov and an estimated 3x3 transformation matrix) is given, the estimates are verified first, and only the mfovs
+       that could not be verified are searched for"""
+    # Read the tilespecs
+    ts1 = utils.load_tilespecs(tiles_fname1)
+    ts2 = utils.load_tilespecs(tiles_fname2)
+    indexed_ts1 = utils.index_tilespec(ts1)
+    indexed_ts2 = utils.index_tilespec(ts2)
+
+    num_mfovs1 = len(indexed_ts1)
+
+    sorted_mfovs1 = sorted(indexed_ts1.keys())
+    sorted_mfovs2 = sorted(indexed_ts2.keys())
+
+    layer1 = indexed_ts1.values()[0].values()[0]["layer"]
+    layer2 = indexed_ts2.values()[0].values()[0]["layer"]
+
+    # Get all the centers of each section
+    #print("Fetching sections centers")
+    centers1 = np.array([getcenter(indexed_ts1[m]) for m in sorted_mfovs1])
+    centers2 = np.array([getcenter(indexed_ts2[i]) for i in sorted_mfovs2])
+
+    # The features of each mfov are loaded once, and kept in memory for all the searches
+    # (and the nearest neighbors index of each mfov is built, or loaded, once)
+    ann_params = None
+    if actual_params["ann_index"]:
+        ann_params = {"trees": actual_params["ann_trees"], "checks": actual_params["ann_checks"]}
+    features_index1 = SectionFeaturesIndex(indexed_ts1, features_dir1, ann_params)
+    features_index2 = SectionFeaturesIndex(indexed_ts2, features_dir2, ann_params)
+    shared_features = None
+    if processes_num > 1:
+        # Load all the features before the worker processes are forked, and keep them in shared memory,
+        # so the workers don't need to load them
+        print("Loading all mfovs features of both sections")
+        shared_features = (SharedSectionFeatures(features_index1, sorted_mfovs1), SharedSectionFeatures(features_index2, sorted_mfovs2))
+        # (and use the shared features in this process as well, so the loaded copies can be freed)
+        features_index1 = shared_features[0].features_index()
+        features_index2 = shared_features[1].features_index()
+
+    # Compute per-mfov bounding box for the 2nd section
+    section2_mfov_bboxes = BoundingBoxArray.fromBoundingBoxes([BoundingBox.read_bbox_from_ts(indexed_ts2[m].values()) for m in sorted_mfovs2])
+
+    mfovs_results = {}
+    search_mfovs_idxs = list(range(num_mfovs1))
+    initial_search_iters_num = 0
+    initial_search_time = 0
+
+    initial_models = {m: model_from_matrix(t) for m, t in (initial_transforms or {}).items() if m in indexed_ts1}
+    if len(initial_models) > 0:
+        # Verify the given estimates of the mfovs transformations with a single localized match for each mfov,
+        # and only search (from the section's preliminary transformation) for the mfovs that were not verified
+        mfovs_models = {}
+        estimated_mfovs = sorted(initial_models.keys())
+        estimated_centers1 = np.array([centers1[sorted_mfovs1.index(m)] for m in estimated_mfovs])
+        for i, mfov in enumerate(sorted_mfovs1):
+            # mfovs w/o an estimate use the estimate of the closest mfov that has one
+            closest_mfov = estimated_mfovs[np.argmin(np.linalg.norm(estimated_centers1 - centers1[i], axis=1))]
+            mfovs_models[mfov] = initial_models[closest_mfov]
+        print("Verifying the estimated transformations of Sec{} mfovs to Sec{}".format(layer1, layer2))
+        search_args = (actual_params, layer1, layer2, mfovs_models, centers1, centers2, section2_mfov_bboxes, sorted_mfovs1, sorted_mfovs2, 1, True)
+        mfovs_results.update(run_mfovs_searches(search_mfovs_idxs, features_index1, features_index2, search_args, processes_num, shared_features))
+        search_mfovs_idxs = [i for i in search_mfovs_idxs if mfovs_results[i] is None]
+        print("Verified the estimated transformations of {} out of {} mfovs".format(num_mfovs1 - len(search_mfovs_idxs), num_mfovs1))
+
+    if len(search_mfovs_idxs) > 0:
+        best_transform, initial_search_iters_num, initial_search_time = initial_section_search(
+            actual_params, layer1, layer2, tiles_fname1, tiles_fname2, ts1, ts2, features_index1, features_index2,
+            centers1, centers2, sorted_mfovs1, sorted_mfovs2, section2_mfov_bboxes)
+
+        if best_transform is not None and actual_params["neighbor_propagation"]:
+            # Search the mfovs starting from the models of their solved neighbors, and only use the regular search
+            # for the mfovs that were not solved this way
+            mfovs_results.update(propagated_mfovs_searches(search_mfovs_idxs, mfovs_results, best_transform, features_index1, features_index2,
+                                                           actual_params, layer1, layer2, centers1, centers2, section2_mfov_bboxes,
+                                                           sorted_mfovs1, sorted_mfovs2, processes_num, shared_features))
+            print("Found the transformations of {} out of {} mfovs using the neighbors models".format(
+                len([i for i in search_mfovs_idxs if mfovs_results[i] is not None]), len(search_mfovs_idxs)))
+            search_mfovs_idxs = [i for i in search_mfovs_idxs if mfovs_results[i] is None]
+
+        if best_transform is not None and len(search_mfovs_idxs) > 0:
+            # Iterate throught the mfovs of section1, and try to find
+            # for each mfov the transformation to section 2
+            # (do an iterative search as was done in the previous phase)
+            mfovs_models = {m: best_transform for m in sorted_mfovs1}
+            search_args = (actual_params, layer1, layer2, mfovs_models, centers1, centers2, section2_mfov_bboxes, sorted_mfovs1, sorted_mfovs2)
+            mfovs_results.update(run_mfovs_searches(search_mfovs_idxs, features_index1, features_index2, search_args, processes_num, shared_features))
+
+    to_ret = [mfovs_results[i] for i in range(num_mfovs1) if mfovs_results.get(i) is not None]
+
+    return to_ret, initial_search_iters_num, initial_search_time
+
+def match_layers_sift_features(tiles_fname1, features_dir1, tiles_fname2, features_dir2, out_fname, conf_fname=None, processes_num=1, initial_pre_matches_fnames=None):
+    """Matches the mfovs of the two sections. If initial_pre_matches_fnames (the pre-matches files of sections (1, X) and
+       (X, 2)) are given, the composition of their transformations is used as the initial estimate of each mfov"""
     params = utils.conf_from_file(conf_fname, 'MatchLayersSiftFeaturesAndFilter')
     if params is None:
         params = {}
@@ -427,6 +865,22 @@ def match_layers_sift_features(tiles_fname1, features_dir1, tiles_fname2, featur
     actual_params["ROD_cutoff"] = params.get("ROD_cutoff", 0.92)
     actual_params["min_features_num"] = params.get("min_features_num", 40)
 
+    # Parameters for the breadth-first search of the mfovs (starting from the models of their neighbors)
+    actual_params["neighbor_propagation"] = params.get("neighbor_propagation", False)
+    actual_params["propagation_max_iterations"] = params.get("propagation_max_iterations", 2)
+    actual_params["propagation_neighbor_distance"] = params.get("propagation_neighbor_distance", 1.5)
+
+    # Parameters for the (approximate) nearest neighbors index of the features (by default, the nearest neighbors are
+    # found by an exact brute-force search)
+    actual_params["ann_index"] = params.get("ann_index", False)
+    actual_params["ann_trees"] = params.get("ann_trees", 4)
+    actual_params["ann_checks"] = params.get("ann_checks", 64)
+
+    # Parameters for the global (low resolution) registration of the sections
+    actual_params["global_registration"] = params.get("global_registration", False)
+    actual_params["global_registration_scale"] = params.get("global_registration_scale", 0.02)
+    actual_params["global_registration_min_response"] = params.get("global_registration_min_response", 0.05)
+
     # Parameters for the RANSAC
     actual_params["model_index"] = params.get("model_index", 1)
     actual_params["iterations"] = params.get("iterations", 500)
@@ -443,21 +897,27 @@ def match_layers_sift_features(tiles_fname1, features_dir1, tiles_fname2, featur
 
     starttime = time.time()
 
+    initial_transforms = None
+    if initial_pre_matches_fnames is not None:
+        initial_transforms = compose_pre_matches(*initial_pre_matches_fnames)
+        print("Composed {} initial mfovs transformations from: {}".format(len(initial_transforms), initial_pre_matches_fnames))
+
     # Match the two sections
-    retval, initial_search_iters_num, initial_search_time = analyze_slices(tiles_fname1, tiles_fname2, features_dir1, features_dir2, actual_params)
+    retval, initial_search_iters_num, initial_search_time = analyze_slices(tiles_fname1, tiles_fname2, features_dir1, features_dir2, actual_params, processes_num, initial_transforms)
 
+    # The output is saved even if no match was found (with an empty matches list), so the jobs that depend on it (e.g.,
+    # the pre-matches of farther layers that start from its transformations) don't wait for it forever
     if len(retval) == 0:
-        print("Could not find a match, avoiding any output to: {}".format(out_fname))
-    else:
-        # Save the output
-        jsonfile = {}
-        jsonfile['tilespec1'] = tiles_fname1
-        jsonfile['tilespec2'] = tiles_fname2
-        jsonfile['matches'] = retval
-        jsonfile['runtime'] = time.time() - starttime
-        jsonfile['initial_search_iterations_num'] = initial_search_iters_num
-        jsonfile['initial_search_time'] = initial_search_time
-        with open(out_fname, 'w') as out:
+        print("Could not find a match, saving an empty matches list to: {}".format(out_fname))
+    jsonfile = {}
+    jsonfile['tilespec1'] = tiles_fname1
+    jsonfile['tilespec2'] = tiles_fname2
+    jsonfile['matches'] = retval
+    jsonfile['runtime'] = time.time() - starttime
+    jsonfile['initial_search_iterations_num'] = initial_search_iters_num
+    jsonfile['initial_search_time'] = initial_search_time
+    with utils.atomic_output_file(out_fname) as tmp_fname:
+        with open(tmp_fname, 'w') as out:
             json.dump(jsonfile, out, indent=4)
 
     print("Done.")
@@ -481,12 +941,20 @@ def main():
     parser.add_argument('-c', '--conf_file_name', type=str,
                         help='the configuration file with the parameters for each step of the alignment process in json format (uses default parameters, if not supplied)',
                         default=None)
+    parser.add_argument('-t', '--threads_num', type=int,
+                        help='the number of processes to use for the per-mfov matching (default: 1)',
+                        default=1)
+    parser.add_argument('-i', '--initial_pre_matches', type=str, nargs=2, metavar=('pre_matches1', 'pre_matches2'),
+                        help='the pre-matches files of the first section to an intermediate section, and of the intermediate section to the second section, '
+                             'whose composed transformations are verified before searching (default: search all mfovs)',
+                        default=None)
 
     args = parser.parse_args()
 
     match_layers_sift_features(args.tiles_file1, args.features_dir1,
                                args.tiles_file2, args.features_dir2, args.output_file,
-                               conf_fname=args.conf_file_name)
+                               conf_fname=args.conf_file_name, processes_num=args.threads_num,
+                               initial_pre_matches_fnames=args.initial_pre_matches)
 
 
 if __name__ == '__main__':
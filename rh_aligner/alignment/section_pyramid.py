@@ -0,0 +1,190 @@
+# A persistent multi-resolution pyramid of a (montaged) section's rendering.
+# Each section is rendered once, where level k of the pyramid is the whole section rendered at base_scale / 2**k,
+# and each level is saved as an npy file that is memory mapped when it is read, so a sub-image (addressed by its level
+# and bbox) is read from the disk without loading (or rendering) the whole section.
+# The pyramid of a section is kept in a directory (named after its tilespec file) in a cache directory, and is
+# validated by the tilespec file's size and mtime.
+
+from __future__ import print_function
+import os
+import math
+import json
+import numpy as np
+import cv2
+from ..common import utils
+from ..common.tile_collection import TileCollection
+from rh_renderer.tilespec_affine_renderer import TilespecAffineRenderer
+
+
+PYRAMID_META_FNAME = 'pyramid.json'
+
+
+class SectionPyramid(object):
+    """The levels of a rendered section pyramid (in a pyramid directory). Level k is the section rendered at scales[k],
+       where its pixel (0, 0) is the pixel start_points[k] of the scaled section"""
+
+    def __init__(self, pyramid_dir, meta):
+        self.pyramid_dir = pyramid_dir
+        self.bbox = meta["bbox"]
+        self.scales = meta["scales"]
+        self.start_points = [tuple(start_point) for start_point in meta["start_points"]]
+        self._levels = {}
+
+    def level(self, level_idx):
+        """Returns the (read-only memory mapped) image of the given level"""
+        if level_idx not in self._levels:
+            self._levels[level_idx] = np.load(_level_fname(self.pyramid_dir, level_idx), mmap_mode='r')
+        return self._levels[level_idx]
+
+    def level_index(self, scale):
+        """Returns the index of the level that is rendered at the given scale (or None if there is no such level)"""
+        for level_idx, level_scale in enumerate(self.scales):
+            if np.isclose(level_scale, scale):
+                return level_idx
+        return None
+
+    def crop(self, level_idx, from_x, from_y, to_x, to_y):
+        """Returns the pixels [floor(from), floor(to)] (inclusive, in the level's scaled section coordinates) of the
+           given level, and the start point of the returned image (the returned image is clipped to the level's image,
+           and None is returned if it is empty)"""
+        image = self.level(level_idx)
+        start_x, start_y = self.start_points[level_idx]
+        from_x, from_y = max(int(math.floor(from_x)), start_x), max(int(math.floor(from_y)), start_y)
+        to_x, to_y = min(int(math.floor(to_x)), start_x + image.shape[1] - 1), min(int(math.floor(to_y)), start_y + image.shape[0] - 1)
+        if from_x > to_x or from_y > to_y:
+            return None, (from_x, from_y)
+        return image[from_y - start_y:to_y - start_y + 1, from_x - start_x:to_x - start_x + 1], (from_x, from_y)
+
+
+def section_pyramid_dir(cache_dir, tiles_fname):
+    """Returns the directory of the given section's pyramid in the cache directory"""
+    base_name = os.path.basename(tiles_fname.replace('file://', ''))
+    if base_name.endswith('.json'):
+        base_name = base_name[:-len('.json')]
+    return os.path.join(cache_dir, base_name)
+
+
+def _level_fname(pyramid_dir, level_idx):
+    return os.path.join(pyramid_dir, 'level_{}.npy'.format(level_idx))
+
+
+def load_section_pyramid(cache_dir, tiles_fname):
+    """Returns the SectionPyramid of the given section tilespec file from the cache directory, or None if the section
+       was not rendered to the cache directory (or if its tilespec file was changed since it was rendered)"""
+    tiles_fname = tiles_fname.replace('file://', '')
+    pyramid_dir = section_pyramid_dir(cache_dir, tiles_fname)
+    try:
+        with open(os.path.join(pyramid_dir, PYRAMID_META_FNAME), 'r') as meta_file:
+            meta = json.load(meta_file)
+        if tuple(meta["key"]) != tuple(float(v) for v in utils.file_cache_key(tiles_fname)):
+            return None
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    return SectionPyramid(pyramid_dir, meta)
+
+
+def _place(dst, dst_start_point, src, src_start_point):
+    """Copies the overlapping part of the src image (that starts at src_start_point) to the dst image"""
+    off_x, off_y = int(src_start_point[0]) - dst_start_point[0], int(src_start_point[1]) - dst_start_point[1]
+    dst_view = dst[max(0, off_y):off_y + src.shape[0], max(0, off_x):off_x + src.shape[1]]
+    dst_view[...] = src[max(0, -off_y):max(0, -off_y) + dst_view.shape[0], max(0, -off_x):max(0, -off_x) + dst_view.shape[1]]
+
+
+def render_strips(renderer, start_point, image, strip_height=2048):
+    """Renders the pixels of the given renderer that start at start_point into the given image (e.g., a memory mapped
+       array), in horizontal strips (of strip_height pixels), so the whole image is never rendered in memory"""
+    end_x = start_point[0] + image.shape[1] - 1
+    end_y = start_point[1] + image.shape[0] - 1
+    for strip_from_y in range(start_point[1], end_y + 1, strip_height):
+        strip_to_y = min(strip_from_y + strip_height - 1, end_y)
+        rendered, rendered_start_point = renderer.crop(start_point[0], strip_from_y, end_x, strip_to_y)
+        if rendered is not None:
+            _place(image[strip_from_y - start_point[1]:strip_to_y - start_point[1] + 1], (start_point[0], strip_from_y), rendered, rendered_start_point)
+
+
+def render_section_pyramid(tiles_fname, cache_dir, base_scale=0.2, levels_num=4, strip_height=2048, tilespecs=None):
+    """Renders the given section into a pyramid (of levels_num levels, where level k is at base_scale / 2**k) in the
+       cache directory, and returns the SectionPyramid. The first level is rendered in horizontal strips (of
+       strip_height pixels), and each of the other levels is downsampled (by 2) from the previous level, so the whole
+       section is never held in memory. If the section's pyramid is already in the cache directory, it is not rendered again"""
+    tiles_fname = tiles_fname.replace('file://', '')
+    pyramid = load_section_pyramid(cache_dir, tiles_fname)
+    if pyramid is not None and len(pyramid.scales) >= levels_num and np.isclose(pyramid.scales[0], base_scale):
+        return pyramid
+
+    cache_key = tuple(float(v) for v in utils.file_cache_key(tiles_fname))
+    if tilespecs is None:
+        tilespecs = utils.load_tilespecs(tiles_fname)
+    bbox = TileCollection(tilespecs).bbox()
+
+    pyramid_dir = section_pyramid_dir(cache_dir, tiles_fname)
+    if not os.path.exists(pyramid_dir):
+        os.makedirs(pyramid_dir)
+    meta_fname = os.path.join(pyramid_dir, PYRAMID_META_FNAME)
+    if os.path.exists(meta_fname):
+        # The levels are about to be overwritten
+        os.remove(meta_fname)
+
+    renderer = TilespecAffineRenderer(tilespecs)
+    renderer.add_transformation(np.array([[base_scale, 0., 0.], [0., base_scale, 0.]]))
+    start_point = (int(math.floor(bbox[0] * base_scale)), int(math.floor(bbox[2] * base_scale)))
+    end_point = (int(math.floor(bbox[1] * base_scale)), int(math.floor(bbox[3] * base_scale)))
+    level = np.lib.format.open_memmap(_level_fname(pyramid_dir, 0), mode='w+', dtype=np.uint8,
+                                      shape=(end_point[1] - start_point[1] + 1, end_point[0] - start_point[0] + 1))
+    render_strips(renderer, start_point, level, strip_height)
+    level.flush()
+
+    scales = [base_scale]
+    start_points = [start_point]
+    for level_idx in range(1, levels_num):
+        # Each pixel of the next level is the average of 2x2 pixels of the previous level, where the 2x2 blocks start
+        # at even (scaled section) coordinates (the previous level is padded with zeros to whole blocks)
+        prev_level = level
+        prev_start_point = start_point
+        pad_x, pad_y = prev_start_point[0] % 2, prev_start_point[1] % 2
+        start_point = (prev_start_point[0] // 2, prev_start_point[1] // 2)
+        level = np.lib.format.open_memmap(_level_fname(pyramid_dir, level_idx), mode='w+', dtype=np.uint8,
+                                          shape=((prev_level.shape[0] + pad_y + 1) // 2, (prev_level.shape[1] + pad_x + 1) // 2))
+        for strip_from_y in range(0, level.shape[0], strip_height):
+            strip_to_y = min(strip_from_y + strip_height, level.shape[0])
+            prev_strip = np.zeros((2 * (strip_to_y - strip_from_y), 2 * level.shape[1]), dtype=np.uint8)
+            prev_rows = prev_level[max(0, 2 * strip_from_y - pad_y):2 * strip_to_y - pad_y]
+            prev_strip_from_y = pad_y if strip_from_y == 0 else 0
+            prev_strip[prev_strip_from_y:prev_strip_from_y + prev_rows.shape[0], pad_x:pad_x + prev_rows.shape[1]] = prev_rows
+            level[strip_from_y:strip_to_y] = cv2.resize(prev_strip, (level.shape[1], strip_to_y - strip_from_y), interpolation=cv2.INTER_AREA)
+        level.flush()
+        del prev_level
+        scales.append(base_scale / 2.0**level_idx)
+        start_points.append(start_point)
+    del level
+
+    # The meta file is written last, so a pyramid is only loaded after all its levels were written
+    meta = {
+        "tilespec": tiles_fname,
+        "key": list(cache_key),
+        "bbox": list(bbox),
+        "scales": scales,
+        "start_points": start_points
+    }
+    with utils.atomic_output_file(meta_fname) as tmp_fname:
+        with open(tmp_fname, 'w') as meta_file:
+            json.dump(meta, meta_file, indent=4)
+    return SectionPyramid(pyramid_dir, meta)
+
+
+def render_layer_pyramid(tiles_fname, cache_dir, conf_fname=None):
+    """Renders the given section into a pyramid in the cache directory, with the parameters of the configuration file
+       (by default, the first level is at the block matching scaling)"""
+    params = utils.conf_from_file(conf_fname, 'RenderSectionPyramid')
+    if params is None:
+        params = {}
+    block_matching_params = utils.conf_from_file(conf_fname, 'MatchLayersBlockMatching')
+    if block_matching_params is None:
+        block_matching_params = {}
+    base_scale = params.get("base_scale", block_matching_params.get("scaling", 0.2))
+    levels_num = params.get("levels_num", 4)
+    strip_height = params.get("strip_height", 2048)
+
+    print("Rendering the pyramid of section {} (scale: {}, levels: {})".format(tiles_fname, base_scale, levels_num))
+    pyramid = render_section_pyramid(tiles_fname, cache_dir, base_scale, levels_num, strip_height)
+    print("Done (level sizes: {})".format(", ".join("{}x{}".format(pyramid.level(level_idx).shape[1], pyramid.level(level_idx).shape[0]) for level_idx in range(len(pyramid.scales)))))
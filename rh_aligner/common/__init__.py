@@ -3,7 +3,9 @@ Common utilities for the stitching and alignment library
 """
 
 from .bounding_box import BoundingBox
+from .tile_collection import TileCollection
 
 __all__ = [
-            'BoundingBox'
+            'BoundingBox',
+            'TileCollection'
           ]
@@ -0,0 +1,118 @@
+# A persistent per-directory index of the sections' bounding boxes.
+# Each directory of tilespec files may hold an index file that maps each tilespec file name to the size and mtime
+# of that file and to its bounding box. Entries are validated against the file's current size and mtime, so a stale
+# entry is never used (the file is re-scanned instead).
+
+import os
+import json
+import fcntl
+import tempfile
+from collections import defaultdict
+from .bounding_box import BoundingBox
+
+# The index file name (a hidden file, so it won't be picked up by '*.json' globs of the tilespecs directory)
+BBOX_INDEX_FNAME = '.bbox_index.json'
+
+
+def _index_fname(dir_name):
+    return os.path.join(dir_name, BBOX_INDEX_FNAME)
+
+
+def _file_key(tiles_spec_fname):
+    st = os.stat(tiles_spec_fname)
+    return [st.st_size, st.st_mtime]
+
+
+def _read_index(dir_name):
+    try:
+        with open(_index_fname(dir_name), 'r') as index_file:
+            return json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _update_index(dir_name, new_entries):
+    """Merges the new entries into the index file of the given directory (while holding an exclusive lock on the index).
+       Failures (e.g., a read-only directory) are ignored, as the index is only an optimization"""
+    try:
+        with open(_index_fname(dir_name) + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = _read_index(dir_name)
+                index.update(new_entries)
+                fd, tmp_fname = tempfile.mkstemp(prefix='.tmp_', dir=dir_name)
+                with os.fdopen(fd, 'w') as out_file:
+                    json.dump(index, out_file, sort_keys=True, indent=4)
+                os.rename(tmp_fname, _index_fname(dir_name))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    except (IOError, OSError):
+        pass
+
+
+def _split_fname(tiles_spec_fname):
+    tiles_spec_fname = os.path.abspath(tiles_spec_fname.replace('file://', ''))
+    return tiles_spec_fname, os.path.dirname(tiles_spec_fname), os.path.basename(tiles_spec_fname)
+
+
+def update_bbox_index(tiles_spec_fnames, bboxes=None):
+    """Updates the bbox index entries of the given (just written) tilespec files (each directory's index is updated once).
+       If the bboxes (each is a [from_x, to_x, from_y, to_y] list or a BoundingBox) are not given, the files are scanned for them"""
+    if bboxes is None:
+        bboxes = [None] * len(tiles_spec_fnames)
+    new_entries = defaultdict(dict)
+    for tiles_spec_fname, bbox in zip(tiles_spec_fnames, bboxes):
+        tiles_spec_fname, dir_name, base_name = _split_fname(tiles_spec_fname)
+        if bbox is None:
+            bbox = BoundingBox.read_bbox_stream(tiles_spec_fname)
+            if bbox is None:
+                continue
+        if isinstance(bbox, BoundingBox):
+            bbox = bbox.toArray()
+        new_entries[dir_name][base_name] = {"key": _file_key(tiles_spec_fname), "bbox": [float(v) for v in bbox]}
+
+    for dir_name, dir_entries in new_entries.items():
+        _update_index(dir_name, dir_entries)
+
+
+def read_bboxes(tiles_spec_fnames):
+    """Returns a list of the bounding boxes (BoundingBox objects, or None for files without tiles) of the given tilespec files.
+       The bboxes are read from the directories' index files, and only new or modified files are scanned
+       (their entries are then added to the index)"""
+    split_fnames = [_split_fname(fname) for fname in tiles_spec_fnames]
+    indices = {dir_name: _read_index(dir_name) for _, dir_name, _ in split_fnames}
+    new_entries = defaultdict(dict)
+
+    bboxes = []
+    for tiles_spec_fname, dir_name, base_name in split_fnames:
+        key = _file_key(tiles_spec_fname)
+        entry = indices[dir_name].get(base_name)
+        if entry is not None and entry["key"] == key:
+            bboxes.append(BoundingBox.fromList(entry["bbox"]))
+            continue
+        bbox = BoundingBox.read_bbox_stream(tiles_spec_fname)
+        bboxes.append(bbox)
+        if bbox is not None:
+            new_entries[dir_name][base_name] = {"key": key, "bbox": bbox.toArray()}
+
+    for dir_name, dir_entries in new_entries.items():
+        _update_index(dir_name, dir_entries)
+    return bboxes
+
+
+def read_bbox(tiles_spec_fname):
+    """Returns the bounding box of a single tilespec file (see read_bboxes)"""
+    return read_bboxes([tiles_spec_fname])[0]
+
+
+def read_stack_bbox(tiles_spec_fnames):
+    """Returns the union of the bounding boxes of all the given tilespec files (or None if there are no tiles)"""
+    ret_val = None
+    for bbox in read_bboxes(tiles_spec_fnames):
+        if bbox is None:
+            continue
+        if ret_val is None:
+            ret_val = bbox
+        else:
+            ret_val.extend(bbox)
+    return ret_val
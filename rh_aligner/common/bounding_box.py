@@ -1,7 +1,14 @@
 
 import sys
-import json
-import subprocess
+import re
+import numbers
+import numpy as np
+from . import utils
+
+# The size of the chunks that are read by the streaming bbox scanner
+BBOX_STREAM_CHUNK_SIZE = 1024 * 1024
+# Matches a tilespec bbox field, e.g., "bbox": [0.0, 2560.0, 0.0, 2208.0]
+BBOX_FIELD_RE = re.compile(r'"bbox"\s*:\s*\[([^\]]*)\]')
 
 # bounding box - represents a bounding box in an image
 class BoundingBox:
@@ -61,8 +68,7 @@ class BoundingBox:
     @classmethod
     def load_tiles(cls, tiles_spec_fname):
         all_bboxes = []
-        with open(tiles_spec_fname, 'r') as data_file:
-            data = json.load(data_file)
+        data = utils.load_tilespecs(tiles_spec_fname)
         for tile in data:
             tile_bbox = BoundingBox.fromList(tile['bbox'])
             all_bboxes.append(tile_bbox)
@@ -70,58 +76,53 @@ class BoundingBox:
 
     @classmethod
     def read_bbox(cls, tiles_spec_fname):
-        all_bboxes = BoundingBox.load_tiles(tiles_spec_fname)
         # merge the bounding boxes to a single bbox
-        if len(all_bboxes) > 0:
-            ret_val = all_bboxes[0]
-            for bbox in all_bboxes:
-                ret_val.extend(bbox)
+        ret_val = BoundingBox.read_bbox_stream(tiles_spec_fname)
+        if ret_val is not None:
             return ret_val.toArray()
         return None
 
     @classmethod
-    def parse_bbox_lines(cls, bbox_lines):
-        str = ''.join(bbox_lines)
-        str = str[str.find('[') + 1:str.find(']')]
-        str = str.replace(',', ' ')
-        return str
+    def read_bbox_stream(cls, tiles_spec_fname, chunk_size=BBOX_STREAM_CHUNK_SIZE):
+        """Scans the tilespec json file in chunks, and returns the union of all the "bbox" fields (or None if none were found),
+           without parsing (or holding) the entire json document"""
+        min_x, max_x, min_y, max_y = None, None, None, None
+        buf = ''
+        with open(tiles_spec_fname.replace('file://', ''), 'r') as data_file:
+            while True:
+                chunk = data_file.read(chunk_size)
+                buf += chunk
+                last_end = 0
+                for m in BBOX_FIELD_RE.finditer(buf):
+                    bbox = [float(v) for v in m.group(1).split(',')]
+                    if min_x is None:
+                        min_x, max_x, min_y, max_y = bbox
+                    else:
+                        min_x = min(min_x, bbox[0])
+                        max_x = max(max_x, bbox[1])
+                        min_y = min(min_y, bbox[2])
+                        max_y = max(max_y, bbox[3])
+                    last_end = m.end()
+                if len(chunk) == 0:
+                    break
+                # Keep only the suffix that may hold the beginning of a bbox field that was cut by the chunk boundary
+                partial_start = buf.rfind('"bbox"', last_end)
+                if partial_start == -1:
+                    partial_start = max(last_end, len(buf) - len('"bbox"'))
+                buf = buf[partial_start:]
+        if min_x is None:
+            return None
+        return BoundingBox(min_x, max_x, min_y, max_y)
 
     @classmethod
     def read_bbox_grep(cls, tiles_spec_fname):
-        cmd = "grep -A 5 \"bbox\" {}".format(tiles_spec_fname)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-        # Parse all bounding boxes in the given json file
-        ret_val = None
-        cur_bbox_lines = []
-        for line in iter(p.stdout.readline, ''):
-            if line.startswith("--"):
-                cur_bbox = BoundingBox.fromStr(BoundingBox.parse_bbox_lines(cur_bbox_lines))
-                if ret_val is None:
-                    ret_val = cur_bbox
-                else:
-                    ret_val.extend(cur_bbox)
-                cur_bbox_lines = []
-            else:
-                cur_bbox_lines.append(line.strip(' \n'))
-        if len(cur_bbox_lines) > 0:
-            cur_bbox = BoundingBox.fromStr(BoundingBox.parse_bbox_lines(cur_bbox_lines))
-            if ret_val is None:
-                ret_val = cur_bbox
-            else:
-                ret_val.extend(cur_bbox)
-        return ret_val
+        # Kept for backward compatibility (the bboxes are now read by a streaming scanner, and not by a grep subprocess)
+        return BoundingBox.read_bbox_stream(tiles_spec_fname)
 
     @classmethod
     def read_bbox_from_ts(cls, tilespec):
-        all_bboxes = [BoundingBox.fromList(tile['bbox']) for tile in tilespec]
         # merge the bounding boxes to a single bbox
-        if len(all_bboxes) > 0:
-            ret_val = all_bboxes[0]
-            for bbox in all_bboxes:
-                ret_val.extend(bbox)
-            return ret_val
-        return None
+        return BoundingBoxArray.fromTilespec(tilespec).union()
 
 
     def union(self, other_bbox):
@@ -154,3 +155,101 @@ class BoundingBox:
 
     def __getitem__(self, i):
         return [self.from_x, self.to_x, self.from_y, self.to_y][i]
+
+
+# bounding box array - represents N bounding boxes (as an Nx4 array of [from_x, to_x, from_y, to_y] rows),
+# and answers geometric queries on all of them at once
+class BoundingBoxArray:
+
+    def __init__(self, bboxes):
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape((-1, 4))
+
+    @classmethod
+    def fromTilespec(cls, tilespec):
+        return cls([tile['bbox'] for tile in tilespec])
+
+    @classmethod
+    def fromBoundingBoxes(cls, bboxes):
+        return cls([bbox.toArray() for bbox in bboxes])
+
+    def __len__(self):
+        return self.bboxes.shape[0]
+
+    def __getitem__(self, i):
+        """Returns a BoundingBox for an integer index, or a BoundingBoxArray for a list of indices (or a slice/mask)"""
+        if isinstance(i, numbers.Integral):
+            return BoundingBox.fromList(self.bboxes[i])
+        return BoundingBoxArray(self.bboxes[i])
+
+    def toArray(self):
+        return self.bboxes.tolist()
+
+    def overlap_matrix(self, other_bboxes=None):
+        """Returns an NxM boolean matrix, where [i, j] is True iff box i overlaps box j of other_bboxes
+           (same semantics as BoundingBox.overlap). If other_bboxes is None, the boxes are compared to themselves"""
+        other = self.bboxes if other_bboxes is None else other_bboxes.bboxes
+        return ((self.bboxes[:, 0:1] < other[:, 1]) & (self.bboxes[:, 1:2] > other[:, 0]) &
+                (self.bboxes[:, 2:3] < other[:, 3]) & (self.bboxes[:, 3:4] > other[:, 2]))
+
+    def query_overlapping(self, bbox):
+        """Returns the indices of the boxes that overlap the given bbox (a BoundingBox or a [from_x, to_x, from_y, to_y] list)"""
+        mask = ((self.bboxes[:, 0] < bbox[1]) & (self.bboxes[:, 1] > bbox[0]) &
+                (self.bboxes[:, 2] < bbox[3]) & (self.bboxes[:, 3] > bbox[2]))
+        return np.nonzero(mask)[0]
+
+    def overlapping_pairs(self):
+        """Returns a Kx2 array of the (i, j) indices (i < j, sorted) of all the overlapping pairs of boxes
+           (same as the upper triangle of overlap_matrix()). The boxes are swept by their from_x, so each box is
+           only compared to the boxes that start before it ends, and no NxN matrix is built"""
+        order = np.argsort(self.bboxes[:, 0], kind='mergesort')
+        sorted_bboxes = self.bboxes[order]
+        # (in the sorted order) the first box that starts at or after the end of each box
+        sweep_ends = np.searchsorted(sorted_bboxes[:, 0], sorted_bboxes[:, 1], side='left')
+        pairs = []
+        for k in range(len(order)):
+            if sweep_ends[k] <= k + 1:
+                continue
+            candidates = sorted_bboxes[k + 1:sweep_ends[k]]
+            mask = ((candidates[:, 1] > sorted_bboxes[k, 0]) &
+                    (candidates[:, 2] < sorted_bboxes[k, 3]) & (candidates[:, 3] > sorted_bboxes[k, 2]))
+            overlapping = order[k + 1 + np.nonzero(mask)[0]]
+            if len(overlapping) > 0:
+                pairs.append(np.column_stack((np.full(len(overlapping), order[k], dtype=overlapping.dtype), overlapping)))
+        if len(pairs) == 0:
+            return np.empty((0, 2), dtype=np.intp)
+        pairs = np.sort(np.vstack(pairs), axis=1)
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    def contains(self, pts):
+        '''return an NxP mask, where [i, j] is True iff point j is within box i.  pts.shape = (P, 2)'''
+        pts = np.asarray(pts).reshape((-1, 2))
+        return ((pts[:, 0] >= self.bboxes[:, 0:1]) & (pts[:, 0] <= self.bboxes[:, 1:2]) &
+                (pts[:, 1] >= self.bboxes[:, 2:3]) & (pts[:, 1] <= self.bboxes[:, 3:4]))
+
+    def union(self):
+        """Returns a single BoundingBox that contains all the boxes (or None if there are no boxes)"""
+        if len(self) == 0:
+            return None
+        return BoundingBox(np.min(self.bboxes[:, 0]), np.max(self.bboxes[:, 1]),
+                           np.min(self.bboxes[:, 2]), np.max(self.bboxes[:, 3]))
+
+    def intersect(self, other_bbox):
+        """Returns the intersection of each box with other_bbox (either a single bbox, or a BoundingBoxArray of the same length).
+           Boxes that do not intersect will have from > to."""
+        other = other_bbox.bboxes if isinstance(other_bbox, BoundingBoxArray) else np.array(list(other_bbox[:4]), dtype=np.float64)
+        other = other.reshape((-1, 4))
+        return BoundingBoxArray(np.column_stack((np.maximum(self.bboxes[:, 0], other[:, 0]),
+                                                 np.minimum(self.bboxes[:, 1], other[:, 1]),
+                                                 np.maximum(self.bboxes[:, 2], other[:, 2]),
+                                                 np.minimum(self.bboxes[:, 3], other[:, 3]))))
+
+    def expand(self, scale=None, offset=None):
+        assert (scale is not None) or (offset is not None)
+        if scale is not None:
+            x_deltas = scale * (self.bboxes[:, 1] - self.bboxes[:, 0])
+            y_deltas = scale * (self.bboxes[:, 3] - self.bboxes[:, 2])
+        else:
+            x_deltas = np.full((len(self), ), offset, dtype=np.float64)
+            y_deltas = x_deltas
+        return BoundingBoxArray(np.column_stack((self.bboxes[:, 0] - x_deltas, self.bboxes[:, 1] + x_deltas,
+                                                 self.bboxes[:, 2] - y_deltas, self.bboxes[:, 3] + y_deltas)))
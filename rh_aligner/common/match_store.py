@@ -0,0 +1,83 @@
+# A compact binary store of the block matching results of a (directed) layers pair.
+# Instead of a json file per mfov (that repeats the section's hexagonal grid, and a dictionary per match), the matches
+# of all the mfovs of section 1 are kept as concatenated arrays (point1, point2 and match_val, with the number of
+# matches of each mfov), and the grid parameters and the tilespecs are stored once, in a single (uncompressed) npz file.
+
+import numpy as np
+from . import utils
+
+
+class MatchStore(object):
+    """The block matching results of all the mfovs of section 1 (tilespec1) on section 2 (tilespec2), where the matches
+       of mfovs[i] are the rows offsets[i]:offsets[i + 1] of point1, point2 and match_val"""
+
+    def __init__(self, tilespec1, tilespec2, hex_spacing, mfovs, matches_nums, point1, point2, match_val, failures=None, runtimes=None):
+        self.tilespec1 = tilespec1
+        self.tilespec2 = tilespec2
+        self.hex_spacing = hex_spacing
+        self.mfovs = np.asarray(mfovs, dtype=np.int64)
+        self.matches_nums = np.asarray(matches_nums, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.matches_nums)))
+        self.point1 = np.asarray(point1, dtype=np.float64).reshape(-1, 2)
+        self.point2 = np.asarray(point2, dtype=np.float64).reshape(-1, 2)
+        self.match_val = np.asarray(match_val, dtype=np.float64).reshape(-1)
+        self.failures = failures
+        self.runtimes = runtimes
+
+    @classmethod
+    def from_mfovs_matches(cls, tilespec1, tilespec2, hex_spacing, mfovs_matches):
+        """Creates the store from a list of (mfov, Nx5 matches array of [x1, y1, x2, y2, match_val], failures counts,
+           runtime) tuples"""
+        mfovs_matches = sorted(mfovs_matches, key=lambda mfov_matches: mfov_matches[0])
+        matches = [np.asarray(mfov_matches[1], dtype=np.float64).reshape(-1, 5) for mfov_matches in mfovs_matches]
+        all_matches = np.concatenate(matches) if len(matches) > 0 else np.empty((0, 5), dtype=np.float64)
+        return cls(tilespec1, tilespec2, hex_spacing,
+                   [mfov_matches[0] for mfov_matches in mfovs_matches],
+                   [len(mfov_matches) for mfov_matches in matches],
+                   all_matches[:, :2], all_matches[:, 2:4], all_matches[:, 4],
+                   np.array([mfov_matches[2] for mfov_matches in mfovs_matches], dtype=np.int64).reshape(len(mfovs_matches), -1),
+                   np.array([mfov_matches[3] for mfov_matches in mfovs_matches], dtype=np.float64))
+
+    def mfov_matches(self, mfov):
+        """Returns the point1, point2 and match_val arrays of the given mfov (of section 1)"""
+        idx = np.searchsorted(self.mfovs, mfov)
+        if idx == len(self.mfovs) or self.mfovs[idx] != mfov:
+            return np.empty((0, 2)), np.empty((0, 2)), np.empty((0, ))
+        from_idx, to_idx = self.offsets[idx], self.offsets[idx + 1]
+        return self.point1[from_idx:to_idx], self.point2[from_idx:to_idx], self.match_val[from_idx:to_idx]
+
+
+def save_match_store(out_fname, store):
+    """Saves the given MatchStore to out_fname (an npz file)"""
+    arrays = {
+        "tilespec1": np.array(store.tilespec1),
+        "tilespec2": np.array(store.tilespec2),
+        "hex_spacing": np.array(store.hex_spacing, dtype=np.float64),
+        "mfovs": store.mfovs,
+        "matches_nums": store.matches_nums,
+        "point1": store.point1,
+        "point2": store.point2,
+        "match_val": store.match_val
+    }
+    if store.failures is not None:
+        arrays["failures"] = store.failures
+    if store.runtimes is not None:
+        arrays["runtimes"] = store.runtimes
+    with utils.atomic_output_file(out_fname) as tmp_fname:
+        # (np.savez adds an .npz suffix to file names, but not to file objects)
+        with open(tmp_fname, 'wb') as out:
+            np.savez(out, **arrays)
+
+
+def load_match_store(fname):
+    """Returns the MatchStore that was saved in the given npz file"""
+    with np.load(fname) as data:
+        return MatchStore(str(data["tilespec1"]), str(data["tilespec2"]), float(data["hex_spacing"]),
+                          data["mfovs"], data["matches_nums"], data["point1"], data["point2"], data["match_val"],
+                          data["failures"] if "failures" in data.files else None,
+                          data["runtimes"] if "runtimes" in data.files else None)
+
+
+def is_match_store_fname(fname):
+    """Returns True if the given matches file name is of a match store (and not of an mfov json file)"""
+    return fname.endswith('.npz')
@@ -211,7 +211,10 @@ def filter_triangles(m0, m1, choices,
     return choices[mask]
     
 
-def ransac(matches, target_model_type, iterations, epsilon, min_inlier_ratio, min_num_inlier, det_delta=0.35, max_stretch=0.25):
+def ransac(matches, target_model_type, iterations, epsilon, min_inlier_ratio, min_num_inlier, det_delta=0.35, max_stretch=0.25, initial_model=None):
+    """If initial_model is given (e.g., the best model of a previous search over a subset of the matches), it is
+       scored first, and the sampled models only replace it if they score better (a warm start).
+       An initial model of a different type is first converted to the closest model of the target type"""
     # model = Model.create_model(target_model_type)
     assert(len(matches[0]) == len(matches[1]))
 
@@ -225,6 +228,21 @@ def ransac(matches, target_model_type, iterations, epsilon, min_inlier_ratio, mi
         print "RANSAC cannot find a good model because the number of initial matches ({}) is too small.".format(matches.shape[1])
         return None, None, None
 
+    if initial_model is not None and type(initial_model) is not type(proposed_model):
+        # Use the model of the target type that is closest to the initial model
+        converted_model = Transforms.create(target_model_type)
+        if converted_model.fit(matches[0], initial_model.apply(matches[0])) == False:
+            converted_model = None
+        initial_model = converted_model
+
+    if initial_model is not None:
+        initial_model_score, inlier_mask, initial_model_mean = initial_model.score(matches[0], matches[1], epsilon, min_inlier_ratio, min_num_inlier)
+        if initial_model_score > best_model_score:
+            best_model = copy.deepcopy(initial_model)
+            best_model_score = initial_model_score
+            best_inlier_mask = inlier_mask
+            best_model_mean_dists = initial_model_mean
+
     # Avoiding repeated indices permutations using a dictionary
     # Limit the number of possible matches that we can search for using n choose k
     max_combinations = int(comb(len(matches[0]), proposed_model.MIN_MATCHES_NUM))
@@ -314,8 +332,8 @@ def filter_after_ransac(candidates, model, max_trust, min_num_inliers):
     return new_model, candidates_mask, np.mean(dists)
 
 
-def filter_matches(matches, target_model_type, iterations, epsilon, min_inlier_ratio, min_num_inlier, max_trust, det_delta=0.35, max_stretch=0.25):
-    """Perform a RANSAC filtering given all the matches"""
+def filter_matches(matches, target_model_type, iterations, epsilon, min_inlier_ratio, min_num_inlier, max_trust, det_delta=0.35, max_stretch=0.25, initial_model=None):
+    """Perform a RANSAC filtering given all the matches (optionally warm-started from initial_model)"""
     new_model = None
     filtered_matches = None
     meandists = -1
@@ -323,7 +341,7 @@ def filter_matches(matches, target_model_type, iterations, epsilon, min_inlier_r
     # Apply RANSAC
     # print "Filtering {} matches".format(matches.shape[1])
     print "pre-ransac matches count: {}".format(matches.shape[1])
-    inliers_mask, model, _ = ransac(matches, target_model_type, iterations, epsilon, min_inlier_ratio, min_num_inlier, det_delta, max_stretch)
+    inliers_mask, model, _ = ransac(matches, target_model_type, iterations, epsilon, min_inlier_ratio, min_num_inlier, det_delta, max_stretch, initial_model)
     if inliers_mask is None:
         print "post-ransac matches count: 0"
     else:
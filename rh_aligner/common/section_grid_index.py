@@ -0,0 +1,82 @@
+# A per-section index of the hexagonal grid points, that maps each grid point to the tile (and mfov) it lies in.
+# The index is computed once per section (and grid spacing), and is cached in a sidecar npz file next to the
+# section's tilespec file (validated by the tilespec file's size and mtime).
+
+import numpy as np
+from scipy import spatial
+from . import utils
+from .bounding_box import BoundingBox
+from .tile_collection import TileCollection
+
+
+class SectionGridIndex(object):
+    """The hexagonal grid points of a section, and for each point the index (in the tilespecs list) of the tile
+       that contains it and that tile's mfov (both are -1 for points that are not inside any tile)"""
+
+    def __init__(self, points, point_tiles, point_mfovs):
+        self.points = points
+        self.point_tiles = point_tiles
+        self.point_mfovs = point_mfovs
+
+    @classmethod
+    def build(cls, tilespecs, bbox, spacing):
+        """Computes the grid index of the given section tilespecs (with the grid spanning the given bbox)"""
+        points = utils.generate_hexagonal_grid(bbox, spacing)
+        tiles = TileCollection(tilespecs)
+        point_tiles = np.full((len(points), ), -1, dtype=np.int64)
+        point_mfovs = np.full((len(points), ), -1, dtype=np.int64)
+        if len(points) > 0 and len(tiles) > 0:
+            # Each point is assigned to the tile with the closest center, if the point is inside that tile's bbox
+            # TODO - instead of checking inside the bbox, need to check inside the polygon after transformation
+            _, closest_tiles = spatial.cKDTree(tiles.centers()).query(points)
+            closest_bboxes = tiles.bboxes[closest_tiles]
+            in_tile_mask = (points[:, 0] > closest_bboxes[:, 0]) & (points[:, 1] > closest_bboxes[:, 2]) & \
+                           (points[:, 0] < closest_bboxes[:, 1]) & (points[:, 1] < closest_bboxes[:, 3])
+            point_tiles[in_tile_mask] = closest_tiles[in_tile_mask]
+            point_mfovs[in_tile_mask] = tiles.mfovs[closest_tiles[in_tile_mask]]
+        return cls(points, point_tiles, point_mfovs)
+
+    def mfov_points(self, mfov):
+        """Returns an Nx2 array of all the grid points that are inside the tiles of the given mfov"""
+        return self.points[self.point_mfovs == mfov]
+
+    def points_in_bbox(self, bbox):
+        """Returns all the grid points that are inside the given [from_x, to_x, from_y, to_y] bbox (including its boundary)"""
+        return self.points[BoundingBox.fromList(bbox).contains(self.points)]
+
+
+def _grid_index_cache_fname(tiles_fname, spacing):
+    return '{}.hexgrid_{}.npz'.format(tiles_fname, spacing)
+
+
+def _read_grid_index_cache(cache_fname):
+    with np.load(cache_fname) as data:
+        return data["key"].tolist(), SectionGridIndex(data["points"], data["point_tiles"], data["point_mfovs"])
+
+
+def _write_grid_index_cache(cache_fname, cache_key, grid_index):
+    with open(cache_fname, 'wb') as cache_file:
+        np.savez(cache_file, key=np.array(cache_key, dtype=np.float64), points=grid_index.points,
+                 point_tiles=grid_index.point_tiles, point_mfovs=grid_index.point_mfovs)
+
+
+def load_section_grid_index(tiles_fname, spacing, tilespecs=None, use_cache=True):
+    """Returns the SectionGridIndex of the given section tilespec file and grid spacing (the grid spans the section's bbox).
+       If use_cache is True, the index is read from (or saved to) a sidecar file next to the tilespec file"""
+    tiles_fname = tiles_fname.replace('file://', '')
+    if use_cache:
+        cache_fname = _grid_index_cache_fname(tiles_fname, spacing)
+        cache_key = tuple(float(v) for v in utils.file_cache_key(tiles_fname))
+        grid_index = utils.load_cache_file(cache_fname, cache_key, _read_grid_index_cache)
+        if grid_index is not None:
+            return grid_index
+
+    if tilespecs is None:
+        tilespecs = utils.load_tilespecs(tiles_fname)
+    bbox = BoundingBox.read_bbox(tiles_fname)
+    grid_index = SectionGridIndex.build(tilespecs, bbox, spacing)
+
+    if use_cache:
+        utils.save_cache_file(cache_fname, cache_key, lambda tmp_fname: _write_grid_index_cache(tmp_fname, cache_key, grid_index))
+
+    return grid_index
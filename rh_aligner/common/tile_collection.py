@@ -0,0 +1,142 @@
+import json
+import numpy as np
+from . import utils
+
+
+def _parse_transform_params(transform):
+    """Returns the numeric parameters of a tilespec transform (its dataString), or None if these aren't a short list of numbers"""
+    try:
+        params = [float(v) for v in transform["dataString"].split()]
+    except (KeyError, ValueError, AttributeError):
+        return None
+    if len(params) > TileCollection.MAX_TRANSFORM_PARAMS:
+        return None
+    return params
+
+
+class TileCollection(object):
+    """A columnar in-memory representation of a section's tilespecs.
+       The per-tile values (bbox, mfov, tile_index, layer, width, height and the first transform's parameters)
+       are kept in numpy arrays (one row per tile, in the tilespecs order), and the tiles can be looked up in O(1)
+       by their image url or by their (mfov, tile_index)."""
+
+    # The maximal number of parameters that are stored for a tile's transform (6 for an affine transform)
+    MAX_TRANSFORM_PARAMS = 6
+
+    def __init__(self, tilespecs):
+        self.tilespecs = tilespecs
+        tiles_num = len(tilespecs)
+
+        self.urls = [ts["mipmapLevels"]["0"]["imageUrl"] for ts in tilespecs]
+        # Keep the original bbox values type (ints or floats), so the json round-trip won't change the values
+        self.bboxes = np.array([ts["bbox"] for ts in tilespecs]).reshape((tiles_num, 4))
+        self.mfovs = np.array([ts.get("mfov", -1) for ts in tilespecs], dtype=np.int64)
+        self.tile_indices = np.array([ts.get("tile_index", -1) for ts in tilespecs], dtype=np.int64)
+        self.layers = np.array([ts.get("layer", -1) for ts in tilespecs], dtype=np.int64)
+        self.widths = np.array([ts.get("width", 0) for ts in tilespecs], dtype=np.int64)
+        self.heights = np.array([ts.get("height", 0) for ts in tilespecs], dtype=np.int64)
+
+        # The first transform of each tile (its class name, and its parameters padded with nans)
+        self.transform_class_names = [None] * tiles_num
+        self.transform_params = np.full((tiles_num, TileCollection.MAX_TRANSFORM_PARAMS), np.nan)
+        for i, ts in enumerate(tilespecs):
+            transforms = ts.get("transforms", [])
+            if len(transforms) == 0:
+                continue
+            self.transform_class_names[i] = transforms[0].get("className")
+            params = _parse_transform_params(transforms[0])
+            if params is not None:
+                self.transform_params[i, :len(params)] = params
+
+        # The lookup indices
+        self.url_to_index = {url: i for i, url in enumerate(self.urls)}
+        self.mfov_tile_to_index = {(mfov, tile_index): i for i, (mfov, tile_index) in
+                                   enumerate(zip(self.mfovs.tolist(), self.tile_indices.tolist()))}
+        self.mfov_to_indices = {}
+        for mfov in np.unique(self.mfovs).tolist():
+            self.mfov_to_indices[mfov] = np.nonzero(self.mfovs == mfov)[0]
+
+    @classmethod
+    def from_file(cls, tiles_fname):
+        return cls(utils.load_tilespecs(tiles_fname))
+
+    def __len__(self):
+        return len(self.tilespecs)
+
+    def __getitem__(self, i):
+        return self.tilespecs[i]
+
+    def index_of_url(self, url):
+        """Returns the index of the tile with the given image url (or None if it is not in the collection)"""
+        return self.url_to_index.get(url)
+
+    def get_by_url(self, url):
+        """Returns the tilespec of the tile with the given image url (or None if it is not in the collection)"""
+        idx = self.url_to_index.get(url)
+        if idx is None:
+            return None
+        return self.tilespecs[idx]
+
+    def index_of(self, mfov, tile_index):
+        """Returns the index of the tile with the given mfov and tile_index (or None if it is not in the collection)"""
+        return self.mfov_tile_to_index.get((mfov, tile_index))
+
+    def get(self, mfov, tile_index):
+        """Returns the tilespec of the tile with the given mfov and tile_index (or None if it is not in the collection)"""
+        idx = self.mfov_tile_to_index.get((mfov, tile_index))
+        if idx is None:
+            return None
+        return self.tilespecs[idx]
+
+    def sorted_mfovs(self):
+        return sorted(self.mfov_to_indices.keys())
+
+    def mfov_indices(self, mfov):
+        """Returns the indices of all the tiles of the given mfov"""
+        return self.mfov_to_indices[mfov]
+
+    def centers(self, indices=None):
+        """Returns an Nx2 array of the centers of the tiles' bounding boxes (of all tiles, or of the given indices)"""
+        bboxes = self.bboxes if indices is None else self.bboxes[indices]
+        bboxes = bboxes.astype(np.float64)
+        return np.column_stack(((bboxes[:, 0] + bboxes[:, 1]) / 2.0,
+                                (bboxes[:, 2] + bboxes[:, 3]) / 2.0))
+
+    def bbox(self, indices=None):
+        """Returns the bounding box [from_x, to_x, from_y, to_y] of all the tiles (or of the given indices)"""
+        bboxes = self.bboxes if indices is None else self.bboxes[indices]
+        if len(bboxes) == 0:
+            return None
+        return [bboxes[:, 0].min(), bboxes[:, 1].max(), bboxes[:, 2].min(), bboxes[:, 3].max()]
+
+    def mfov_bboxes(self):
+        """Returns a dictionary that maps each mfov to its bounding box [from_x, to_x, from_y, to_y] (a numpy array)"""
+        return {mfov: np.array(self.bbox(indices), dtype=np.float64) for mfov, indices in self.mfov_to_indices.items()}
+
+    def mfov_centers(self):
+        """Returns a dictionary that maps each mfov to the center of its bounding box (an array of 2 elements)"""
+        mfov_centers = {}
+        for mfov in self.sorted_mfovs():
+            min_x, max_x, min_y, max_y = self.bbox(self.mfov_to_indices[mfov])
+            # center = [(min_x + max_x) / 2.0, (min_y + max_y) / 2.0], but w/o overflow
+            mfov_centers[mfov] = np.array([min_x / 2.0 + max_x / 2.0, min_y / 2.0 + max_y / 2.0])
+        return mfov_centers
+
+    def overlapping(self, bbox):
+        """Returns the indices of the tiles whose bounding box overlaps the given [from_x, to_x, from_y, to_y] bbox"""
+        mask = (self.bboxes[:, 0] < bbox[1]) & (self.bboxes[:, 1] > bbox[0]) & \
+               (self.bboxes[:, 2] < bbox[3]) & (self.bboxes[:, 3] > bbox[2])
+        return np.nonzero(mask)[0]
+
+    def to_tilespecs(self):
+        """Returns the tilespecs (a list of dictionaries) of the collection, updated with the current bboxes values"""
+        out_tilespecs = []
+        for ts, bbox in zip(self.tilespecs, self.bboxes.tolist()):
+            out_ts = dict(ts)
+            out_ts["bbox"] = bbox
+            out_tilespecs.append(out_ts)
+        return out_tilespecs
+
+    def save(self, out_fname):
+        with open(out_fname, 'w') as out_file:
+            json.dump(self.to_tilespecs(), out_file, sort_keys=True, indent=4)
@@ -5,6 +5,26 @@ import sys
 import json
 import time
 import math
+import tempfile
+import select
+import contextlib
+import numpy as np
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# The completion marker of an output file is a hidden file in the same directory, named .<file name><DONE_MARKER_SUFFIX>
+DONE_MARKER_SUFFIX = '.done'
+# While waiting for a completion marker, the directory is re-checked at least once in this interval
+# (inotify doesn't see files that were created by other hosts on a network file system, e.g., NFS)
+WAIT_POLL_INTERVAL_SECONDS = 5
+
+# The suffix of the binary cache file that is saved next to each loaded tilespec json file
+TILESPECS_CACHE_SUFFIX = '.cache.pkl'
+# Only cache tilespec files that weren't modified in the last few seconds (the mtime resolution of some
+# file systems is a second, so a file that is being rewritten might otherwise get the same size and mtime)
+TILESPECS_CACHE_MIN_AGE_SECONDS = 2
 
 def conf_from_file(conf_fname, tool):
     ''' Read the tool configuration from conf file name (json format), and return the parameters in a dictionary format '''
@@ -24,8 +44,7 @@ def create_dir(path):
 
 def read_layer_from_file(tiles_spec_fname):
     layer = None
-    with open(tiles_spec_fname, 'r') as data_file:
-        data = json.load(data_file)
+    data = load_tilespecs(tiles_spec_fname)
     for tile in data:
         if tile['layer'] is None:
             print "Error reading layer in one of the tiles in: {0}".format(tiles_spec_fname)
@@ -40,24 +59,145 @@ def read_layer_from_file(tiles_spec_fname):
         sys.exit(1)
     return int(layer)
 
-def wait_after_file(filename, timeout_seconds):
+def done_marker_fname(filename):
+    """Returns the file name of the completion marker of the given file"""
+    dir_name, base_name = os.path.split(filename)
+    return os.path.join(dir_name, '.{}{}'.format(base_name, DONE_MARKER_SUFFIX))
+
+def mark_file_done(filename):
+    """Creates the completion marker of the given (fully written) file"""
+    with open(done_marker_fname(filename), 'w'):
+        pass
+
+@contextlib.contextmanager
+def atomic_output_file(out_fname):
+    """A context manager that yields a temporary file name (a hidden file in the output directory) to write the output to.
+       When the block completes, the temporary file is renamed to out_fname and the completion marker of out_fname is created,
+       so readers never see a partially written output. If the block raises an exception, the temporary file is removed."""
+    dir_name, base_name = os.path.split(out_fname)
+    tmp_fname = os.path.join(dir_name, '.{}.tmp.{}'.format(base_name, os.getpid()))
+    try:
+        yield tmp_fname
+        os.rename(tmp_fname, out_fname)
+    except:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    mark_file_done(out_fname)
+
+def _inotify_watch_dir(dir_name):
+    """Returns an inotify file descriptor that watches the given directory for new files (or None if inotify is unavailable)"""
+    IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x8, 0x80, 0x100
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            return None
+        if not isinstance(dir_name, bytes):
+            dir_name = dir_name.encode('utf-8')
+        if libc.inotify_add_watch(fd, ctypes.c_char_p(dir_name), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+def wait_after_file(filename, timeout_seconds, poll_interval=WAIT_POLL_INTERVAL_SECONDS):
+    """Waits until the given file is ready to be read. Returns immediately if the file's completion marker exists,
+       and otherwise waits (using inotify, with a periodic re-check) for the marker to be created, but no longer than
+       until the file wasn't modified for timeout_seconds (for files that are written without a completion marker)"""
     if timeout_seconds > 0:
-        cur_time = time.time()
-        mod_time = os.path.getmtime(filename)
-        end_wait_time = mod_time + timeout_seconds
-        while cur_time < end_wait_time:
-            print "Waiting for file: {}".format(filename)
-            cur_time = time.time()
-            mod_time = os.path.getmtime(filename)
-            end_wait_time = mod_time + timeout_seconds
-            if cur_time < end_wait_time:
-                time.sleep(end_wait_time - cur_time)
-
-def load_tilespecs(tile_file):
+        marker_fname = done_marker_fname(filename)
+        if os.path.exists(marker_fname):
+            return
+        print "Waiting for file: {}".format(filename)
+        watch_fd = _inotify_watch_dir(os.path.dirname(os.path.abspath(filename)))
+        try:
+            while not os.path.exists(marker_fname):
+                remaining_time = os.path.getmtime(filename) + timeout_seconds - time.time()
+                if remaining_time <= 0:
+                    break
+                cur_wait_time = min(remaining_time, poll_interval)
+                if watch_fd is None:
+                    time.sleep(cur_wait_time)
+                else:
+                    ready_fds, _, _ = select.select([watch_fd], [], [], cur_wait_time)
+                    if len(ready_fds) > 0:
+                        # Discard the events (the marker file existence is checked explicitly)
+                        os.read(watch_fd, 4096)
+        finally:
+            if watch_fd is not None:
+                os.close(watch_fd)
+
+def file_cache_key(fname):
+    """Returns a key (the file's size and mtime) that is used to validate that a cache file matches its source file"""
+    st = os.stat(fname)
+    return (st.st_size, st.st_mtime)
+
+def load_cache_file(cache_fname, cache_key, read_func):
+    """Returns the data of a sidecar cache file, where read_func(cache_fname) returns the (key, data) of the file.
+       Returns None if the file's key is not cache_key (see file_cache_key, and a None cache_key matches any key), and
+       a missing, partial or corrupted cache file is treated as a cache miss as well"""
+    if not os.path.exists(cache_fname):
+        return None
+    try:
+        cached_key, data = read_func(cache_fname)
+    except Exception:
+        return None
+    if cache_key is not None and tuple(float(v) for v in cached_key) != tuple(float(v) for v in cache_key):
+        return None
+    return data
+
+def save_cache_file(cache_fname, cache_key, write_func):
+    """Atomically saves a sidecar cache file, where write_func(tmp_fname) writes the file (including cache_key).
+       A cache of a source file that was modified in the last TILESPECS_CACHE_MIN_AGE_SECONDS is not saved (the source
+       file's mtime may not change if it is modified again right away), and failures (e.g., a read-only directory) are
+       ignored. Returns True if the cache file was saved"""
+    if cache_key is not None and time.time() - cache_key[1] <= TILESPECS_CACHE_MIN_AGE_SECONDS:
+        return False
+    try:
+        fd, tmp_fname = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(cache_fname) or '.')
+        os.close(fd)
+    except (IOError, OSError):
+        return False
+    try:
+        write_func(tmp_fname)
+        os.rename(tmp_fname, cache_fname)
+    except Exception:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        return False
+    return True
+
+def _read_tilespecs_cache(cache_fname):
+    with open(cache_fname, 'rb') as cache_file:
+        cached_key = pickle.load(cache_file)
+        return cached_key, pickle.load(cache_file)
+
+def _write_tilespecs_cache(cache_fname, cache_key, tilespecs):
+    with open(cache_fname, 'wb') as cache_file:
+        pickle.dump(cache_key, cache_file, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(tilespecs, cache_file, pickle.HIGHEST_PROTOCOL)
+
+def load_tilespecs(tile_file, use_cache=True):
+    """Loads the tilespecs json file. If use_cache is True, the parsed tilespecs are also kept in a binary sidecar file
+       (next to the json file), and later loads use that file as long as the json file's size and mtime were not changed"""
     tile_file = tile_file.replace('file://', '')
+    if use_cache:
+        cache_fname = tile_file + TILESPECS_CACHE_SUFFIX
+        cache_key = file_cache_key(tile_file)
+        tilespecs = load_cache_file(cache_fname, cache_key, _read_tilespecs_cache)
+        if tilespecs is not None:
+            return tilespecs
+
     with open(tile_file, 'r') as data_file:
         tilespecs = json.load(data_file)
 
+    if use_cache:
+        save_cache_file(cache_fname, cache_key, lambda tmp_fname: _write_tilespecs_cache(tmp_fname, cache_key, tilespecs))
+
     return tilespecs
 
 def index_tilespec(tilespec):
@@ -82,17 +222,17 @@ def generate_hexagonal_grid(boundingbox, spacing):
     sizey = int((boundingbox[3] - boundingbox[2]) / vertspacing) + 2
     if sizey % 2 == 0:
         sizey += 1
-    pointsret = []
-    for i in range(-2, sizex):
-        for j in range(-2, sizey):
-            xpos = i * spacing
-            ypos = j * spacing
-            if j % 2 == 1:
-                xpos += spacing * 0.5
-            if (j % 2 == 1) and (i == sizex - 1):
-                continue
-            pointsret.append([int(xpos + boundingbox[0]), int(ypos + boundingbox[2])])
-    return pointsret
+    # Returns an Nx2 array of the grid points (ordered by columns, i.e., all points of i=-2, then i=-1, etc.)
+    i_vals, j_vals = np.meshgrid(np.arange(-2, sizex), np.arange(-2, sizey), indexing='ij')
+    i_vals = i_vals.ravel()
+    j_vals = j_vals.ravel()
+    odd_rows = (j_vals % 2 == 1)
+    keep_mask = ~(odd_rows & (i_vals == sizex - 1))
+    xpos = i_vals * spacing + odd_rows * (spacing * 0.5)
+    ypos = j_vals * spacing
+    pointsret = np.column_stack((xpos + boundingbox[0], ypos + boundingbox[2]))[keep_mask]
+    # truncate towards zero (as int() does)
+    return np.trunc(pointsret).astype(np.int64)
 
 
 def is_cv2():
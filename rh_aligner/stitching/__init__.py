@@ -4,12 +4,13 @@
 
 from .create_sift_features_cv2 import create_sift_features, create_multiple_sift_features
 from .match_sift_features_and_filter_cv2 import match_single_sift_features_and_filter, match_multiple_sift_features_and_filter
-from .optimize_2d_mfovs import optimize_2d_mfovs
+from .optimize_2d_mfovs import optimize_2d_mfovs, optimize_2d_mfovs_batch
 
 __all__ = [
             'create_sift_features',
             'create_multiple_sift_features',
             'match_single_sift_features_and_filter',
             'match_multiple_sift_features_and_filter',
-            'optimize_2d_mfovs'
+            'optimize_2d_mfovs',
+            'optimize_2d_mfovs_batch'
           ]
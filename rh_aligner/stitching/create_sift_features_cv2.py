@@ -50,14 +50,15 @@ def create_sift_features_single_tile(tilespecs, out_fname, index, initial_sigma=
     # Save the features
 
     print "Saving {} sift features at: {}".format(len(descs), out_fname)
-    with h5py.File(out_fname, 'w') as hf:
-        hf.create_dataset("imageUrl",
-                            data=np.array(image_path.encode("utf-8"), dtype='S'))
-        hf.create_dataset("pts/responses", data=np.array([p.response for p in pts], dtype=np.float32))
-        hf.create_dataset("pts/locations", data=np.array([p.pt for p in pts], dtype=np.float32))
-        hf.create_dataset("pts/sizes", data=np.array([p.size for p in pts], dtype=np.float32))
-        hf.create_dataset("pts/octaves", data=np.array([p.octave for p in pts], dtype=np.float32))
-        hf.create_dataset("descs", data=descs)
+    with utils.atomic_output_file(out_fname) as tmp_fname:
+        with h5py.File(tmp_fname, 'w') as hf:
+            hf.create_dataset("imageUrl",
+                                data=np.array(image_path.encode("utf-8"), dtype='S'))
+            hf.create_dataset("pts/responses", data=np.array([p.response for p in pts], dtype=np.float32))
+            hf.create_dataset("pts/locations", data=np.array([p.pt for p in pts], dtype=np.float32))
+            hf.create_dataset("pts/sizes", data=np.array([p.size for p in pts], dtype=np.float32))
+            hf.create_dataset("pts/octaves", data=np.array([p.octave for p in pts], dtype=np.float32))
+            hf.create_dataset("descs", data=descs)
 
 
 def create_sift_features(tiles_fname, out_fname, index, conf_fname=None):
@@ -67,8 +67,9 @@ def save_empty_matches_file(out_fname, image_url1, image_url2):
     }]
 
     logger.info("Saving matches into {}".format(out_fname))
-    with open(out_fname, 'w') as out:
-        json.dump(out_data, out, sort_keys=True, indent=4)
+    with utils.atomic_output_file(out_fname) as tmp_fname:
+        with open(tmp_fname, 'w') as out:
+            json.dump(out_data, out, sort_keys=True, indent=4)
 
 
 def dist_after_model(model, p1_l, p2_l):
@@ -158,8 +159,9 @@ def match_single_pair(ts1, ts2, features_file1, features_file2, out_fname, rod,
     }]
 
     logger.info("Saving matches into {}".format(out_fname))
-    with open(out_fname, 'w') as out:
-        json.dump(out_data, out, sort_keys=True, indent=4)
+    with utils.atomic_output_file(out_fname) as tmp_fname:
+        with open(tmp_fname, 'w') as out:
+            json.dump(out_data, out, sort_keys=True, indent=4)
 
     return True
 
@@ -1,4 +1,7 @@
 from ..common import utils
+from ..common.tile_collection import TileCollection
+from ..common.bounding_box import BoundingBoxArray
+from ..common import bbox_index
 import sys
 import os.path
 import os
@@ -9,6 +12,8 @@ from collections import defaultdict
 import json
 
 import glob
+import traceback
+import multiprocessing as mp
 import progressbar
 import numpy as np
 import scipy.sparse as spp
@@ -29,8 +34,7 @@ def find_rotation(p1, p2, stepsize):
 
 def create_new_tilespec(old_ts_fname, rotations, translations, centers, out_fname):
     print("Optimization done, saving tilespec at: {}".format(out_fname))
-    with open(old_ts_fname, 'r') as f:
-        tilespecs = json.load(f)
+    tilespecs = utils.load_tilespecs(old_ts_fname)
 
     # Iterate over the tiles in the original tilespec
     for ts in tilespecs:
@@ -94,6 +98,7 @@ def create_new_tilespec(old_ts_fname, rotations, translations, centers, out_fnam
     with open(out_fname, 'w') as outjson:
         json.dump(tilespecs, outjson, sort_keys=True, indent=4)
         print('Wrote tilespec to {0}'.format(out_fname))
+    bbox_index.update_bbox_index([out_fname], [BoundingBoxArray.fromTilespec(tilespecs).union()])
 
 
 def optimize_2d_mfovs(tiles_fname, match_list_file, out_fname, conf_fname=None):
@@ -117,7 +122,7 @@ def optimize_2d_mfovs(tiles_fname, match_list_file, out_fname, conf_fname=None):
     stepsize = params.get("stepSize", 0.1)
     damping = params.get("damping", 0.01)  # in units of matches per pair
     noemptymatches = params.get("noEmptyMatches", True)
-    tilespec = json.load(open(tiles_fname, 'r'))
+    tiles = TileCollection(utils.load_tilespecs(tiles_fname))
 
     # load the matches
     pbar = progressbar.ProgressBar()
@@ -139,15 +144,9 @@ def optimize_2d_mfovs(tiles_fname, match_list_file, out_fname, conf_fname=None):
         # If we want to add fake points when no matches are found
         elif noemptymatches:
             # Find the images in the tilespec
-            mfov1, mfov2 = -1, -1
-            for t in tilespec:
-                if t['mipmapLevels']['0']['imageUrl'] == url1:
-                    tile1 = t
-                    mfov1 = t["mfov"]
-                if t['mipmapLevels']['0']['imageUrl'] == url2:
-                    tile2 = t
-                    mfov2 = t["mfov"]
-            if mfov1 == -1 or mfov2 == -1 or mfov1 != mfov2:
+            tile1 = tiles.get_by_url(url1)
+            tile2 = tiles.get_by_url(url2)
+            if tile1 is None or tile2 is None or tile1.get("mfov", -1) != tile2.get("mfov", -1):
                 continue
 
             # Determine the region of overlap between the two images
@@ -296,6 +295,56 @@ def optimize_2d_mfovs(tiles_fname, match_list_file, out_fname, conf_fname=None):
     #           indent=4)
     create_new_tilespec(tiles_fname, R, T, centers, out_fname)
 
+
+def _optimize_2d_mfovs_logged(tiles_fname, match_list_file, out_fname, conf_fname, log_fname):
+    """Optimizes a single section while redirecting its output to a per-section log file.
+       Returns True if the section was optimized, and False if an error occurred (the traceback is logged)."""
+    with open(log_fname, 'w') as log_file:
+        orig_stdout, orig_stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = log_file
+        try:
+            optimize_2d_mfovs(tiles_fname, match_list_file, out_fname, conf_fname=conf_fname)
+        except Exception:
+            traceback.print_exc()
+            return False
+        finally:
+            sys.stdout, sys.stderr = orig_stdout, orig_stderr
+    return True
+
+
+def optimize_2d_mfovs_batch(tiles_fnames, match_list_files, out_fnames, conf_fname=None, processes_num=1, logs_dir=None):
+    """Optimizes multiple sections (each with its own tilespec, matches list file and output file) in a single process pool.
+       Each section writes its output to a separate log file (in logs_dir, or next to the section's output file),
+       and a failure in one section does not stop the optimization of the others.
+       Returns the list of output files of the sections that failed."""
+    assert(len(tiles_fnames) == len(match_list_files))
+    assert(len(tiles_fnames) == len(out_fnames))
+
+    print("Optimizing {} sections using {} processes".format(len(tiles_fnames), processes_num))
+    # Each section is executed by a fresh process, so a crashing/leaking section won't affect the others
+    pool = mp.Pool(processes=processes_num, maxtasksperchild=1)
+
+    pool_results = []
+    for tiles_fname, match_list_file, out_fname in zip(tiles_fnames, match_list_files, out_fnames):
+        log_dir = logs_dir if logs_dir is not None else os.path.dirname(out_fname)
+        log_fname = os.path.join(log_dir, "{}.log".format(os.path.splitext(os.path.basename(out_fname))[0]))
+        res = pool.apply_async(_optimize_2d_mfovs_logged, (tiles_fname, match_list_file, out_fname, conf_fname, log_fname))
+        pool_results.append((out_fname, log_fname, res))
+
+    failed_out_fnames = []
+    for out_fname, log_fname, res in pool_results:
+        if res.get():
+            print("Optimized section: {} (log: {})".format(out_fname, log_fname))
+        else:
+            print("Error while optimizing section: {} (see log: {})".format(out_fname, log_fname))
+            failed_out_fnames.append(out_fname)
+
+    pool.close()
+    pool.join()
+
+    print("Optimized {} out of {} sections".format(len(out_fnames) - len(failed_out_fnames), len(out_fnames)))
+    return failed_out_fnames
+
 if __name__ == '__main__':
     # Command line parser
     parser = argparse.ArgumentParser(description='Iterates over a directory that contains matched points in json files, \
@@ -12,12 +12,11 @@ import os
 import subprocess
 import datetime
 import time
-import itertools
 import argparse
 import glob
 import json
 from utils import create_dir, read_layer_from_file, parse_range, load_tilespecs, write_list_to_file
-from rh_aligner.common.bounding_box import BoundingBox
+from rh_aligner.common.bounding_box import BoundingBoxArray
 from job import Job
 
 
@@ -209,6 +208,62 @@ class OptimizeMontageTransform(Job):
                 os.path.join(os.environ['ALIGNER'], 'scripts', 'wrappers', 'optimize_2d_mfovs.py'),
                 self.output_file, self.conf_fname, self.tiles_fname, self.matches_list_file]
 
+class OptimizeMultipleMontageTransform(Job):
+    def __init__(self, work_dir, temp_files_prefix, conf_fname=None, threads_num=1):
+        Job.__init__(self)
+        self.already_done = False
+        self.dependencies = []
+        self.tiles_fnames_list = []
+        self.matches_list_files_list = []
+        self.output_files_list = []
+        if conf_fname is None:
+            self.conf_fname = ''
+        else:
+            self.conf_fname = '-c "{0}"'.format(conf_fname)
+        self.threads = threads_num
+        self.threads_str = "-t {0}".format(threads_num)
+        self.memory = 4000
+        self.time = 0
+        self.work_dir = work_dir
+        self.temp_files_prefix = temp_files_prefix
+        self.logs_dir = '-l "{0}"'.format(work_dir)
+
+    def add_job(self, dependencies, tiles_fname, matches_list_file, opt_output_file):
+        self.tiles_fnames_list.append(tiles_fname)
+        self.matches_list_files_list.append(matches_list_file)
+        self.output_files_list.append(opt_output_file)
+        for d in dependencies:
+            if d not in self.dependencies:
+                self.dependencies.append(d)
+        self.output.append(opt_output_file)
+        # The sections are optimized concurrently by self.threads processes (600 minutes per section)
+        self.time = 600 * ((len(self.output_files_list) + self.threads - 1) // self.threads)
+
+    def prepare_files(self):
+        if len(self.output_files_list) > 0:
+            tmp_tiles_fnames = os.path.join(self.work_dir, "{}_tiles_lst.txt".format(self.temp_files_prefix))
+            tmp_matches_list_files = os.path.join(self.work_dir, "{}_matches_lsts.txt".format(self.temp_files_prefix))
+            tmp_output_files = os.path.join(self.work_dir, "{}_outputs_lst.txt".format(self.temp_files_prefix))
+            with open(tmp_tiles_fnames, 'w') as f:
+                for item in self.tiles_fnames_list:
+                    f.write("{}\n".format(item))
+            with open(tmp_matches_list_files, 'w') as f:
+                for item in self.matches_list_files_list:
+                    f.write("{}\n".format(item))
+            with open(tmp_output_files, 'w') as f:
+                for item in self.output_files_list:
+                    f.write("{}\n".format(item))
+            self.tiles_fnames = '"{0}"'.format(tmp_tiles_fnames)
+            self.matches_list_files = '"{0}"'.format(tmp_matches_list_files)
+            self.output_files = '-o "{0}"'.format(tmp_output_files)
+
+    def command(self):
+        self.prepare_files()
+        return ['python -u',
+                os.path.join(os.environ['ALIGNER'], 'scripts', 'wrappers', 'optimize_2d_mfovs_batch.py'),
+                self.output_files, self.conf_fname, self.threads_str, self.logs_dir,
+                self.tiles_fnames, self.matches_list_files]
+
 
 
 
@@ -241,6 +296,12 @@ if __name__ == '__main__':
                         help='Run all jobs in blocks on multiple cores')
     parser.add_argument('-mk', '--multicore_keeprunning', action='store_true', 
                         help='Run all jobs in blocks on multiple cores and report cluster jobs execution stats')
+    parser.add_argument('-b', '--montage_batch_size', type=int, 
+                        help='the number of sections that are montage-optimized by a single job (default: 1)',
+                        default=1)
+    parser.add_argument('-bt', '--montage_batch_threads', type=int, 
+                        help='the number of processes that each batched montage-optimization job uses (default: 4)',
+                        default=4)
 
 
     args = parser.parse_args() 
@@ -274,6 +335,20 @@ if __name__ == '__main__':
     
     fixed_tile = 0
 
+    # The sections that wait to be added to a batched montage-optimization job
+    montage_batch = []
+    montage_batches_dir = os.path.join(args.workspace_dir, "montage_batches")
+    if args.montage_batch_size > 1:
+        create_dir(montage_batches_dir)
+
+    def create_montage_batch_job(batch):
+        job_opt_montage = OptimizeMultipleMontageTransform(montage_batches_dir,
+            "montage_batch_{}_{}".format(batch[0][0], batch[-1][0]),
+            conf_fname=args.conf_file_name, threads_num=min(args.montage_batch_threads, len(batch)))
+        for _, dependencies, tiles_fname, matches_list_file, opt_montage_json in batch:
+            job_opt_montage.add_job(dependencies, tiles_fname, matches_list_file, opt_montage_json)
+        return job_opt_montage
+
     for f in sorted(json_files.keys()):
         tiles_fname_prefix = os.path.splitext(os.path.basename(f))[0]
 
@@ -371,63 +446,63 @@ if __name__ == '__main__':
         jobs_match_intra_mfovs = {}
         jobs_match_inter_mfovs = []
         indices = []
-        for pair in itertools.combinations(xrange(len(cur_tilespec)), 2):
+        # find all pairs of overlapping tiles at once (sweeping the tiles by their x coordinate)
+        tiles_bboxes = BoundingBoxArray.fromTilespec(cur_tilespec)
+        overlapping_pairs = tiles_bboxes.overlapping_pairs()
+        for pair in overlapping_pairs:
             idx1 = pair[0]
             idx2 = pair[1]
             ts1 = cur_tilespec[idx1]
             ts2 = cur_tilespec[idx2]
-            # if the two tiles intersect, match them
-            bbox1 = BoundingBox.fromList(ts1["bbox"])
-            bbox2 = BoundingBox.fromList(ts2["bbox"])
-            if bbox1.overlap(bbox2):
-                imageUrl1 = ts1["mipmapLevels"]["0"]["imageUrl"]
-                imageUrl2 = ts2["mipmapLevels"]["0"]["imageUrl"]
-                tile_fname1 = os.path.basename(imageUrl1).split('.')[0]
-                tile_fname2 = os.path.basename(imageUrl2).split('.')[0]
-                index_pair = ["{}_{}".format(ts1["mfov"], ts1["tile_index"]), "{}_{}".format(ts2["mfov"], ts2["tile_index"])]
+            # the two tiles intersect, so match them
+            imageUrl1 = ts1["mipmapLevels"]["0"]["imageUrl"]
+            imageUrl2 = ts2["mipmapLevels"]["0"]["imageUrl"]
+            tile_fname1 = os.path.basename(imageUrl1).split('.')[0]
+            tile_fname2 = os.path.basename(imageUrl2).split('.')[0]
+            index_pair = ["{}_{}".format(ts1["mfov"], ts1["tile_index"]), "{}_{}".format(ts2["mfov"], ts2["tile_index"])]
+            if ts1["mfov"] == ts2["mfov"]:
+                # Intra mfov job
+                cur_match_dir = os.path.join(layer_matched_sifts_intra_dir, str(ts1["mfov"]))
+            else:
+                # Inter mfov job
+                cur_match_dir = layer_matched_sifts_inter_dir
+            match_json = os.path.join(cur_match_dir, "{0}_sift_matches_{1}_{2}.json".format(tiles_fname_prefix, tile_fname1, tile_fname2))
+            # match the features of overlapping tiles
+            if not os.path.exists(match_json):
+                print "Matching sift of tiles: {0} and {1}".format(imageUrl1, imageUrl2)
+                dependencies = [ ]
+                if imageUrl1 in jobs[slayer]['sifts'].keys():
+                    if jobs[slayer]['sifts'][imageUrl1] not in dependencies: # needed because of multiple-sift job
+                        dependencies.append(jobs[slayer]['sifts'][imageUrl1])
+                if imageUrl2 in jobs[slayer]['sifts'].keys():
+                    if jobs[slayer]['sifts'][imageUrl2] not in dependencies: # needed because of multiple-sift job
+                        dependencies.append(jobs[slayer]['sifts'][imageUrl2])
+
+                # Check if the job already exists
                 if ts1["mfov"] == ts2["mfov"]:
                     # Intra mfov job
-                    cur_match_dir = os.path.join(layer_matched_sifts_intra_dir, str(ts1["mfov"]))
+                    if ts1["mfov"] in jobs[slayer]['matched_sifts']['intra'].keys():
+                        job_match = jobs[slayer]['matched_sifts']['intra'][ts1["mfov"]]
+                    else:
+                        job_match = MatchMultipleSiftFeaturesAndFilter(cur_match_dir, layers_data[slayer]['ts'],
+                                "intra_l{}_{}".format(slayer,ts1["mfov"]),
+                                threads_num=4, wait_time=30, conf_fname=args.conf_file_name)
+                        jobs[slayer]['matched_sifts']['intra'][ts1["mfov"]] = job_match
                 else:
                     # Inter mfov job
-                    cur_match_dir = layer_matched_sifts_inter_dir
-                match_json = os.path.join(cur_match_dir, "{0}_sift_matches_{1}_{2}.json".format(tiles_fname_prefix, tile_fname1, tile_fname2))
-                # match the features of overlapping tiles
-                if not os.path.exists(match_json):
-                    print "Matching sift of tiles: {0} and {1}".format(imageUrl1, imageUrl2)
-                    dependencies = [ ]
-                    if imageUrl1 in jobs[slayer]['sifts'].keys():
-                        if jobs[slayer]['sifts'][imageUrl1] not in dependencies: # needed because of multiple-sift job
-                            dependencies.append(jobs[slayer]['sifts'][imageUrl1])
-                    if imageUrl2 in jobs[slayer]['sifts'].keys():
-                        if jobs[slayer]['sifts'][imageUrl2] not in dependencies: # needed because of multiple-sift job
-                            dependencies.append(jobs[slayer]['sifts'][imageUrl2])
-
-                    # Check if the job already exists
-                    if ts1["mfov"] == ts2["mfov"]:
-                        # Intra mfov job
-                        if ts1["mfov"] in jobs[slayer]['matched_sifts']['intra'].keys():
-                            job_match = jobs[slayer]['matched_sifts']['intra'][ts1["mfov"]]
-                        else:
-                            job_match = MatchMultipleSiftFeaturesAndFilter(cur_match_dir, layers_data[slayer]['ts'],
-                                    "intra_l{}_{}".format(slayer,ts1["mfov"]),
-                                    threads_num=4, wait_time=30, conf_fname=args.conf_file_name)
-                            jobs[slayer]['matched_sifts']['intra'][ts1["mfov"]] = job_match
+                    if jobs[slayer]['matched_sifts']['inter'] is None:
+                        job_match = MatchMultipleSiftFeaturesAndFilter(cur_match_dir, layers_data[slayer]['ts'],
+                                "inter_{}".format(slayer),
+                                threads_num=4, wait_time=30, conf_fname=args.conf_file_name)
+                        jobs[slayer]['matched_sifts']['inter'] = job_match
                     else:
-                        # Inter mfov job
-                        if jobs[slayer]['matched_sifts']['inter'] is None:
-                            job_match = MatchMultipleSiftFeaturesAndFilter(cur_match_dir, layers_data[slayer]['ts'],
-                                    "inter_{}".format(slayer),
-                                    threads_num=4, wait_time=30, conf_fname=args.conf_file_name)
-                            jobs[slayer]['matched_sifts']['inter'] = job_match
-                        else:
-                            job_match = jobs[slayer]['matched_sifts']['inter']
-                    job_match.add_job(dependencies, layers_data[slayer]['sifts'][imageUrl1], layers_data[slayer]['sifts'][imageUrl2],
-                            match_json, index_pair)
+                        job_match = jobs[slayer]['matched_sifts']['inter']
+                job_match.add_job(dependencies, layers_data[slayer]['sifts'][imageUrl1], layers_data[slayer]['sifts'][imageUrl2],
+                        match_json, index_pair)
 
 
-                    #jobs[slayer]['matched_sifts'].append(job_match)
-                layers_data[slayer]['matched_sifts'].append(match_json)
+                #jobs[slayer]['matched_sifts'].append(job_match)
+            layers_data[slayer]['matched_sifts'].append(match_json)
 
         # Create a single file that lists all tilespecs and a single file that lists all pmcc matches (the os doesn't support a very long list)
         matches_list_file = os.path.join(args.workspace_dir, "{}_matched_sifts_files.txt".format(tiles_fname_prefix))
@@ -445,9 +520,16 @@ if __name__ == '__main__':
                 dependencies.append(jobs[slayer]['matched_sifts']['inter'])
             if jobs[slayer]['matched_sifts']['intra'] is not None and len(jobs[slayer]['matched_sifts']['intra']) > 0:
                 dependencies.extend(jobs[slayer]['matched_sifts']['intra'].values())
-            job_opt_montage = OptimizeMontageTransform(dependencies, layers_data[slayer]['ts'],
-                matches_list_file, opt_montage_json,
-                conf_fname=args.conf_file_name)
+            if args.montage_batch_size > 1:
+                # Only create the batched job once it is full, so a partially filled job won't be submitted
+                montage_batch.append((slayer, dependencies, layers_data[slayer]['ts'], matches_list_file, opt_montage_json))
+                if len(montage_batch) == args.montage_batch_size:
+                    job_opt_montage = create_montage_batch_job(montage_batch)
+                    montage_batch = []
+            else:
+                job_opt_montage = OptimizeMontageTransform(dependencies, layers_data[slayer]['ts'],
+                    matches_list_file, opt_montage_json,
+                    conf_fname=args.conf_file_name)
         layers_data[slayer]['optimized_montage'] = opt_montage_json
 
         if args.multicore_keeprunning:
@@ -458,6 +540,11 @@ if __name__ == '__main__':
 
 
 
+    # Create a job for the remaining sections that need to be montage-optimized
+    if len(montage_batch) > 0:
+        create_montage_batch_job(montage_batch)
+        montage_batch = []
+
     # Run all jobs
     if args.keeprunning:
         Job.keep_running()
@@ -12,12 +12,11 @@ import os
 import subprocess
 import datetime
 import time
-import itertools
 import argparse
 import glob
 import json
 from utils import create_dir, read_layer_from_file, parse_range, load_tilespecs, write_list_to_file
-from rh_aligner.common.bounding_box import BoundingBox
+from rh_aligner.common.bounding_box import BoundingBoxArray
 from job import Job
 
 
@@ -271,59 +270,58 @@ def create_post_filter_jobs(slayer, filtered_ts_fname, layers_data, jobs, matche
     jobs_match_intra_mfovs = {}
     jobs_match_inter_mfovs = []
     indices = []
-    # TODO - use some other method to detect overlapping tiles
-    for pair in itertools.combinations(xrange(len(cur_tilespec)), 2):
+    # find all pairs of overlapping tiles at once (sweeping the tiles by their x coordinate)
+    tiles_bboxes = BoundingBoxArray.fromTilespec(cur_tilespec)
+    overlapping_pairs = tiles_bboxes.overlapping_pairs()
+    for pair in overlapping_pairs:
         idx1 = pair[0]
         idx2 = pair[1]
         ts1 = cur_tilespec[idx1]
         ts2 = cur_tilespec[idx2]
-        # if the two tiles intersect, match them
-        bbox1 = BoundingBox.fromList(ts1["bbox"])
-        bbox2 = BoundingBox.fromList(ts2["bbox"])
-        if bbox1.overlap(bbox2):
-            imageUrl1 = ts1["mipmapLevels"]["0"]["imageUrl"]
-            imageUrl2 = ts2["mipmapLevels"]["0"]["imageUrl"]
-            tile_fname1 = os.path.basename(imageUrl1).split('.')[0]
-            tile_fname2 = os.path.basename(imageUrl2).split('.')[0]
-            index_pair = ["{}_{}".format(ts1["mfov"], ts1["tile_index"]), "{}_{}".format(ts2["mfov"], ts2["tile_index"])]
+        # the two tiles intersect, so match them
+        imageUrl1 = ts1["mipmapLevels"]["0"]["imageUrl"]
+        imageUrl2 = ts2["mipmapLevels"]["0"]["imageUrl"]
+        tile_fname1 = os.path.basename(imageUrl1).split('.')[0]
+        tile_fname2 = os.path.basename(imageUrl2).split('.')[0]
+        index_pair = ["{}_{}".format(ts1["mfov"], ts1["tile_index"]), "{}_{}".format(ts2["mfov"], ts2["tile_index"])]
+        if ts1["mfov"] == ts2["mfov"]:
+            # Intra mfov job
+            cur_match_dir = os.path.join(layer_matched_sifts_intra_dir, str(ts1["mfov"]))
+        else:
+            # Inter mfov job
+            cur_match_dir = layer_matched_sifts_inter_dir
+        match_json = os.path.join(cur_match_dir, "{0}_sift_matches_{1}_{2}.json".format(tiles_fname_prefix, tile_fname1, tile_fname2))
+        # match the features of overlapping tiles
+        if not os.path.exists(match_json):
+            print "Matching sift of tiles: {0} and {1}".format(imageUrl1, imageUrl2)
+            # The filter is done, so assumes no dependencies
+            dependencies = [ ]
+
+            # Check if the job already exists
             if ts1["mfov"] == ts2["mfov"]:
                 # Intra mfov job
-                cur_match_dir = os.path.join(layer_matched_sifts_intra_dir, str(ts1["mfov"]))
+                if ts1["mfov"] in jobs[slayer]['matched_sifts']['intra'].keys():
+                    job_match = jobs[slayer]['matched_sifts']['intra'][ts1["mfov"]]
+                else:
+                    job_match = MatchMultipleSiftFeaturesAndFilter(cur_match_dir, filtered_ts_fname,
+                            "intra_l{}_{}".format(slayer,ts1["mfov"]),
+                            threads_num=4, wait_time=None, conf_fname=conf_file_name)
+                    jobs[slayer]['matched_sifts']['intra'][ts1["mfov"]] = job_match
             else:
                 # Inter mfov job
-                cur_match_dir = layer_matched_sifts_inter_dir
-            match_json = os.path.join(cur_match_dir, "{0}_sift_matches_{1}_{2}.json".format(tiles_fname_prefix, tile_fname1, tile_fname2))
-            # match the features of overlapping tiles
-            if not os.path.exists(match_json):
-                print "Matching sift of tiles: {0} and {1}".format(imageUrl1, imageUrl2)
-                # The filter is done, so assumes no dependencies
-                dependencies = [ ]
-
-                # Check if the job already exists
-                if ts1["mfov"] == ts2["mfov"]:
-                    # Intra mfov job
-                    if ts1["mfov"] in jobs[slayer]['matched_sifts']['intra'].keys():
-                        job_match = jobs[slayer]['matched_sifts']['intra'][ts1["mfov"]]
-                    else:
-                        job_match = MatchMultipleSiftFeaturesAndFilter(cur_match_dir, filtered_ts_fname,
-                                "intra_l{}_{}".format(slayer,ts1["mfov"]),
-                                threads_num=4, wait_time=None, conf_fname=conf_file_name)
-                        jobs[slayer]['matched_sifts']['intra'][ts1["mfov"]] = job_match
+                if jobs[slayer]['matched_sifts']['inter'] is None:
+                    job_match = MatchMultipleSiftFeaturesAndFilter(cur_match_dir, filtered_ts_fname,
+                            "inter_{}".format(slayer),
+                            threads_num=4, wait_time=None, conf_fname=conf_file_name)
+                    jobs[slayer]['matched_sifts']['inter'] = job_match
                 else:
-                    # Inter mfov job
-                    if jobs[slayer]['matched_sifts']['inter'] is None:
-                        job_match = MatchMultipleSiftFeaturesAndFilter(cur_match_dir, filtered_ts_fname,
-                                "inter_{}".format(slayer),
-                                threads_num=4, wait_time=None, conf_fname=conf_file_name)
-                        jobs[slayer]['matched_sifts']['inter'] = job_match
-                    else:
-                        job_match = jobs[slayer]['matched_sifts']['inter']
-                job_match.add_job(dependencies, layers_data[slayer]['sifts'][imageUrl1], layers_data[slayer]['sifts'][imageUrl2],
-                        match_json, index_pair)
-
-
-                #jobs[slayer]['matched_sifts'].append(job_match)
-            layers_data[slayer]['matched_sifts'].append(match_json)
+                    job_match = jobs[slayer]['matched_sifts']['inter']
+            job_match.add_job(dependencies, layers_data[slayer]['sifts'][imageUrl1], layers_data[slayer]['sifts'][imageUrl2],
+                    match_json, index_pair)
+
+
+            #jobs[slayer]['matched_sifts'].append(job_match)
+        layers_data[slayer]['matched_sifts'].append(match_json)
 
 
 
@@ -16,17 +16,26 @@ from itertools import product
 from collections import defaultdict
 import argparse
 import glob
-import json
-from utils import write_list_to_file, create_dir, read_layer_from_file, parse_range
+import math
+from utils import write_list_to_file, create_dir, read_layer_from_file, parse_range, load_tilespecs
 from job import Job
 from rh_aligner.common.bounding_box import BoundingBox
+from rh_aligner.common.utils import conf_from_file
 
 
 
 
 
+def dir_size_mb(dir_name):
+    """Returns the total size (in MB) of the files in the given directory tree"""
+    total_size = 0
+    for root, _, fnames in os.walk(dir_name):
+        total_size += sum(os.path.getsize(os.path.join(root, fname)) for fname in fnames)
+    return total_size / (1024.0 ** 2)
+
+
 class PreliminaryMatchLayersMfovs(Job):
-    def __init__(self, tiles_fname1, features_dir1, tiles_fname2, features_dir2, output_fname, conf_fname=None, threads_num=1):
+    def __init__(self, dependencies, tiles_fname1, features_dir1, tiles_fname2, features_dir2, output_fname, conf_fname=None, threads_num=1, initial_pre_matches=None):
         Job.__init__(self)
         self.already_done = False
         self.tiles_fname1 = '"{0}"'.format(tiles_fname1)
@@ -38,10 +47,19 @@ class PreliminaryMatchLayersMfovs(Job):
             self.conf_fname = ''
         else:
             self.conf_fname = '-c "{0}"'.format(conf_fname)
-        self.dependencies = [ ]
-        #self.threads = threads_num
-        #self.threads_str = "-t {0}".format(threads_num)
+        if initial_pre_matches is None:
+            self.initial_pre_matches = ''
+        else:
+            self.initial_pre_matches = '-i "{0}" "{1}"'.format(initial_pre_matches[0], initial_pre_matches[1])
+        self.dependencies = dependencies
+        self.threads = threads_num
+        self.threads_str = "-t {0}".format(threads_num)
         self.memory = 1000
+        if threads_num > 1:
+            # All the features of both sections are preloaded into shared memory (and loaded once more while
+            # they are copied there), so add their size (split between the requested cpus)
+            features_mb = dir_size_mb(features_dir1) + dir_size_mb(features_dir2)
+            self.memory += int(math.ceil(2 * features_mb / threads_num))
         self.time = 300
         self.output = output_fname
         #self.already_done = os.path.exists(self.output_file)
@@ -49,7 +67,30 @@ class PreliminaryMatchLayersMfovs(Job):
     def command(self):
         return ['python -u',
                 os.path.join(os.environ['ALIGNER'], 'scripts', 'wrappers', 'pre_match_3d_incremental.py'),
-                self.output_fname, self.conf_fname, self.tiles_fname1, self.features_dir1, self.tiles_fname2, self.features_dir2]
+                self.output_fname, self.conf_fname, self.threads_str, self.initial_pre_matches,
+                self.tiles_fname1, self.features_dir1, self.tiles_fname2, self.features_dir2]
+
+
+class RenderSectionPyramid(Job):
+    def __init__(self, dependencies, tiles_fname, output_dir, output_fname, conf_fname=None):
+        Job.__init__(self)
+        self.already_done = False
+        self.tiles_fname = '"{0}"'.format(tiles_fname)
+        self.output_dir = '-o "{0}"'.format(output_dir)
+        if conf_fname is None:
+            self.conf_fname = ''
+        else:
+            self.conf_fname = '-c "{0}"'.format(conf_fname)
+        self.dependencies = dependencies
+        self.memory = 4000
+        self.time = 300
+        self.output = output_fname
+        #self.already_done = os.path.exists(self.output_file)
+
+    def command(self):
+        return ['python -u',
+                os.path.join(os.environ['ALIGNER'], 'scripts', 'wrappers', 'render_section_pyramid.py'),
+                self.output_dir, self.conf_fname, self.tiles_fname]
 
 
 class MatchLayersByMaxPMCCMfov(Job):
@@ -85,6 +126,40 @@ class MatchLayersByMaxPMCCMfov(Job):
                 self.tiles_fname1, self.tiles_fname2, self.pre_match_fname, self.targeted_mfov]
 
 
+class MatchLayersByMaxPMCC(Job):
+    def __init__(self, dependencies, tiles_fname1, tiles_fname2, pre_match_fname, output_fname_pattern, outputs, conf_fname=None, threads_num=1, reverse_output_fname_pattern=None):
+        Job.__init__(self)
+        self.already_done = False
+        self.tiles_fname1 = '"{0}"'.format(tiles_fname1)
+        self.tiles_fname2 = '"{0}"'.format(tiles_fname2)
+        self.pre_match_fname = '"{0}"'.format(pre_match_fname)
+        # all the mfovs of the first section are matched (to per-mfov output files)
+        self.targeted_mfov = '-1'
+        self.output_fname = '-o "{0}"'.format(output_fname_pattern)
+        if reverse_output_fname_pattern is None:
+            self.reverse_output_fname = ''
+        else:
+            # the second section mfovs are matched as well (the sections are rendered once for both directions)
+            self.reverse_output_fname = '-r "{0}"'.format(reverse_output_fname_pattern)
+        if conf_fname is None:
+            self.conf_fname = ''
+        else:
+            self.conf_fname = '-c "{0}"'.format(conf_fname)
+        self.threads = threads_num
+        self.threads_str = '-t {0}'.format(threads_num)
+        self.dependencies = dependencies
+        self.memory = 4000 * threads_num
+        self.time = 1440
+        self.output = outputs
+
+    def command(self):
+        return ['python -u',
+                os.path.join(os.environ['ALIGNER'], 'scripts', 'wrappers', 'block_match_3d_multiprocess.py'),
+                self.output_fname, self.reverse_output_fname, self.conf_fname,
+                self.threads_str,
+                self.tiles_fname1, self.tiles_fname2, self.pre_match_fname, self.targeted_mfov]
+
+
 class OptimizeLayersElastic(Job):
     def __init__(self, dependencies, outputs, tiles_fnames, corr_fnames, output_dir, max_layer_distance, conf_fname=None, skip_layers=None, threads_num=1):
         Job.__init__(self)
@@ -174,6 +249,10 @@ if __name__ == '__main__':
                         help='Run all jobs in blocks on multiple cores')
     parser.add_argument('-mk', '--multicore_keeprunning', action='store_true', 
                         help='Run all jobs in blocks on multiple cores and report cluster jobs execution stats')
+    parser.add_argument('--pmcc_mfov_jobs', action='store_true', 
+                        help='Block match each mfov in a separate job (default: a single job per layers pair, for both directions)')
+    parser.add_argument('--pmcc_match_store', action='store_true',
+                        help='Save the block matching results of each (directed) layers pair to a single binary match store file, instead of a json file per mfov (ignored with --pmcc_mfov_jobs)')
 
     args = parser.parse_args() 
 
@@ -214,9 +293,7 @@ if __name__ == '__main__':
     # Make sure we only parse the relevant sections
     for f in json_files.keys():
         # read the layer from the file
-        data = None
-        with open(f, 'r') as data_file:
-            data = json.load(data_file)
+        data = load_tilespecs(f)
         layer = data[0]['layer']
 
         if layer in skipped_layers:
@@ -260,11 +337,11 @@ if __name__ == '__main__':
 
     print "Found the following layers: {0}".format(all_layers)
 
-    # Match each two layers in the required distance
-    all_pmcc_files = []
-    pmcc_jobs = []
-    for layer1_ind, layer1 in enumerate(all_layers):
+    # Find the layers that each layer is matched with (in the required distance, in increasing order)
+    layers_matched_layers = {}
+    for layer1 in all_layers:
         slayer1 = str(layer1)
+        layers_matched_layers[slayer1] = []
         # Process all matched layers
         matched_after_layers = 0
         j = 1
@@ -273,35 +350,116 @@ if __name__ == '__main__':
                 break
 
             layer2 = layer1 + j
-            slayer2 = str(layer2)
             if layer1 in skipped_layers or layer2 in skipped_layers:
                 print "Skipping matching of layers {} and {}, because at least one of them should be skipped".format(layer1, layer2)
                 j += 1
                 continue
 
+            layers_matched_layers[slayer1].append(str(layer2))
+            j += 1
+            matched_after_layers += 1
+
+    # Pre-match the layers pairs, in increasing order of the distance between the layers, so a pair (layer1, layer2)
+    # that has an intermediate layer (the layer that was matched with layer1 just before layer2) can start from
+    # the composition of the pre-matches of (layer1, intermediate layer) and (intermediate layer, layer2). Such a pair
+    # depends on the intermediate pre-match jobs (a pre-match always saves its output, even if it found no match)
+    pre_match_jobs = {}
+    for pair_ind in range(args.max_layer_distance):
+        for layer1 in all_layers:
+            slayer1 = str(layer1)
+            if pair_ind >= len(layers_matched_layers[slayer1]):
+                continue
+            slayer2 = layers_matched_layers[slayer1][pair_ind]
+
             fname1_prefix = layers_data[slayer1]['prefix']
             fname2_prefix = layers_data[slayer2]['prefix']
 
-            job_pre_match = None
-            job_pmcc = None
-
             # match the features of neighboring tiles
             pre_match_json = os.path.join(pre_matches_dir, "{0}_{1}_pre_matches.json".format(fname1_prefix, fname2_prefix))
-            if not os.path.exists(pre_match_json):
-                print "Pre-Matching layers: {0} and {1}".format(layer1, layer2)
-                job_pre_match = PreliminaryMatchLayersMfovs(layers_data[slayer1]['ts'], layers_data[slayer1]['sifts_dir'],
-                    layers_data[slayer2]['ts'], layers_data[slayer2]['sifts_dir'], pre_match_json,
-                    conf_fname=args.conf_file_name)
-                all_running_jobs.append(job_pre_match)
             layers_data[slayer1]['pre_matched_mfovs'][slayer2] = pre_match_json
+            if os.path.exists(pre_match_json):
+                continue
+
+            print "Pre-Matching layers: {0} and {1}".format(slayer1, slayer2)
+            dependencies = [ ]
+            initial_pre_matches = None
+            if pair_ind > 0:
+                slayer_mid = layers_matched_layers[slayer1][pair_ind - 1]
+                if slayer2 in layers_matched_layers[slayer_mid]:
+                    initial_pre_matches = [layers_data[slayer1]['pre_matched_mfovs'][slayer_mid], layers_data[slayer_mid]['pre_matched_mfovs'][slayer2]]
+                    dependencies = [pre_match_jobs[pair] for pair in [(slayer1, slayer_mid), (slayer_mid, slayer2)] if pair in pre_match_jobs]
+            job_pre_match = PreliminaryMatchLayersMfovs(dependencies, layers_data[slayer1]['ts'], layers_data[slayer1]['sifts_dir'],
+                layers_data[slayer2]['ts'], layers_data[slayer2]['sifts_dir'], pre_match_json,
+                conf_fname=args.conf_file_name, threads_num=4, initial_pre_matches=initial_pre_matches)
+            all_running_jobs.append(job_pre_match)
+            pre_match_jobs[(slayer1, slayer2)] = job_pre_match
+
+    # Render each layer once to a (memory mapped) pyramid that the block matching cuts its templates and search windows
+    # from, if a pyramids directory is set in the block matching parameters
+    block_matching_params = conf_from_file(args.conf_file_name, 'MatchLayersBlockMatching')
+    pyramid_cache_dir = None if block_matching_params is None else block_matching_params.get("pyramid_cache_dir", None)
+    pyramid_jobs = {}
+    if pyramid_cache_dir is not None:
+        create_dir(pyramid_cache_dir)
+        for layer in all_layers:
+            slayer = str(layer)
+            pyramid_meta_fname = os.path.join(pyramid_cache_dir, layers_data[slayer]['prefix'], 'pyramid.json')
+            if not os.path.exists(pyramid_meta_fname):
+                print "Rendering the pyramid of layer: {0}".format(slayer)
+                job_pyramid = RenderSectionPyramid([], layers_data[slayer]['ts'], pyramid_cache_dir, pyramid_meta_fname,
+                    conf_fname=args.conf_file_name)
+                all_running_jobs.append(job_pyramid)
+                pyramid_jobs[slayer] = job_pyramid
 
+    # Match each two layers in the required distance
+    all_pmcc_files = []
+    pmcc_jobs = []
+    for layer1_ind, layer1 in enumerate(all_layers):
+        slayer1 = str(layer1)
+        for slayer2 in layers_matched_layers[slayer1]:
+            layer2 = int(slayer2)
+            j = layer2 - layer1
+
+            fname1_prefix = layers_data[slayer1]['prefix']
+            fname2_prefix = layers_data[slayer2]['prefix']
+
+            job_pre_match = pre_match_jobs.get((slayer1, slayer2))
+            job_pmcc = None
+            pyramids_dependencies = [pyramid_jobs[slayer] for slayer in [slayer1, slayer2] if slayer in pyramid_jobs]
+
+
+            if not args.pmcc_mfov_jobs:
+                # match by max PMCC the two layers (all the mfovs of both directions in a single job)
+                if args.pmcc_match_store:
+                    pmcc_fname_pattern = os.path.join(matched_pmcc_dir, "{0}_{1}_match_pmcc.npz".format(fname1_prefix, fname2_prefix))
+                    pmcc_fname2_pattern = os.path.join(matched_pmcc_dir, "{0}_{1}_match_pmcc.npz".format(fname2_prefix, fname1_prefix))
+                    pmcc_fnames = [pmcc_fname_pattern, pmcc_fname2_pattern]
+                else:
+                    pmcc_fname_pattern = os.path.join(matched_pmcc_dir, "{0}_{1}_match_pmcc_mfov_{{mfov}}.json".format(fname1_prefix, fname2_prefix))
+                    pmcc_fname2_pattern = os.path.join(matched_pmcc_dir, "{0}_{1}_match_pmcc_mfov_{{mfov}}.json".format(fname2_prefix, fname1_prefix))
+                    pmcc_fnames = [pmcc_fname_pattern.format(mfov=mfov) for mfov in mfovs_per_layer[slayer1]] + \
+                                  [pmcc_fname2_pattern.format(mfov=mfov) for mfov in mfovs_per_layer[slayer2]]
+                if not all([os.path.exists(pmcc_fname) for pmcc_fname in pmcc_fnames]):
+                    print "Matching layers by Max PMCC: {0} and {1}".format(slayer1, slayer2)
+                    dependencies = list(pyramids_dependencies)
+                    if job_pre_match != None:
+                        dependencies.append(job_pre_match)
+
+                    job_pmcc = MatchLayersByMaxPMCC(dependencies, layers_data[slayer1]['ts'], layers_data[slayer2]['ts'],
+                        layers_data[slayer1]['pre_matched_mfovs'][slayer2],
+                        pmcc_fname_pattern, pmcc_fnames,
+                        conf_fname=args.conf_file_name, threads_num=8, reverse_output_fname_pattern=pmcc_fname2_pattern)
+                    all_running_jobs.append(job_pmcc)
+                    pmcc_jobs.append(job_pmcc)
+                all_pmcc_files.extend(pmcc_fnames)
+                continue
 
             # match by max PMCC the two layers (mfov after mfov)
             for mfov1 in mfovs_per_layer[slayer1]:
                 pmcc_fname_mfov1 = os.path.join(matched_pmcc_dir, "{0}_{1}_match_pmcc_mfov_{2}.json".format(fname1_prefix, fname2_prefix, mfov1))
                 if not os.path.exists(pmcc_fname_mfov1):
                     print "Matching layers by Max PMCC: {0} (mfov {1}) and {2}".format(i, mfov1, i + j)
-                    dependencies = [ ]
+                    dependencies = list(pyramids_dependencies)
                     if job_pre_match != None:
                         dependencies.append(job_pre_match)
 
@@ -319,7 +477,7 @@ if __name__ == '__main__':
                 pmcc_fname2_mfov2 = os.path.join(matched_pmcc_dir, "{0}_{1}_match_pmcc_mfov_{2}.json".format(fname2_prefix, fname1_prefix, mfov2))
                 if not os.path.exists(pmcc_fname2_mfov2):
                     print "Matching layers by Max PMCC: {0} (mfov {1}) and {2}".format(i + j, mfov2, i)
-                    dependencies = [ ]
+                    dependencies = list(pyramids_dependencies)
                     if job_pre_match != None:
                         dependencies.append(job_pre_match)
 
@@ -338,11 +496,6 @@ if __name__ == '__main__':
 
 
 
-            j += 1
-            matched_after_layers += 1
-
-
-
     print "all_pmcc_files: {0}".format(all_pmcc_files)
 
     # Create a single file that lists all tilespecs and a single file that lists all pmcc matches (the os doesn't support a very long list)
@@ -13,9 +13,9 @@ def main():
     parser.add_argument('pre_matches_file', metavar='pre_matches_file', type=str,
                         help='a json file that contains the preliminary matches')
     parser.add_argument('mfov', type=int,
-                        help='the mfov number of compare')
+                        help='the mfov number of compare (-1 for all the mfovs, where the output file name should include "{mfov}", unless it is an npz match store)')
     parser.add_argument('-o', '--output_file', type=str,
-                        help='an output correspondent_spec file, that will include the matches between the sections (default: ./matches.json)',
+                        help='an output correspondent_spec file, that will include the matches between the sections, or an npz match store of all the matched mfovs (default: ./matches.json)',
                         default='./matches.json')
     parser.add_argument('-c', '--conf_file_name', type=str,
                         help='the configuration file with the parameters for each step of the alignment process in json format (uses default parameters, if not supplied)',
@@ -23,12 +23,16 @@ def main():
     parser.add_argument('-t', '--threads_num', type=int,
                         help='the number of threads (processes) to use (default: 1)',
                         default=1)
+    parser.add_argument('-r', '--reverse_output_file', type=str,
+                        help='when all the mfovs are matched (mfov -1), also match the second section mfovs to the first section, and save them to this file name (should include "{mfov}", unless it is an npz match store)',
+                        default=None)
 
     args = parser.parse_args()
     match_layers_pmcc_matching(args.tiles_file1, args.tiles_file2,
                                args.pre_matches_file, args.output_file,
                                args.mfov,
-                               conf_fname=args.conf_file_name, processes_num=args.threads_num)
+                               conf_fname=args.conf_file_name, processes_num=args.threads_num,
+                               reverse_out_fname=args.reverse_output_file)
 
 if __name__ == '__main__':
     main()
@@ -1,23 +1,8 @@
 from rh_aligner.stitching.match_sift_features_and_filter_cv2 import match_single_sift_features_and_filter, match_multiple_sift_features_and_filter
-import os
-import time
+from rh_aligner.common.utils import wait_after_file
 import argparse
 import re
 
-def wait_after_file(filename, timeout_seconds):
-    if timeout_seconds > 0:
-        cur_time = time.time()
-        mod_time = os.path.getmtime(filename)
-        end_wait_time = mod_time + timeout_seconds
-        while cur_time < end_wait_time:
-            print "Waiting for file: {}".format(filename)
-            cur_time = time.time()
-            mod_time = os.path.getmtime(filename)
-            end_wait_time = mod_time + timeout_seconds
-            if cur_time < end_wait_time:
-                time.sleep(end_wait_time - cur_time)
-
-
 def main():
     # Command line parser
     parser = argparse.ArgumentParser(description='Iterates over the tilespecs in a file, computing matches for each overlapping tile.')
@@ -0,0 +1,44 @@
+from rh_aligner.stitching.optimize_2d_mfovs import optimize_2d_mfovs_batch
+import sys
+import argparse
+
+
+def read_list_file(list_fname):
+    with open(list_fname, 'r') as list_file:
+        return [fname.strip() for fname in list_file.readlines() if len(fname.strip()) > 0]
+
+
+def main():
+    # Command line parser
+    parser = argparse.ArgumentParser(description='Optimizes the montage of multiple sections in a single process pool. \
+        Each section is given by its tilespec file, a txt file that lists its match files, and an output tilespec file.')
+    parser.add_argument('tiles_fnames_list', metavar='tiles_fnames_list', type=str,
+                        help='a txt file containing a list of tile_spec files (one per section)')
+    parser.add_argument('match_files_lists', metavar='match_files_lists', type=str,
+                        help='a txt file containing a list of txt files, each lists all the match files of the corresponding section')
+    parser.add_argument('-o', '--output_files_list', type=str, required=True,
+                        help='a txt file containing a list of output tile_spec files, each will include the rotations for all tiles of the corresponding section')
+    parser.add_argument('-c', '--conf_file_name', type=str,
+                        help='the configuration file with the parameters for each step of the alignment process in json format (uses default parameters, if not supplied)',
+                        default=None)
+    parser.add_argument('-t', '--threads_num', type=int,
+                        help='the number of processes to use (default: 1)',
+                        default=1)
+    parser.add_argument('-l', '--logs_dir', type=str,
+                        help='a directory where the per-section log files will be saved (default: the directory of each output file)',
+                        default=None)
+
+    args = parser.parse_args()
+
+    tiles_fnames = read_list_file(args.tiles_fnames_list)
+    match_list_files = read_list_file(args.match_files_lists)
+    out_fnames = read_list_file(args.output_files_list)
+
+    failed_out_fnames = optimize_2d_mfovs_batch(tiles_fnames, match_list_files, out_fnames,
+                                                conf_fname=args.conf_file_name, processes_num=args.threads_num,
+                                                logs_dir=args.logs_dir)
+    if len(failed_out_fnames) > 0:
+        sys.exit("Failed optimizing {} sections: {}".format(len(failed_out_fnames), failed_out_fnames))
+
+if __name__ == '__main__':
+    main()
@@ -19,12 +19,20 @@ def main():
     parser.add_argument('-c', '--conf_file_name', type=str,
                         help='the configuration file with the parameters for each step of the alignment process in json format (uses default parameters, if not supplied)',
                         default=None)
+    parser.add_argument('-t', '--threads_num', type=int,
+                        help='the number of processes to use for the per-mfov matching (default: 1)',
+                        default=1)
+    parser.add_argument('-i', '--initial_pre_matches', type=str, nargs=2, metavar=('pre_matches1', 'pre_matches2'),
+                        help='the pre-matches files of the first section to an intermediate section, and of the intermediate section to the second section, '
+                             'whose composed transformations are verified before searching (default: search all mfovs)',
+                        default=None)
 
     args = parser.parse_args()
 
     match_layers_sift_features(args.tiles_file1, args.features_dir1,
                                args.tiles_file2, args.features_dir2, args.output_file,
-                               conf_fname=args.conf_file_name)
+                               conf_fname=args.conf_file_name, processes_num=args.threads_num,
+                               initial_pre_matches_fnames=args.initial_pre_matches)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,23 @@
+from __future__ import print_function
+from rh_aligner.alignment.section_pyramid import render_layer_pyramid
+import argparse
+
+def main():
+    # Command line parser
+    parser = argparse.ArgumentParser(description='Renders a section (once) into a memory mapped multi-resolution pyramid, that the block matching cuts its templates and search windows from.')
+    parser.add_argument('tiles_file', metavar='tiles_file', type=str,
+                        help='the layer json file containing tilespecs')
+    parser.add_argument('-o', '--output_dir', type=str,
+                        help='the pyramids directory (the section pyramid is saved in a sub-directory named after the tilespec file) (default: ./pyramids)',
+                        default='./pyramids')
+    parser.add_argument('-c', '--conf_file_name', type=str,
+                        help='the configuration file with the parameters for each step of the alignment process in json format (uses default parameters, if not supplied)',
+                        default=None)
+
+    args = parser.parse_args()
+
+    render_layer_pyramid(args.tiles_file, args.output_dir, conf_fname=args.conf_file_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+from rh_aligner.alignment import block_match_3d_multiprocess as bm
+import numpy as np
+import cv2
+import shutil
+import tempfile
+import os
+import unittest
+
+
+class TestPMCCMatchingRegions(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        image1 = cv2.GaussianBlur(rng.randint(0, 255, (600, 600)).astype(np.uint8), (0, 0), 2.5)
+        # Section 1 is a memory mapped (pyramid level) region, and section 2 is section 1 moved by (3, 5)
+        level_fname = os.path.join(self.tmp_dir, 'level_0.npy')
+        np.save(level_fname, image1)
+        self.region1 = bm.RenderedRegion(np.load(level_fname, mmap_mode='r'), (0, 0))
+        image2 = np.zeros_like(image1)
+        image2[5:, 3:] = image1[:-5, :-3]
+        self.region2 = bm.RenderedRegion(image2, (0, 0))
+        self.transform = np.array([[1., 0., 0.], [0., 1., 0.]])
+        self.matching_args = (self.transform, 1.0, 40, 80, 0.3, 10, 0.9, False, None, None)
+        self.points = np.array([[x, y] for x in range(100, 501, 50) for y in range(100, 501, 50)], dtype=np.float64)
+
+    def tearDown(self):
+        del self.region1
+        shutil.rmtree(self.tmp_dir)
+
+    def test_01_share_region(self):
+        self.assertIs(bm.share_region(self.region1), self.region1)
+        self.assertIsNone(bm.share_region(None))
+        transformed_region = bm.TransformedRegion(self.region1, self.transform, 1.0)
+        self.assertIs(bm.share_region(transformed_region), transformed_region)
+        shared_region = bm.share_region(self.region2)
+        self.assertIsInstance(shared_region, bm.SharedRenderedRegion)
+        np.testing.assert_array_equal(bm.unshare_region(shared_region).image, self.region2.image)
+
+    def test_02_transformed_memmap_region_processes(self):
+        # The single mfov mode with sections pyramids matches a TransformedRegion of a memory mapped section
+        img1_region = bm.TransformedRegion(self.region1, self.transform, 1.0)
+        matches, failures_counts, _ = bm.run_pmcc_matching(self.points, img1_region, self.region2, self.matching_args, processes_num=1)
+        processes_matches, processes_failures_counts, _ = bm.run_pmcc_matching(self.points, img1_region, self.region2, self.matching_args, processes_num=2)
+        self.assertEqual(len(matches), len(self.points))
+        np.testing.assert_allclose(matches[:, 2:4] - matches[:, :2], np.tile([3., 5.], (len(matches), 1)), atol=0.5)
+        order = np.lexsort(matches[:, :2].T)
+        processes_order = np.lexsort(processes_matches[:, :2].T)
+        np.testing.assert_allclose(processes_matches[processes_order], matches[order])
+        np.testing.assert_array_equal(processes_failures_counts, failures_counts)
+
+    def test_03_adaptive_empty_templates(self):
+        # The left part of the sections is empty, so only its coarse points are evaluated (and fail, without densification)
+        image1 = np.array(self.region1.image)
+        image1[:, :260] = 128
+        image2 = np.zeros_like(image1)
+        image2[5:, 3:] = image1[:-5, :-3]
+        matching_args = self.matching_args[:-1] + ((1.0, 0.0), )
+        points = np.array([[x, y] for x in range(100, 501, 25) for y in range(100, 501, 25)], dtype=np.float64)
+        matches, failures_counts, empty_mask = bm.run_adaptive_pmcc_matching(points, bm.RenderedRegion(image1, (0, 0)), bm.RenderedRegion(image2, (0, 0)),
+                                                                             matching_args, (100, 5.0, 6))
+        coarse_empty = [i for i in bm.adaptive_points_subset(points, 100) if points[i, 0] + 20 < 260]
+        self.assertEqual(sorted(np.nonzero(empty_mask)[0]), coarse_empty)
+        self.assertEqual(failures_counts[bm.PMCC_filter.FAIL_PMCC_EMPTY_TEMPLATE], len(coarse_empty))
+        # The rest of the coarse points are matched, so no points are added around the empty templates
+        self.assertEqual(np.sum(failures_counts) + len(matches), len(bm.adaptive_points_subset(points, 100)))
+
+    def test_04_adaptive_processes(self):
+        # The adaptive matching uses a single pool for all its rounds, and gets the same matches as a single process
+        # (a negative maximal local curvature densifies around every match, so there are several rounds)
+        points = np.array([[x, y] for x in range(100, 501, 25) for y in range(100, 501, 25)], dtype=np.float64)
+        img1_region = bm.TransformedRegion(self.region1, self.transform, 1.0)
+        adaptive_args = (100, 1e9, 6, -1.0)
+        matches, failures_counts, _ = bm.run_adaptive_pmcc_matching(points, img1_region, self.region2, self.matching_args, adaptive_args)
+        processes_matches, processes_failures_counts, _ = bm.run_adaptive_pmcc_matching(points, img1_region, self.region2, self.matching_args, adaptive_args, processes_num=2)
+        order = np.lexsort(matches[:, :2].T)
+        processes_order = np.lexsort(processes_matches[:, :2].T)
+        np.testing.assert_allclose(processes_matches[processes_order], matches[order])
+        np.testing.assert_array_equal(processes_failures_counts, failures_counts)
+        self.assertEqual(np.sum(failures_counts) + len(matches), len(points))
+
+    def test_05_local_model_curvatures(self):
+        # The left half of the points is translated, and the right half is also rotated, so only the matches near the
+        # boundary have neighbors with different local models
+        pts1 = np.array([[x, y] for x in range(0, 1000, 100) for y in range(0, 1000, 100)], dtype=np.float64)
+        pts2 = pts1 + 10
+        right = pts1[:, 0] >= 500
+        angle = 0.05
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        pts2[right] = np.dot(pts1[right] - [500, 0], rotation.T) + [510, 10]
+        matches = np.column_stack((pts1, pts2, np.ones((len(pts1), ))))
+        curvatures = bm.local_model_curvatures(matches, 4)
+        far = np.abs(pts1[:, 0] - 450) > 200
+        np.testing.assert_allclose(curvatures[far], 0, atol=1e-9)
+        self.assertTrue(np.all(curvatures[(pts1[:, 0] == 400) | (pts1[:, 0] == 500)] > 1e-5))
+        self.assertTrue(np.all(np.isnan(bm.local_model_curvatures(matches[:3], 4))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+from rh_aligner.common.bounding_box import BoundingBox, BoundingBoxArray
+import numpy as np
+import shutil
+import tempfile
+import json
+import os
+import unittest
+
+
+class TestBoundingBoxArray(unittest.TestCase):
+    def setUp(self):
+        self.bboxes_list = [[0, 10, 0, 10], [5, 15, 5, 15], [20, 30, 0, 10], [10, 20, 10, 20]]
+        self.bboxes = BoundingBoxArray(self.bboxes_list)
+
+    def test_01_overlap_matrix(self):
+        result = self.bboxes.overlap_matrix()
+        for i, bbox1 in enumerate(self.bboxes_list):
+            for j, bbox2 in enumerate(self.bboxes_list):
+                self.assertEqual(result[i, j], BoundingBox.fromList(bbox1).overlap(BoundingBox.fromList(bbox2)))
+
+    def test_02_query_overlapping(self):
+        np.testing.assert_array_equal(self.bboxes.query_overlapping(BoundingBox(8, 12, 8, 12)), [0, 1, 3])
+        np.testing.assert_array_equal(self.bboxes.query_overlapping([100, 200, 100, 200]), [])
+
+    def test_03_contains(self):
+        pts = np.array([[0, 0], [10, 10], [25, 5]])
+        result = self.bboxes.contains(pts)
+        self.assertEqual(result.shape, (4, 3))
+        for i, bbox in enumerate(self.bboxes_list):
+            np.testing.assert_array_equal(result[i], BoundingBox.fromList(bbox).contains(pts))
+
+    def test_04_union_intersect_expand(self):
+        self.assertEqual(self.bboxes.union().toArray(), [0, 30, 0, 20])
+        self.assertIsNone(BoundingBoxArray([]).union())
+        np.testing.assert_array_equal(self.bboxes.intersect(BoundingBox(5, 25, 5, 25)).bboxes,
+                                      [[5, 10, 5, 10], [5, 15, 5, 15], [20, 25, 5, 10], [10, 20, 10, 20]])
+        np.testing.assert_array_equal(self.bboxes[[0, 2]].expand(offset=1).bboxes,
+                                      [[-1, 11, -1, 11], [19, 31, -1, 11]])
+        self.assertEqual(self.bboxes[1].expand(scale=0.5).toArray(),
+                         self.bboxes[[1]].expand(scale=0.5)[0].toArray())
+
+    def test_05_overlapping_pairs(self):
+        np.testing.assert_array_equal(self.bboxes.overlapping_pairs(), [[0, 1], [1, 3]])
+        self.assertEqual(BoundingBoxArray([]).overlapping_pairs().shape, (0, 2))
+        # A grid of (integer, so with touching and equal from_x) tiles, in a shuffled order
+        rng = np.random.RandomState(29)
+        corners = rng.permutation([[x, y] for x in range(0, 2000, 90) for y in range(0, 1000, 90)])
+        tiles = BoundingBoxArray(np.column_stack((corners[:, 0], corners[:, 0] + 100, corners[:, 1], corners[:, 1] + rng.randint(90, 200, len(corners)))))
+        expected = np.transpose(np.nonzero(np.triu(tiles.overlap_matrix(), 1)))
+        np.testing.assert_array_equal(tiles.overlapping_pairs(), expected)
+
+
+class TestReadBboxStream(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        r = np.random.RandomState(5050)
+        self.tilespecs = [{"mipmapLevels": {"0": {"imageUrl": "file:///tile_{}.bmp".format(i)}},
+                           "bbox": [float(x), float(x) + 2560.5, float(y), float(y) + 2208.25],
+                           "layer": 1}
+                          for i, (x, y) in enumerate(r.uniform(-5000, 50000, (20, 2)))]
+        self.tiles_fname = os.path.join(self.tmp_dir, "tiles.json")
+        with open(self.tiles_fname, 'w') as out:
+            json.dump(self.tilespecs, out, indent=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_01_chunk_boundaries(self):
+        # With tiny chunks, the "bbox" fields straddle the chunks boundaries at every possible offset
+        with open(self.tiles_fname, 'r') as data_file:
+            expected = BoundingBoxArray.fromTilespec(json.load(data_file)).union().toArray()
+        for chunk_size in [1, 2, 5, 7, 13, 64, 1024 * 1024]:
+            self.assertEqual(BoundingBox.read_bbox_stream(self.tiles_fname, chunk_size=chunk_size).toArray(), expected)
+        self.assertEqual(BoundingBox.read_bbox("file://" + self.tiles_fname), expected)
+
+    def test_02_no_bbox(self):
+        with open(self.tiles_fname, 'w') as out:
+            json.dump([{"layer": 1}], out)
+        self.assertIsNone(BoundingBox.read_bbox_stream(self.tiles_fname, chunk_size=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
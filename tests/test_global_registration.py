@@ -0,0 +1,41 @@
+from rh_aligner.alignment import global_registration
+import numpy as np
+import cv2
+import unittest
+
+
+class TestEstimateRigidTransform(unittest.TestCase):
+    def setUp(self):
+        # A textured tissue-like area (with an asymmetric boundary) in an empty image
+        r = np.random.RandomState(4040)
+        texture = cv2.GaussianBlur(r.uniform(0, 255, (400, 400)).astype(np.float32), (0, 0), 3)
+        mask = np.zeros((400, 400), dtype=np.float32)
+        cv2.fillPoly(mask, [np.array([[110, 90], [300, 120], [290, 260], [200, 310], [100, 240]], dtype=np.int32)], 1.0)
+        self.img1 = texture * mask
+
+    def check_transform(self, angle_degrees, shift):
+        matrix = cv2.getRotationMatrix2D((200, 200), angle_degrees, 1.0)
+        matrix[:, 2] += shift
+        img2 = cv2.warpAffine(self.img1, matrix, (400, 400), flags=cv2.INTER_LINEAR)
+        estimated_matrix, response = global_registration.estimate_rigid_transform(self.img1, img2)
+        # Compare the mapping of the tissue area's corners
+        points = np.array([[110., 90.], [300., 120.], [290., 260.], [200., 310.], [100., 240.]])
+        expected_points = np.dot(points, matrix[:, :2].T) + matrix[:, 2]
+        estimated_points = np.dot(points, estimated_matrix[:, :2].T) + estimated_matrix[:, 2]
+        self.assertLess(np.max(np.linalg.norm(estimated_points - expected_points, axis=1)), 0.2)
+        self.assertGreater(response, 0.5)
+
+    def test_01_translation(self):
+        self.check_transform(0, (12., -7.))
+
+    def test_02_rotations(self):
+        self.check_transform(15, (5., 3.))
+        self.check_transform(-30, (-8., 10.))
+
+    def test_03_rotation_beyond_pi_ambiguity(self):
+        # The spectra only determine the rotation up to pi, so the translation response chooses between the two
+        self.check_transform(120, (4., -6.))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+from rh_aligner.alignment import pre_match_3d_incremental
+import numpy as np
+import unittest
+
+
+def make_features_index(mfovs_features):
+    """Returns a SectionFeaturesIndex (with exact nearest neighbors) whose mfovs features are already loaded"""
+    features_index = pre_match_3d_incremental.SectionFeaturesIndex(None, None)
+    for mfov, (points, descs) in mfovs_features.items():
+        features_index.mfovs_features[mfov] = (points, np.ones((len(points), )), descs)
+    return features_index
+
+
+def sorted_matches(match_points):
+    """Returns the (point1, point2) rows of a 2xNx2 matches array, sorted"""
+    rows = np.hstack((match_points[0], match_points[1]))
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+class TestIncrementalCrossCheckMatcher(unittest.TestCase):
+    def setUp(self):
+        r = np.random.RandomState(3030)
+        # Section 2 mfovs have noisy copies of some of the section 1 features, and other (random) features
+        self.features1 = {1: (r.uniform(size=(40, 2)) * 1000, r.uniform(size=(40, 16)).astype(np.float32)),
+                          2: (r.uniform(size=(30, 2)) * 1000, r.uniform(size=(30, 16)).astype(np.float32))}
+        all_descs1 = np.vstack((self.features1[1][1], self.features1[2][1]))
+        self.features2 = {}
+        for mfov2, features_num in [(1, 25), (2, 0), (3, 35)]:
+            copied_idxs = r.choice(len(all_descs1), features_num // 2, replace=False)
+            descs = np.vstack((all_descs1[copied_idxs] + r.normal(scale=0.02, size=(len(copied_idxs), 16)),
+                               r.uniform(size=(features_num - len(copied_idxs), 16)))).astype(np.float32)
+            self.features2[mfov2] = (r.uniform(size=(features_num, 2)) * 1000, descs)
+        self.features_index1 = make_features_index(self.features1)
+        self.features_index2 = make_features_index(self.features2)
+
+    def test_01_incremental_same_as_one_shot(self):
+        matcher = pre_match_3d_incremental.IncrementalCrossCheckMatcher(self.features_index1, [1, 2], self.features_index2)
+        matcher.add_mfovs([3])
+        matcher.add_mfovs([2, 1])
+        self.assertEqual(len(matcher), 60)
+
+        points1, _, descs1 = self.features_index1.get_mfovs_features([1, 2])
+        points2, _, descs2 = self.features_index2.get_mfovs_features([3, 2, 1])
+        expected = pre_match_3d_incremental.generatematches_crosscheck_cv2(points1, points2, descs1, descs2, None)
+        self.assertGreater(expected.shape[1], 0)
+        np.testing.assert_array_equal(sorted_matches(matcher.get_match_points()), sorted_matches(expected))
+
+    def test_02_no_section2_features(self):
+        matcher = pre_match_3d_incremental.IncrementalCrossCheckMatcher(self.features_index1, [1, 2], self.features_index2)
+        matcher.add_mfovs([2])
+        self.assertEqual(len(matcher), 0)
+        self.assertEqual(matcher.get_match_points().shape[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+from rh_aligner.common.match_store import MatchStore, save_match_store, load_match_store
+import numpy as np
+import shutil
+import tempfile
+import os
+import unittest
+
+
+class TestMatchStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_01_save_load(self):
+        rng = np.random.RandomState(0)
+        mfovs_matches = [(mfov, rng.rand(matches_num, 5), [matches_num, 1, 0, 0, 2, 0], 0.5 * mfov)
+                         for mfov, matches_num in [(3, 7), (1, 0), (2, 12)]]
+        store = MatchStore.from_mfovs_matches('/tmp/sec1.json', '/tmp/sec2.json', 1500, mfovs_matches)
+        out_fname = os.path.join(self.tmp_dir, 'sec1_sec2_match_pmcc.npz')
+        save_match_store(out_fname, store)
+        self.assertTrue(os.path.exists(out_fname))
+
+        loaded = load_match_store(out_fname)
+        self.assertEqual(loaded.tilespec1, '/tmp/sec1.json')
+        self.assertEqual(loaded.tilespec2, '/tmp/sec2.json')
+        self.assertEqual(loaded.hex_spacing, 1500)
+        self.assertEqual(loaded.mfovs.tolist(), [1, 2, 3])
+        self.assertEqual(len(loaded.point1), 19)
+        for mfov, matches, failures, runtime in mfovs_matches:
+            point1, point2, match_val = loaded.mfov_matches(mfov)
+            np.testing.assert_array_equal(point1, matches[:, :2])
+            np.testing.assert_array_equal(point2, matches[:, 2:4])
+            np.testing.assert_array_equal(match_val, matches[:, 4])
+            self.assertEqual(loaded.failures[loaded.mfovs.tolist().index(mfov)].tolist(), failures)
+        self.assertEqual(len(loaded.mfov_matches(4)[0]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
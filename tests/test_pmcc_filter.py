@@ -0,0 +1,53 @@
+from rh_aligner.alignment import PMCC_filter
+import numpy as np
+import cv2
+import unittest
+
+
+def make_pairs(pairs_num, seed=0):
+    """Returns a list of search windows, a list of templates (cut from the windows, or random), and the location of
+       each template in its window (or None for random templates)"""
+    rng = np.random.RandomState(seed)
+    section = cv2.GaussianBlur(rng.randint(0, 255, (800, 800)).astype(np.uint8), (0, 0), 2.5)
+    windows = []
+    templates = []
+    locations = []
+    for i in range(pairs_num):
+        y, x = rng.randint(0, 600, 2)
+        window = section[y:y + 161, x:x + 161]
+        if i % 4 == 3:
+            templates.append(rng.randint(0, 255, (41, 41)).astype(np.uint8))
+            locations.append(None)
+        else:
+            ty, tx = rng.randint(5, 115, 2)
+            templates.append(window[ty:ty + 41, tx:tx + 41].copy())
+            locations.append((ty, tx))
+        windows.append(window)
+    return windows, templates, locations
+
+
+class TestPMCCMatch(unittest.TestCase):
+    def test_01_locations(self):
+        windows, templates, expected_locations = make_pairs(16, seed=1)
+        for window, template, expected_location in zip(windows, templates, expected_locations):
+            result, reason, match_val = PMCC_filter.PMCC_match(window, template)
+            if expected_location is None:
+                self.assertIsNone(result)
+            else:
+                self.assertTrue(result)
+                np.testing.assert_allclose(reason, expected_location, atol=0.1)
+                self.assertGreater(match_val, 0.99)
+
+    def test_02_second_best_ratio(self):
+        # A template that appears twice in the window fails on the ratio of the two highest maxima
+        windows, templates, _ = make_pairs(2, seed=2)
+        window = np.array(windows[0])
+        window[10:51, 10:51] = templates[1]
+        window[100:141, 100:141] = templates[1]
+        result, reason, match_val = PMCC_filter.PMCC_match(window, templates[1])
+        self.assertIsNone(result)
+        self.assertEqual(reason, PMCC_filter.FAIL_PMCC_MAXRATIO_TOO_HIGH)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+from rh_aligner.alignment import pre_match_3d_incremental
+import numpy as np
+import shutil
+import tempfile
+import json
+import os
+import unittest
+
+
+def make_tilespec(url, mfov, tile_index, bbox):
+    return {"mipmapLevels": {"0": {"imageUrl": url}},
+            "mfov": mfov,
+            "tile_index": tile_index,
+            "layer": 2,
+            "width": bbox[1] - bbox[0],
+            "height": bbox[3] - bbox[2],
+            "bbox": bbox}
+
+
+def make_model(angle, translation):
+    return np.array([[np.cos(angle), -np.sin(angle), translation[0]],
+                     [np.sin(angle), np.cos(angle), translation[1]],
+                     [0., 0., 1.]])
+
+
+def make_match(mfov1, section2_center, model):
+    return {"mfov1": mfov1, "section2_center": list(section2_center), "transformation": {"matrix": model.tolist()}}
+
+
+class TestComposePreMatches(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tiles_fnames = [os.path.join(self.tmp_dir, "sec{}.json".format(sec)) for sec in "ABC"]
+        # Section B has two mfovs, centered at (50, 50) and (1050, 50)
+        with open(self.tiles_fnames[1], 'w') as out:
+            json.dump([make_tilespec("file:///b1.bmp", 1, 1, [0, 100, 0, 100]),
+                       make_tilespec("file:///b2.bmp", 2, 1, [1000, 1100, 0, 100])], out)
+        self.models_ab = {1: make_model(0.0, (10., 0.)), 3: make_model(0.1, (990., 20.))}
+        self.models_bc = {1: make_model(0.05, (-5., 3.)), 2: make_model(-0.02, (7., -4.))}
+        self.pre_matches_ab = self.save_pre_matches("ab", 0, 1, [make_match(1, (55., 50.), self.models_ab[1]),
+                                                                 make_match(3, (1040., 60.), self.models_ab[3])])
+        self.pre_matches_bc = self.save_pre_matches("bc", 1, 2, [make_match(1, (45., 52.), self.models_bc[1]),
+                                                                 make_match(2, (1052., 48.), self.models_bc[2])])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save_pre_matches(self, name, sec1, sec2, matches):
+        fname = os.path.join(self.tmp_dir, "{}_pre_matches.json".format(name))
+        with open(fname, 'w') as out:
+            json.dump({"tilespec1": self.tiles_fnames[sec1], "tilespec2": self.tiles_fnames[sec2], "matches": matches}, out)
+        return fname
+
+    def test_01_compose(self):
+        # Each section A mfov is composed with the section B mfov that is closest to its location in section B
+        estimates = pre_match_3d_incremental.compose_pre_matches(self.pre_matches_ab, self.pre_matches_bc)
+        self.assertEqual(sorted(estimates.keys()), [1, 3])
+        np.testing.assert_allclose(estimates[1], np.dot(self.models_bc[1], self.models_ab[1]))
+        np.testing.assert_allclose(estimates[3], np.dot(self.models_bc[2], self.models_ab[3]))
+
+    def test_02_fallbacks(self):
+        # A missing pre-matches file, pre-matches that don't share a section, or an empty matches list give no estimates
+        missing_fname = os.path.join(self.tmp_dir, "missing_pre_matches.json")
+        self.assertEqual(pre_match_3d_incremental.compose_pre_matches(self.pre_matches_ab, missing_fname), {})
+        self.assertEqual(pre_match_3d_incremental.compose_pre_matches(missing_fname, self.pre_matches_bc), {})
+        self.assertEqual(pre_match_3d_incremental.compose_pre_matches(self.pre_matches_bc, self.pre_matches_ab), {})
+        empty_bc = self.save_pre_matches("empty_bc", 1, 2, [])
+        self.assertEqual(pre_match_3d_incremental.compose_pre_matches(self.pre_matches_ab, empty_bc), {})
+
+    def test_03_meets_match_thresholds(self):
+        actual_params = {"num_filtered_percent": 0.25, "filter_rate_cutoff": 0.25}
+        # 1000 features in 2 mfovs require more than 125 filtered matches
+        self.assertTrue(pre_match_3d_incremental.meets_match_thresholds(actual_params, 126, 0.3, 1000, 2))
+        self.assertFalse(pre_match_3d_incremental.meets_match_thresholds(actual_params, 125, 0.3, 1000, 2))
+        self.assertFalse(pre_match_3d_incremental.meets_match_thresholds(actual_params, 200, 0.25, 1000, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
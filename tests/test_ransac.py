@@ -120,5 +120,32 @@ class TestRansac(unittest.TestCase):
             self.assertTrue(np.all(in_model[:len(good0)]))
             self.assertLess(np.max(np.abs(model.apply(good0) - good1)), 30)
 
+    def test_02_ransac_initial_model(self):
+        #
+        # Translated inliers (with up to 0.1 noise) and far outliers, so no
+        # sampled translation has more inliers than the exact translation
+        #
+        r = np.random.RandomState(2020)
+        good0 = r.uniform(size=(30, 2)) * 1000
+        good1 = good0 + np.array([12.0, -7.0]) + (r.uniform(size=good0.shape) - .5) * .2
+        bad0 = r.uniform(size=(10, 2)) * 1000
+        bad1 = bad0 + r.uniform(size=bad0.shape) * 500 + 100
+        matches = np.array([np.vstack((good0, bad0)), np.vstack((good1, bad1))])
+        initial_model = rh_renderer.models.Transforms.create(0)
+        initial_model.fit(good0, good0 + np.array([12.0, -7.0]))
+        in_model, model, distances = R.ransac(matches, 0, 100, 1, .1, 10, initial_model=initial_model)
+        # A sampled model that only ties the initial model doesn't replace it
+        np.testing.assert_allclose(model.get_matrix(), initial_model.get_matrix())
+        self.assertTrue(np.all(in_model[:len(good0)]))
+        self.assertFalse(np.any(in_model[len(good0):]))
+        #
+        # A wrong initial model is replaced by a sampled model
+        #
+        wrong_model = rh_renderer.models.Transforms.create(0)
+        wrong_model.fit(good0, good0 + np.array([300.0, 300.0]))
+        in_model, model, distances = R.ransac(matches, 0, 100, 1, .1, 10, initial_model=wrong_model)
+        self.assertTrue(np.all(in_model[:len(good0)]))
+        self.assertLess(np.max(np.abs(model.apply(good0) - good1)), 1)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,52 @@
+from rh_aligner.common import utils
+from rh_aligner.common.section_grid_index import SectionGridIndex
+import numpy as np
+import unittest
+
+
+def make_tilespec(mfov, tile_index, bbox):
+    return {"mipmapLevels": {"0": {"imageUrl": "file:///{}_{}.bmp".format(mfov, tile_index)}},
+            "mfov": mfov,
+            "tile_index": tile_index,
+            "bbox": bbox}
+
+
+class TestHexagonalGrid(unittest.TestCase):
+    def test_01_grid(self):
+        bbox = [100, 5000, -300, 4000]
+        grid = utils.generate_hexagonal_grid(bbox, 500)
+        self.assertEqual(grid.shape[1], 2)
+        # The grid covers the bounding box
+        self.assertLessEqual(grid[:, 0].min(), bbox[0])
+        self.assertGreaterEqual(grid[:, 0].max(), bbox[1])
+        self.assertLessEqual(grid[:, 1].min(), bbox[2])
+        self.assertGreaterEqual(grid[:, 1].max(), bbox[3])
+        # Odd rows are shifted by half the spacing
+        rows = (grid[:, 1] - bbox[2]) // 500
+        self.assertTrue(np.all((grid[rows % 2 == 1, 0] - bbox[0]) % 500 == 250))
+        self.assertTrue(np.all((grid[rows % 2 == 0, 0] - bbox[0]) % 500 == 0))
+
+
+class TestSectionGridIndex(unittest.TestCase):
+    def test_01_build(self):
+        tilespecs = [make_tilespec(1, 1, [0, 1000, 0, 1000]),
+                     make_tilespec(1, 2, [1000, 2000, 0, 1000]),
+                     make_tilespec(2, 1, [0, 1000, 1000, 2000]),
+                     make_tilespec(2, 2, [1000, 2000, 1000, 2000])]
+        grid_index = SectionGridIndex.build(tilespecs, [0, 2000, 0, 2000], 300)
+        self.assertEqual(len(grid_index.points), len(utils.generate_hexagonal_grid([0, 2000, 0, 2000], 300)))
+        for p, tile_idx, mfov in zip(grid_index.points, grid_index.point_tiles, grid_index.point_mfovs):
+            containing = [i for i, ts in enumerate(tilespecs) if
+                          ts["bbox"][0] < p[0] < ts["bbox"][1] and ts["bbox"][2] < p[1] < ts["bbox"][3]]
+            if len(containing) == 0:
+                self.assertEqual(tile_idx, -1)
+                self.assertEqual(mfov, -1)
+            else:
+                self.assertEqual(tile_idx, containing[0])
+                self.assertEqual(mfov, tilespecs[containing[0]]["mfov"])
+        mfov_points = grid_index.mfov_points(2)
+        self.assertTrue(np.all(mfov_points[:, 1] > 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+from rh_aligner.common.tile_collection import TileCollection
+import numpy as np
+import unittest
+
+
+def make_tilespec(url, mfov, tile_index, bbox):
+    return {"mipmapLevels": {"0": {"imageUrl": url}},
+            "mfov": mfov,
+            "tile_index": tile_index,
+            "layer": 1,
+            "width": bbox[1] - bbox[0],
+            "height": bbox[3] - bbox[2],
+            "bbox": bbox,
+            "transforms": [{"className": "mpicbg.trakem2.transform.TranslationModel2D",
+                            "dataString": "{} {}".format(bbox[0], bbox[2])}]}
+
+
+class TestTileCollection(unittest.TestCase):
+    def setUp(self):
+        self.tilespecs = [make_tilespec("file:///a.bmp", 1, 1, [0, 100, 0, 50]),
+                          make_tilespec("file:///b.bmp", 1, 2, [90, 190, 0, 50]),
+                          make_tilespec("file:///c.bmp", 2, 1, [1000, 1100, 500, 550])]
+        self.tiles = TileCollection(self.tilespecs)
+
+    def test_01_lookups(self):
+        self.assertEqual(len(self.tiles), 3)
+        self.assertIs(self.tiles.get_by_url("file:///b.bmp"), self.tilespecs[1])
+        self.assertIsNone(self.tiles.get_by_url("file:///d.bmp"))
+        self.assertEqual(self.tiles.index_of(2, 1), 2)
+        self.assertIsNone(self.tiles.get(2, 2))
+        self.assertEqual(self.tiles.sorted_mfovs(), [1, 2])
+        np.testing.assert_array_equal(self.tiles.mfov_indices(1), [0, 1])
+
+    def test_02_centers(self):
+        np.testing.assert_array_almost_equal(self.tiles.centers(),
+                                             [[50, 25], [140, 25], [1050, 525]])
+        mfov_centers = self.tiles.mfov_centers()
+        np.testing.assert_array_almost_equal(mfov_centers[1], [95, 25])
+        np.testing.assert_array_almost_equal(mfov_centers[2], [1050, 525])
+
+    def test_03_transform_params(self):
+        np.testing.assert_array_almost_equal(self.tiles.transform_params[1, :2], [90, 0])
+        self.assertTrue(np.all(np.isnan(self.tiles.transform_params[:, 2:])))
+
+    def test_04_overlapping(self):
+        np.testing.assert_array_equal(self.tiles.overlapping([95, 96, 10, 20]), [0, 1])
+        np.testing.assert_array_equal(self.tiles.overlapping([200, 300, 0, 50]), [])
+
+    def test_05_round_trip(self):
+        self.assertEqual(self.tiles.to_tilespecs(), self.tilespecs)
+
+
+if __name__ == '__main__':
+    unittest.main()